@@ -0,0 +1,62 @@
+import os
+import time
+import random
+import itertools
+import tempfile
+import onir
+from onir import indices, util
+
+
+def main():
+    logger = onir.log.easy()
+
+    context = onir.injector.load({
+        'vocab': onir.vocab,
+        'dataset': onir.datasets
+    })
+
+    dataset = context['dataset']
+    logger.debug(f'dataset: {dataset.config}')
+
+    doc_count = int(onir.config.args().get('docs', '100000'))
+    read_count = int(onir.config.args().get('reads', '10000'))
+    batch_size = int(onir.config.args().get('batch', '64'))
+    seed = int(onir.config.args().get('random_seed', '42'))
+
+    logger.debug(f'docs: {doc_count}')
+    logger.debug(f'reads: {read_count}')
+    logger.debug(f'batch: {batch_size}')
+
+    dataset.init()
+    source = dataset._get_docstore()
+    dids = list(itertools.islice(source.docids(), doc_count))
+    docs = []
+    for chunk in util.chunked(logger.pbar(dids, desc='loading documents'), 1000):
+        docs.extend(indices.RawDoc(did, text) for did, text in zip(chunk, source.get_raws(chunk)))
+    rng = random.Random(seed)
+    reads = [rng.choice(dids) for _ in range(read_count)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {}
+        for name, compress in [('plain', False), ('zstd', True)]:
+            docstore = indices.SqliteDocstore(os.path.join(tmpdir, name), compress=compress)
+            t = time.perf_counter()
+            docstore.build(iter(docs))
+            build_time = time.perf_counter() - t
+            size = os.path.getsize(docstore.path())
+            t = time.perf_counter()
+            for did in reads:
+                docstore.get_raw(did)
+            get_raw_rate = read_count / (time.perf_counter() - t)
+            t = time.perf_counter()
+            for batch in util.chunked(reads, batch_size):
+                docstore.get_raws(batch)
+            get_raws_rate = read_count / (time.perf_counter() - t)
+            results[name] = size
+            logger.info(f'{name} size={size/1024/1024:.1f}MB build={build_time:.1f}s '
+                        f'get_raw={get_raw_rate:.0f}docs/s get_raws={get_raws_rate:.0f}docs/s')
+        logger.info(f'size ratio (zstd/plain)={results["zstd"] / results["plain"]:.3f}')
+
+
+if __name__ == '__main__':
+    main()
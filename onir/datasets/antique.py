@@ -30,9 +30,9 @@ https://ciir.cs.umass.edu/downloads/Antique/readme.txt"""
     def __init__(self, config, logger, vocab):
         super().__init__(config, logger, vocab)
         base_path = util.path_dataset(self)
-        self.index = indices.AnseriniIndex(os.path.join(base_path, 'anserini'), stemmer='none')
-        self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqlite'))
+        self.index = self._lexical_index(os.path.join(base_path, 'anserini'), stemmer='none')
+        self.index_stem = self._lexical_index(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqlite'))
 
     def qrels(self, fmt='dict'):
         return self._load_qrels(self.config['subset'], fmt)
@@ -30,6 +30,9 @@ class Dataset:
     def build_record(self, fields, **initial_values):
         raise NotImplementedError
 
+    def build_records(self, fields, pairs):
+        return [self.build_record(fields, query_id=qid, doc_id=did) for qid, did in pairs]
+
     def all_doc_ids(self):
         raise NotImplementedError
 
@@ -0,0 +1,94 @@
+import inspect
+import collections
+import multiprocessing
+import numpy as np
+import onir
+from onir import spec
+
+
+class BatchWorkerPool:
+    """
+    Builds model input batches in a pool of worker processes.
+
+    Batches are provided as dicts of lists of pre-resolved values (at least query_id and doc_id,
+    e.g., as produced by record_iter or pair_iter with only those fields). Each worker process
+    constructs its own copy of the dataset (and vocabulary) from their configurations, so docstore
+    and index handles are never shared between processes. Workers resolve the remaining fields and
+    apply the input spec, and the resulting batches are yielded in the order they are provided.
+    """
+    def __init__(self, dataset, fields, input_spec, workers, prefetch=None):
+        self.dataset = dataset
+        self.fields = set(fields)
+        self.input_spec = input_spec
+        self.workers = workers
+        self.prefetch = prefetch or (workers * 2)
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn (rather than fork) so that workers do not inherit JVM or SQLite state
+            ctx = multiprocessing.get_context('spawn')
+            vocab = self.dataset.vocab
+            initargs = (
+                dict(onir.config.args()),
+                type(self.dataset), dict(self.dataset.config), self.dataset.logger.name,
+                type(vocab), dict(vocab.config), vocab.logger.name,
+            )
+            self._pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=initargs)
+        return self._pool
+
+    def imap(self, batches):
+        """
+        Yields built batches (in order). At most self.prefetch batches are queued ahead of the one
+        being consumed.
+        """
+        pool = self._get_pool()
+        pending = collections.deque()
+        for batch in batches:
+            # send the current config along with each batch; it may have changed (e.g., rankfn
+            # during a grid search).
+            pending.append(pool.apply_async(_build_batch, (batch, dict(self.dataset.config), self.fields, self.input_spec)))
+            if len(pending) >= self.prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+_worker = {}
+
+
+def _init_worker(*initargs):
+    # The dataset is constructed when the first batch arrives (rather than here) so that any
+    # failure is propagated to the parent process instead of the pool repeatedly re-spawning
+    # workers.
+    _worker['initargs'] = initargs
+
+
+def _get_dataset():
+    if 'dataset' not in _worker:
+        args, ds_cls, ds_config, ds_logger, vocab_cls, vocab_config, vocab_logger = _worker['initargs']
+        onir.config.args().update(args)
+        random = np.random.RandomState(int(args['random_seed']))
+        vocab = _construct(vocab_cls, config=vocab_config, logger=onir.log.Logger(vocab_logger), random=random)
+        _worker['dataset'] = _construct(ds_cls, config=ds_config, logger=onir.log.Logger(ds_logger), vocab=vocab, random=random)
+    return _worker['dataset']
+
+
+def _construct(cls, **available):
+    args = inspect.getfullargspec(cls.__init__).args
+    return cls(*(available[arg] for arg in args if arg != 'self'))
+
+
+def _build_batch(batch, config, fields, input_spec):
+    dataset = _get_dataset()
+    dataset.config.update(config)
+    # fields already provided with the batch (e.g., relscore from msmarco's mspairs) are kept as-is
+    build_fields = set(fields) - set(batch)
+    records = dataset.build_records(build_fields, zip(batch['query_id'], batch['doc_id']))
+    result = {f: (batch[f] if f in batch else [r[f] for r in records]) for f in fields}
+    return spec.apply_spec_batch(result, input_spec)
@@ -41,7 +41,7 @@ http://trec-car.cs.unh.edu/"""
         base_path = util.path_dataset(self)
         self.index = indices.AnseriniIndex(os.path.join(base_path, 'anserini'), stemmer='none')
         self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqlite'))
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqlite'))
 
     def path_segment(self):
         result = '{name}_{subset}_{rankfn}.{ranktopk}'.format(name=self.name, **self.config)
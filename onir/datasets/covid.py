@@ -1,7 +1,6 @@
 import os
 import json
 import contextlib
-import functools
 import pandas as pd
 from bs4 import BeautifulSoup
 from pytools import memoize_method
@@ -52,7 +51,7 @@ https://ir.nist.gov/covidSubmit/"""
         os.makedirs(base_path, exist_ok=True)
         self.index_stem = indices.MultifieldAnseriniIndex(os.path.join(base_path, 'anserini_multifield'), stemmer='porter', primary_field=config['bs_field'])
         self.index_stem_2020 = indices.MultifieldAnseriniIndex(os.path.join(base_path, 'anserini_multifield_2020'), stemmer='porter', primary_field=config['bs_field'])
-        self.doc_store = indices.MultifieldSqliteDocstore(os.path.join(base_path, 'docs_multifield.sqlite'), primary_field=config['rr_field'])
+        self.doc_store = indices.MultifieldSqliteDocstore(os.path.join(base_path, 'docs_multifield.sqlite'), primary_field=config['rr_field'], compress=config['docstore_compress'])
 
     def path_segment(self):
         result = '{base}_{date}'.format(base=super().path_segment(), **self.config)
@@ -86,6 +85,9 @@ https://ir.nist.gov/covidSubmit/"""
     def _get_docstore(self):
         return self.doc_store
 
+    def _tokstore_path(self):
+        return '{path}.{rr_field}.tok'.format(path=self.doc_store.path(), **self.config)
+
     def _load_queries_base(self, subset):
         rnd, fields = subset.split('-', 1)
         fields = fields.split('-')
@@ -111,14 +113,15 @@ https://ir.nist.gov/covidSubmit/"""
                 needs_docs.append(index)
 
         if needs_docs and self._confirm_dua():
-            with contextlib.ExitStack() as stack:
-                doc_iter = self._init_iter_collection()
-                doc_iter = self.logger.pbar(doc_iter, desc='articles')
-                doc_iters = util.blocking_tee(doc_iter, len(needs_docs))
-                for idx, it in zip(needs_docs, doc_iters):
-                    if idx is self.index_stem_2020:
-                        it = (d for d in it if '2020' in d.data['date'])
-                    stack.enter_context(util.CtxtThread(functools.partial(idx.build, it)))
+            doc_iter = self._init_iter_collection()
+            doc_iter = self.logger.pbar(doc_iter, desc='articles')
+            build_fns = []
+            for idx in needs_docs:
+                if idx is self.index_stem_2020:
+                    build_fns.append(lambda it, idx=idx: idx.build(d for d in it if '2020' in d.data['date']))
+                else:
+                    build_fns.append(idx.build)
+            util.fan_out(doc_iter, build_fns, logger=self.logger)
 
         path = os.path.join(util.path_dataset(self), 'rnd1.tsv')
         if not os.path.exists(path) and self._confirm_dua():
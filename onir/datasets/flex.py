@@ -1,8 +1,6 @@
 import os
 import sys
-import contextlib
 import itertools
-import functools
 from glob import glob
 from tqdm import tqdm
 from pytools import memoize_method
@@ -29,9 +27,9 @@ class FlexDataset(datasets.IndexBackedDataset):
         super().__init__(config, logger, vocab)
         base_path = os.path.join(util.path_dataset(self), config['subset'])
         os.makedirs(base_path, exist_ok=True)
-        self.index = indices.AnseriniIndex(os.path.join(base_path, 'anserini'), stemmer='none')
-        self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqllite'))
+        self.index = self._lexical_index(os.path.join(base_path, 'anserini'), stemmer='none')
+        self.index_stem = self._lexical_index(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqllite'))
 
     def collection_path_segment(self):
         return '{name}_{subset}'.format(name=self.name, **self.config)
@@ -96,10 +94,7 @@ class FlexDataset(datasets.IndexBackedDataset):
                 datafiles = glob(df_glob)
             main_iter = itertools.chain(*(plaintext.read_tsv(df) for df in datafiles))
             main_iter = tqdm(main_iter, desc='reading datafiles')
-            iters = util.blocking_tee(main_iter, len(needs_datafile))
-            with contextlib.ExitStack() as stack:
-                for fn, it in zip(needs_datafile, iters):
-                    stack.enter_context(util.CtxtThread(functools.partial(fn, it)))
+            util.fan_out(main_iter, needs_datafile, logger=self.logger)
 
         qrels_file = os.path.join(base_dir, 'qrels.txt')
         while not os.path.exists(qrels_file):
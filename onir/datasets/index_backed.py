@@ -1,10 +1,8 @@
 import os
-import functools
-import contextlib
-import pickle
 from glob import glob
+import numpy as np
 from pytools import memoize_method
-from onir import datasets, util
+from onir import datasets, util, indices
 from onir.interfaces import trec
 
 
@@ -19,16 +17,44 @@ class IndexBackedDataset(datasets.Dataset):
         result.update({
             'rankfn': 'bm25',
             'subset': 'all',
-            'ranktopk': 1000
+            'ranktopk': 1000,
+            'index_backend': 'anserini', # anserini or numpy (indices.InvertedIndex, which does not need the JVM)
+            'tokstore': False, # serve doc_tok/doc_len from a pre-tokenized (memory-mapped) docstore
+            'record_cache_mb': 0, # size of the cache of query/document fields shared between records (0 to disable)
+            'docstore_compress': False, # build SQLite docstores with zstd (dictionary) compression
+            'batch_qdscores': False, # score runscore/query_score for the whole run at once (needs the run)
         })
         return result
 
     def __init__(self, config, logger, vocab):
         super().__init__(config, logger, vocab)
         self.run_cache = {}
+        self._record_cache = None
+        self._record_cache_config = None
+
+    def _lexical_index(self, path, **kwargs):
+        """
+        Returns the lexical index at path (with the AnseriniIndex arguments kwargs), using the
+        implementation selected by the index_backend config.
+        """
+        if self.config['index_backend'] == 'anserini':
+            return indices.AnseriniIndex(path, **kwargs)
+        if self.config['index_backend'] == 'numpy':
+            return indices.InvertedIndex(f'{path}.numpy', **kwargs)
+        raise ValueError(f'unknown index_backend {self.config["index_backend"]}')
+
+    def _sqlite_docstore(self, path, **kwargs):
+        """
+        Returns the SQLite docstore at path (with the SqliteDocstore arguments kwargs), compressed
+        when built if the docstore_compress config is set.
+        """
+        return indices.SqliteDocstore(path, compress=self.config['docstore_compress'], **kwargs)
 
     def path_segment(self):
-        return '{name}_{subset}_{rankfn}.{ranktopk}'.format(name=self.name, **self.config)
+        result = '{name}_{subset}_{rankfn}.{ranktopk}'.format(name=self.name, **self.config)
+        if self.config['index_backend'] != 'anserini':
+            result += '_{index_backend}'.format(**self.config)
+        return result
 
     def collection_path_segment(self):
         return '{name}'.format(name=self.name, **self.config)
@@ -38,6 +64,57 @@ class IndexBackedDataset(datasets.Dataset):
         record.load(fields)
         return record
 
+    def build_records(self, fields, pairs):
+        """
+        Builds the records for a batch of (query_id, doc_id) pairs. If the document text is needed,
+        it is fetched from the docstore for the whole batch at once.
+        """
+        records = [LazyDataRecord(self, query_id=qid, doc_id=did) for qid, did in pairs]
+        if self._needs_doc_rawtext(fields):
+            # pylint: disable=W0212
+            cache = self._get_record_cache() if self.config['record_cache_mb'] > 0 else None
+            missing = [r for r in records if cache is None or ('doc_rawtext', r['doc_id']) not in cache]
+            if missing:
+                raws = self._get_docstore().get_raws([r['doc_id'] for r in missing])
+                for record, raw in zip(missing, raws):
+                    record._data['doc_rawtext'] = raw
+        for record in records:
+            record.load(fields)
+        return records
+
+    def _needs_doc_rawtext(self, fields):
+        if type(self)._doc_rawtext is not IndexBackedDataset._doc_rawtext:
+            return False # doc_rawtext is not sourced from the docstore
+        needs = {'doc_rawtext', 'doc_text', 'doc_idf'}
+        if not self.config['tokstore']:
+            needs = needs | {'doc_tok', 'doc_len'}
+        return bool(needs & set(fields))
+
+    def _resolve_field(self, field, method, record):
+        # Fields that only depend on the query (or only on the document) are shared between records
+        # through a LRU cache, keyed by query_id (or doc_id).
+        if self.config['record_cache_mb'] > 0:
+            # pylint: disable=W0212
+            if field in CACHED_DOC_FIELDS and 'doc_id' in record._data:
+                return self._get_record_cache().get((field, record._data['doc_id']), lambda: method(record))
+            if field in CACHED_QUERY_FIELDS and 'query_id' in record._data:
+                return self._get_record_cache().get((field, record._data['query_id']), lambda: method(record))
+        return method(record)
+
+    def _get_record_cache(self):
+        if self._record_cache is None:
+            self._record_cache = util.LruCache(self.config['record_cache_mb'] * 1024 * 1024)
+        if self._record_cache_config != self.config:
+            # config changed (e.g., rankfn during a grid search); cached values may no longer apply
+            if self._record_cache_config is not None:
+                self.logger.debug(f'clearing record cache: {self._record_cache.stats()}')
+                self._record_cache.clear()
+            self._record_cache_config = dict(self.config)
+        lookups = self._record_cache.hits + self._record_cache.misses
+        if lookups > 0 and lookups % RECORD_CACHE_LOG_INTERVAL == 0:
+            self.logger.debug(f'record cache: {self._record_cache.stats()}')
+        return self._record_cache
+
     def run(self, fmt='dict'):
         return self._load_run_base(self._get_index_for_batchsearch(),
                                    self.config['subset'],
@@ -75,40 +152,26 @@ class IndexBackedDataset(datasets.Dataset):
         run_dir = f'{index_path}.{subset}.runs'
         os.makedirs(run_dir, exist_ok=True)
         run_path = os.path.join(run_dir, f'{rankfn}.{ranktopk}.run')
-        run_path_cache = f'{run_path}.{fmt}.cache'
 
-        result = self._load_run_base_fscached(run_path_cache, rankfn, ranktopk, fscache)
-        if result is None:
-            result = self._load_run_base_direct(run_path, rankfn, ranktopk, fmt)
+        # with fscache, runs are read from (or written to) a binary sidecar next to the run file
+        result = self._load_run_base_direct(run_path, rankfn, ranktopk, fmt, fscache)
         if result is None:
-            result = self._load_run_base_infer(run_dir, rankfn, ranktopk, fmt)
+            result = self._load_run_base_infer(run_dir, run_path, rankfn, ranktopk, fmt, fscache)
         if result is None:
-            result = self._load_run_base_query(index, subset, rankfn, ranktopk, run_path, fmt)
-
-        if fscache and not os.path.exists(run_path_cache):
-            with open(run_path_cache, 'wb') as f:
-                with self.logger.duration(f'caching {rankfn}:{ranktopk}'):
-                    pickle.dump(result, f)
+            result = self._load_run_base_query(index, subset, rankfn, ranktopk, run_path, fmt, fscache)
 
         if memcache:
             self.run_cache[key] = result
 
         return result
 
-    def _load_run_base_fscached(self, run_path_cache, rankfn, ranktopk, fscache=False):
-        if fscache and os.path.exists(run_path_cache):
-            with open(run_path_cache, 'rb') as f:
-                with self.logger.duration(f'reading {rankfn}:{ranktopk} (cached)'):
-                    return pickle.load(f)
-        return None
-
-    def _load_run_base_direct(self, run_path, rankfn, ranktopk, fmt='dict'):
+    def _load_run_base_direct(self, run_path, rankfn, ranktopk, fmt='dict', fscache=False):
         if os.path.exists(run_path):
             with self.logger.duration(f'reading {rankfn}:{ranktopk}'):
-                return trec.read_run_fmt(run_path, fmt=fmt)
+                return trec.read_run_fmt(run_path, fmt=fmt, cache=fscache)
         return None
 
-    def _load_run_base_infer(self, run_dir, rankfn, ranktopk, fmt='dict'):
+    def _load_run_base_infer(self, run_dir, run_path, rankfn, ranktopk, fmt='dict', fscache=False):
         best_candidate_run, best_topk = None, None
         for candidate_run in glob(os.path.join(run_dir, f'{rankfn}.*.run')):
             c_topk = int(candidate_run.split('.')[-2])
@@ -117,7 +180,9 @@ class IndexBackedDataset(datasets.Dataset):
                 best_topk = c_topk
         if best_candidate_run is not None:
             with self.logger.duration(f'loading {rankfn}:{ranktopk} from larger batch {rankfn}:{best_topk}'):
-                return trec.read_run_fmt(best_candidate_run, fmt, top=ranktopk)
+                # the truncated run is saved, so later lookups are direct
+                trec.truncate_run(best_candidate_run, run_path, ranktopk)
+                return trec.read_run_fmt(run_path, fmt, cache=fscache)
         return None
 
     def _init_indices_parallel(self, indices, doc_iter, force):
@@ -127,15 +192,23 @@ class IndexBackedDataset(datasets.Dataset):
                 needs_docs.append(index)
 
         if needs_docs and self._confirm_dua():
-            with contextlib.ExitStack() as stack:
-                doc_iters = util.blocking_tee(doc_iter, len(needs_docs))
-                for idx, it in zip(needs_docs, doc_iters):
-                    stack.enter_context(util.CtxtThread(functools.partial(idx.build, it)))
+            util.fan_out(doc_iter, [idx.build for idx in needs_docs], logger=self.logger)
 
-    def _load_run_base_query(self, index, subset, rankfn, ranktopk, run_path, fmt):
+    def _load_run_base_query(self, index, subset, rankfn, ranktopk, run_path, fmt, fscache=False):
         queries = self._load_queries_base(subset).items()
-        index.batch_query(queries, rankfn, ranktopk, destf=run_path)
-        return trec.read_run_fmt(run_path, fmt)
+        if not hasattr(index, 'batch_query_table'):
+            index.batch_query(queries, rankfn, ranktopk, destf=run_path)
+            return trec.read_run_fmt(run_path, fmt, cache=fscache)
+        # the run is kept in memory (rather than re-read from run_path) once it is written
+        run = index.batch_query_table(queries, rankfn, ranktopk)
+        run.save_file(f'{run_path}.tmp', runid=rankfn)
+        os.replace(f'{run_path}.tmp', run_path)
+        return {
+            'trec': lambda: run_path,
+            'dict': run.to_dict,
+            'df': run.to_df,
+            'table': lambda: run,
+        }[fmt]()
 
     def _load_queries_base(self, subset):
         raise NotImplementedError()
@@ -149,6 +222,16 @@ class IndexBackedDataset(datasets.Dataset):
     def _get_index_for_batchsearch(self):
         raise NotImplementedError
 
+    def _tokstore_path(self):
+        return '{}.tok'.format(self._get_docstore().path())
+
+    @memoize_method
+    def _get_tokstore(self):
+        tokstore = indices.TokenizedDocstore(self._tokstore_path(), self._get_docstore(), self.vocab)
+        if not tokstore.built():
+            tokstore.build()
+        return tokstore
+
     def _lang(self):
         return "en"
 
@@ -163,8 +246,15 @@ class IndexBackedDataset(datasets.Dataset):
 
     def _query_idf(self, record):
         index = self._get_index(record)
+        self._precompute_query_analysis(index)
         return [index.term2idf(t) for t in record['query_text']]
 
+    @memoize_method
+    def _precompute_query_analysis(self, index):
+        # the terms of all the queries are analyzed together (and stored by the index), rather than
+        # one at a time in each process
+        index.precompute_analyzed({t for _, text in self.all_queries_raw() for t in self.vocab.tokenize(text)})
+
     def _query_len(self, record):
         return len(record['query_text'])
 
@@ -172,8 +262,7 @@ class IndexBackedDataset(datasets.Dataset):
         return self._lang()
 
     def _query_score(self, record):
-        index = self._get_index(record)
-        return index.get_query_doc_scores(record['query_text'], record['doc_id'], self.config['rankfn'])[1]
+        return self._query_doc_scores(record)[1]
 
     def _doc_rawtext(self, record):
         docstore = self._get_docstore()
@@ -183,6 +272,8 @@ class IndexBackedDataset(datasets.Dataset):
         return self.vocab.tokenize(record['doc_rawtext'])
 
     def _doc_tok(self, record):
+        if self.config['tokstore']:
+            return self._get_tokstore().get_tok(record['doc_id'])
         return [self.vocab.tok2id(t) for t in record['doc_text']]
 
     def _doc_idf(self, record):
@@ -190,47 +281,69 @@ class IndexBackedDataset(datasets.Dataset):
         return [index.term2idf(t) for t in record['doc_rawtext']]
 
     def _doc_len(self, record):
+        if self.config['tokstore']:
+            return self._get_tokstore().get_len(record['doc_id'])
         return len(record['doc_text'])
 
     def _doc_lang(self, record):
         return self._lang()
 
     def _runscore(self, record):
+        return self._query_doc_scores(record)[0]
+
+    def _query_doc_scores(self, record):
         index = self._get_index(record)
-        return index.get_query_doc_scores(record['query_text'], record['doc_id'], self.config['rankfn'])[0]
+        result = None
+        if self.config['batch_qdscores']:
+            # scores of all pairs in the run are computed at once; other pairs are scored individually.
+            # fmt='trec' provides the path of the run file (which the scores are cached alongside)
+            run_scores = self._load_query_doc_scores(index, self.config['rankfn'], self.run(fmt='trec'))
+            if run_scores is not None:
+                result = run_scores.get(record['query_id'], record['doc_id'], record['query_text'])
+        if result is None:
+            result = index.get_query_doc_scores(record['query_text'], record['doc_id'], self.config['rankfn'])
+        return result
+
+    @memoize_method
+    def _load_query_doc_scores(self, index, rankfn, run_path):
+        if not hasattr(index, 'batch_query_doc_scores') or indices.scoring.parse_model(rankfn) is None:
+            return None
+        path = f'{run_path}.{self.vocab.lexicon_path_segment()}.qdscores.npz'
+        stat = os.stat(run_path)
+        stat = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        result = indices.scoring.QueryDocScores.load(path, stat)
+        if result is None:
+            with self.logger.duration(f'computing {rankfn} query-document scores for {run_path}'):
+                queries = {qid: tuple(self.vocab.tokenize(text)) for qid, text in self._load_queries_base(self.config['subset']).items()}
+                run = self.run(fmt='dict')
+                result = index.batch_query_doc_scores(queries, run, rankfn)
+            result.save(path, stat)
+        return result
 
     def _relscore(self, record):
         return float(self.qrels('dict').get(record['query_id'], {}).get(record['doc_id'], -999))
 
     def _kdescore(self, record):
-        return self._kde_crf(record['query_id'])(record['runscore']).item()
+        return self._run_scores().kdescore(record['query_id'], record['runscore'])
 
     def _normscore(self, record):
-        return self._norm(record['query_id'])(record['runscore'])
+        return self._run_scores().normscore(record['query_id'], record['runscore'])
 
     def _rank(self, record):
-        ranks = self._rank_dict()
-        return ranks[record['query_id']].get(record['doc_id'], 1000)
+        return self._run_scores().rank(record['query_id'], record['doc_id'])
 
-    @memoize_method
-    def _kde_crf(self, qid):
-        run = self.run_dict().get(qid, {})
-        return util.kde_cdf_from_run(run)
+    def _run_scores(self):
+        # fmt='trec' provides the path of the run file (which the statistics are cached alongside)
+        return self._load_run_scores(self.run(fmt='trec'))
 
     @memoize_method
-    def _norm(self, qid):
-        scores = self.run_dict().get(qid, {}).values()
-        mx, mn = max(scores), min(scores)
-        return lambda x: (x - mn) / (mx - mn)
+    def _load_run_scores(self, run_path):
+        return datasets.RunScores.load_or_build(run_path, self.logger)
 
-    @memoize_method
-    def _rank_dict(self):
-        run = self.run_dict()
-        result = {}
-        for qid in run:
-            sorted_docs = sorted(run[qid].items(), key=lambda x: (x[1], x[0]), reverse=True)
-            result[qid] = {did: rank+1 for rank, (did, score) in enumerate(sorted_docs)}
-        return result
+
+CACHED_QUERY_FIELDS = {'query_rawtext', 'query_text', 'query_tok', 'query_idf', 'query_len', 'query_lang'}
+CACHED_DOC_FIELDS = {'doc_rawtext', 'doc_text', 'doc_tok', 'doc_idf', 'doc_len', 'doc_lang'}
+RECORD_CACHE_LOG_INTERVAL = 100000
 
 
 class LazyDataRecord:
@@ -262,7 +375,7 @@ class LazyDataRecord:
     def __getitem__(self, key):
         if key not in self._data:
             if key in self.methods:
-                self._data[key] = self.methods[key](self)
+                self._data[key] = self.ds._resolve_field(key, self.methods[key], self) # pylint: disable=W0212
             else:
                 raise ValueError(f'Unsupported input `{key}`')
         return self._data[key]
@@ -4,8 +4,6 @@ import itertools
 import gzip
 import tarfile
 import zipfile
-import contextlib
-import functools
 from tqdm import tqdm
 from pytools import memoize_method
 import onir
@@ -81,7 +79,7 @@ http://www.msmarco.org/dataset.aspx"""
         base_path = util.path_dataset(self)
         self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
         self.index_doctttttquery_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.doctttttquery.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqllite'))
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqllite'))
 
     def _get_docstore(self):
         return self.doc_store
@@ -114,7 +112,7 @@ http://www.msmarco.org/dataset.aspx"""
         path = os.path.join(base_path, f'{subset}.queries.tsv')
         return dict(self.logger.pbar(plaintext.read_tsv(path), desc='loading queries'))
 
-    def pair_iter(self, fields, pos_source='intersect', neg_source='run', sampling='query', pos_minrel=1, unjudged_rel=0, num_neg=1, random=None, inf=False):
+    def pair_iter(self, fields, pos_source='intersect', neg_source='run', sampling='query', pos_minrel=1, unjudged_rel=0, num_neg=1, random=None, inf=False, engine='pandas', sampler_state=None):
         special = self.config['special']
         if special == '':
             raise NotImplementedError
@@ -135,13 +133,12 @@ http://www.msmarco.org/dataset.aspx"""
                     if qid in MINI_DEV:
                         continue
                     result = {f: [] for f in fields}
-                    for did in [pos_did, neg_did]:
-                        record = self.build_record(fields, query_id=qid, doc_id=did)
+                    for record in self.build_records(fields, [(qid, pos_did), (qid, neg_did)]):
                         for f in fields:
                             result[f].append(record[f])
                     yield result
 
-    def record_iter(self, fields, source, minrel=None, shuf=True, random=None, inf=False, run_threshold=None):
+    def record_iter(self, fields, source, minrel=None, shuf=True, random=None, inf=False, run_threshold=None, sampler_state=None):
         special = self.config['special']
         if special == '':
             raise NotImplementedError
@@ -215,16 +212,13 @@ http://www.msmarco.org/dataset.aspx"""
 
         if needs_queries and self._confirm_dua():
             with util.download_tmp(_SOURCES['queries'], expected_md5=_HASHES['queries']) as f, \
-                 tarfile.open(fileobj=f) as tarf, \
-                 contextlib.ExitStack() as ctxt:
+                 tarfile.open(fileobj=f) as tarf:
                 def _extr_subf(subf):
                     for qid, txt in plaintext.read_tsv(io.TextIOWrapper(tarf.extractfile(subf))):
                         yield subf, qid, txt
                 query_iter = [_extr_subf('queries.train.tsv'), _extr_subf('queries.dev.tsv'), _extr_subf('queries.eval.tsv')]
                 query_iter = tqdm(itertools.chain(*query_iter), desc='queries')
-                query_iters = util.blocking_tee(query_iter, len(needs_queries))
-                for fn, it in zip(needs_queries, query_iters):
-                    ctxt.enter_context(util.CtxtThread(functools.partial(fn, it)))
+                util.fan_out(query_iter, needs_queries, logger=self.logger)
 
         file = os.path.join(base_path, 'train.qrels')
         file_mini = os.path.join(base_path, 'minidev.qrels')
@@ -1,7 +1,5 @@
 import os
 import tarfile
-import contextlib
-import functools
 from glob import glob
 from multiprocessing import Pool
 from pytools import memoize_method
@@ -44,7 +42,7 @@ https://catalog.ldc.upenn.edu/LDC2008T19"""
         base_path = util.path_dataset(self)
         self.index = indices.AnseriniIndex(os.path.join(base_path, 'anserini'), stemmer='none')
         self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqllite'))
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqllite'))
 
 
     def _get_index(self, record):
@@ -115,11 +113,8 @@ https://catalog.ldc.upenn.edu/LDC2008T19"""
                 needs_collection.append(self._init_build_qrels(qrels_file, is_heldout))
 
         if needs_collection and self._confirm_dua():
-            with contextlib.ExitStack() as stack:
-                collection_iter = logger.pbar(self._init_iter_corpus(), desc='collection')
-                sub_iters = util.blocking_tee(collection_iter, len(needs_collection))
-                for fn, it in zip(needs_collection, sub_iters):
-                    stack.enter_context(util.CtxtThread(functools.partial(fn, it)))
+            collection_iter = logger.pbar(self._init_iter_corpus(), desc='collection')
+            util.fan_out(collection_iter, needs_collection, logger=logger)
 
     def _init_iter_corpus(self):
         nyt_corpus_dir = os.path.join(util.path_dataset(self), 'nyt_corpus')
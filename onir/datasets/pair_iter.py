@@ -14,7 +14,9 @@ def pair_iter(dataset,
               unjudged_rel: int = 0,
               num_neg: int = 1,
               random=None,
-              inf: bool = False
+              inf: bool = False,
+              engine: str = 'pandas', # one of ['pandas', 'numpy']
+              sampler_state=None, # SamplerState, tracks the position of the sampler (pandas engine only)
              ):
     qrels_fn = util.Lazy(lambda: dataset.qrels(fmt='df'))
     run_fn = util.Lazy(lambda: dataset.run(fmt='df'))
@@ -30,14 +32,33 @@ def pair_iter(dataset,
         'qrels': pair_iter_neg_candidates_qrels,
         'union': pair_iter_neg_candidates_union,
     }[neg_source](dataset, qrels_fn, run_fn, unjudged_rel)
+    assert len(neg_candidates.index) > 0
+
+    if engine == 'pandas':
+        pairs = pair_iter_sample_pandas(dataset, pos_candidates, neg_candidates, sampling, num_neg, random, inf, sampler_state)
+    elif engine == 'numpy':
+        if sampler_state is not None:
+            dataset.logger.debug('the numpy sampler engine does not track sampler state; resuming will fast-forward')
+        pairs = pair_iter_sample_numpy(dataset, pos_candidates, neg_candidates, sampling, num_neg, random, inf)
+    else:
+        raise ValueError(f'unsupported engine {engine}')
+
+    for qid, dids in pairs:
+        result = {f: [] for f in fields}
+        for record in dataset.build_records(fields, [(qid, did) for did in dids]):
+            for f in fields:
+                result[f].append(record[f])
+        yield result
+
+
+def pair_iter_sample_pandas(dataset, pos_candidates, neg_candidates, sampling, num_neg, random, inf, sampler_state=None):
     neg_candidates = neg_candidates.set_index('qid')
     neg_candidates.sort_index(inplace=True)
-    assert len(neg_candidates.index) > 0
 
     pos_iter = {
         'query': pair_iter_sample_by_query,
         'qrel': pair_iter_sample_by_qrel
-    }[sampling](dataset, pos_candidates, random, inf)
+    }[sampling](dataset, pos_candidates, random, inf, sampler_state=sampler_state)
 
     for qid, pos_did, score in pos_iter:
         negs = pair_iter_filter_neg(dataset, neg_candidates, qid, pos_did, score)
@@ -49,25 +70,109 @@ def pair_iter(dataset,
         negs = negs['did'].sample(n=num_neg, random_state=random)
         for did in negs:
             dids.append(did)
+        if sampler_state is not None:
+            sampler_state.record()
+        yield qid, dids
+
+
+PAIR_SAMPLE_BLOCK = 4096
+
+
+def pair_iter_sample_numpy(dataset, pos_candidates, neg_candidates, sampling, num_neg, random, inf):
+    """
+    Vectorized alternative to pair_iter_sample_pandas. Candidates are compiled once into
+    integer-interned CSR arrays (by query), and positives/negatives are drawn in blocks of
+    PAIR_SAMPLE_BLOCK using vectorized calls to random.
+    """
+    with dataset.logger.duration('compiling pair sampler'):
+        pos_count = len(pos_candidates.index)
+        qids, q_codes = np.unique(np.concatenate([pos_candidates['qid'].values, neg_candidates['qid'].values]).astype(str), return_inverse=True)
+        dids, d_codes = np.unique(np.concatenate([pos_candidates['did'].values, neg_candidates['did'].values]).astype(str), return_inverse=True)
+        # intern scores as levels, such that the comparison score(neg) < score(pos) can be done on
+        # (query, level) keys
+        levels, l_codes = np.unique(np.concatenate([pos_candidates['score'].values, neg_candidates['score'].values]).astype(np.float64), return_inverse=True)
+        q_codes, d_codes, l_codes = q_codes.astype(np.int64), d_codes.astype(np.int64), l_codes.astype(np.int64)
+
+        # negatives, by query then by score level
+        neg_q, neg_d, neg_l = q_codes[pos_count:], d_codes[pos_count:], l_codes[pos_count:]
+        order = np.lexsort((neg_d, neg_l, neg_q))
+        neg_q, neg_d, neg_l = neg_q[order], neg_d[order], neg_l[order]
+        neg_offsets = np.searchsorted(neg_q, np.arange(len(qids) + 1))
+        neg_keys = neg_q * len(levels) + neg_l
+
+        # positives, by query
+        pos_q, pos_d, pos_l = q_codes[:pos_count], d_codes[:pos_count], l_codes[:pos_count]
+        order = np.lexsort((pos_d, pos_q))
+        pos_q, pos_d, pos_l = pos_q[order], pos_d[order], pos_l[order]
+        pos_offsets = np.searchsorted(pos_q, np.arange(len(qids) + 1))
+        pos_qids = np.unique(pos_q)
+
+        # the negatives of a positive are the prefix of its query's negatives with a lower score
+        pos_neg_start = neg_offsets[pos_q]
+        pos_neg_count = np.searchsorted(neg_keys, pos_q * len(levels) + pos_l, side='left') - pos_neg_start
+
+    for block in _pair_iter_pos_blocks(pos_qids, pos_offsets, sampling, random, inf):
+        counts = pos_neg_count[block]
+        has_negs = counts >= num_neg
+        if not has_negs.all():
+            # not enough negative documents for these positive samples
+            dataset.logger.debug(f'not enough negs ({(~has_negs).sum()} samples)')
+            block, counts = block[has_negs], counts[has_negs]
+        if len(block) == 0:
+            continue
+        negs = _sample_without_replacement(counts, num_neg, random) + pos_neg_start[block].reshape(-1, 1)
+        for pos, neg in zip(block, negs):
+            yield qids[pos_q[pos]], [dids[pos_d[pos]]] + [dids[n] for n in neg_d[neg]]
 
-        result = {f: [] for f in fields}
-        for did in dids:
-            record = dataset.build_record(fields, query_id=qid, doc_id=did)
-            for f in fields:
-                result[f].append(record[f])
-        yield result
+
+def _pair_iter_pos_blocks(pos_qids, pos_offsets, sampling, random, inf):
+    first = True
+    while first or inf:
+        first = False
+        if sampling == 'query':
+            seq = random.permutation(len(pos_qids))
+            for i in range(0, len(seq), PAIR_SAMPLE_BLOCK):
+                q = pos_qids[seq[i:i+PAIR_SAMPLE_BLOCK]]
+                yield pos_offsets[q] + random.randint(0, pos_offsets[q+1] - pos_offsets[q])
+        elif sampling == 'qrel':
+            if inf:
+                while True:
+                    yield random.randint(0, pos_offsets[-1], size=PAIR_SAMPLE_BLOCK)
+            seq = random.permutation(pos_offsets[-1])
+            for i in range(0, len(seq), PAIR_SAMPLE_BLOCK):
+                yield seq[i:i+PAIR_SAMPLE_BLOCK]
+        else:
+            raise ValueError(f'unsupported sampling {sampling}')
+
+
+def _sample_without_replacement(counts, k, random):
+    # Draws k distinct values from range(count) for each item in counts. Each draw j is made over
+    # the count-j remaining values and then shifted past the values drawn so far.
+    result = np.empty((len(counts), k), dtype=np.int64)
+    for j in range(k):
+        value = random.randint(0, counts - j)
+        drawn = np.sort(result[:, :j], axis=1)
+        for t in range(j):
+            value += (value >= drawn[:, t])
+        result[:, j] = value
+    return result
 
 
 @util.allow_redefinition_iter
-def pair_iter_sample_by_query(dataset, candidates, random, inf):
+def pair_iter_sample_by_query(dataset, candidates, random, inf, sampler_state=None):
     first = True
     candidates = candidates.set_index('qid')
     candidates.sort_index(inplace=True)
     qids = candidates.index.unique()
     while inf or first:
         first = False
+        if sampler_state is not None:
+            sampler_state.begin_pass()
         seq = random.permutation(len(qids))
-        for i in seq:
+        skip = sampler_state.resume_cursor() if sampler_state is not None else 0
+        for i in seq[skip:]:
+            if sampler_state is not None:
+                sampler_state.advance()
             qid = qids[i]
             samples = candidates.loc[qid:qid]
             samples = samples.sample(n=1, random_state=random)
@@ -76,14 +181,23 @@ def pair_iter_sample_by_query(dataset, candidates, random, inf):
 
 
 @util.allow_redefinition_iter
-def pair_iter_sample_by_qrel(dataset, candidates, random, inf):
+def pair_iter_sample_by_qrel(dataset, candidates, random, inf, sampler_state=None):
+    if sampler_state is not None:
+        sampler_state.begin_pass()
     if inf:
+        if sampler_state is not None:
+            sampler_state.resume_cursor() # samples are independent; only the random state matters
         while True:
+            if sampler_state is not None:
+                sampler_state.advance()
             sample = candidates.sample(n=1, random_state=random).iloc[0]
             yield sample['qid'], sample['did'], sample['score']
     else:
         samples = candidates.sample(frac=1., random_state=random)
-        for _, sample in samples.iterrows():
+        skip = sampler_state.resume_cursor() if sampler_state is not None else 0
+        for _, sample in samples.iloc[skip:].iterrows():
+            if sampler_state is not None:
+                sampler_state.advance()
             yield sample['qid'], sample['did'], sample['score']
 
 
@@ -66,7 +66,8 @@ class RandomDataset(datasets.Dataset):
                     minrel: None, # integer indicating the minimum relevance score, or None for unfiltered
                     shuf: bool = True,
                     random=None,
-                    inf: bool = False):
+                    inf: bool = False,
+                    sampler_state=None):
         self.logger.warn(f'source={source} minrel={minrel} and shuf={shuf} do not apply to RandomDataset')
         first = True
         while first or inf:
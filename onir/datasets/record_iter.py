@@ -2,6 +2,8 @@ import pandas as pd
 from onir import util
 
 
+RECORD_BATCH = 64
+
 @util.allow_redefinition_iter
 def record_iter(dataset,
                 fields: set,
@@ -10,7 +12,8 @@ def record_iter(dataset,
                 run_threshold: int = 0, # integer representing cutoff rank threshold (if > 0)
                 shuf: bool = True,
                 random=None,
-                inf: bool = False
+                inf: bool = False,
+                sampler_state=None, # SamplerState, tracks the position of the sampler
                ):
     run_fn = util.Lazy(lambda: dataset.run('df'))
     qrels_fn = util.Lazy(lambda: dataset.qrels('df'))
@@ -35,11 +38,18 @@ def record_iter(dataset,
         raise ValueError(f'unsupported source {source}')
     src = src.filter(items=['qid', 'did'])
 
-    it = record_iter_sample(dataset, src, shuf, random, inf)
+    it = record_iter_sample(dataset, src, shuf, random, inf, sampler_state=sampler_state)
 
-    for qid, did in it:
-        record = dataset.build_record(fields, query_id=qid, doc_id=did)
-        yield {f: record[f] for f in fields}
+    # records are built in batches so that the dataset can fetch documents in bulk
+    for chunk in util.chunked(it, RECORD_BATCH):
+        chunk_fields = set(fields)
+        records = dataset.build_records(chunk_fields, chunk)
+        for i in range(len(chunk)):
+            if fields != chunk_fields:
+                # fields changed while iterating (e.g., during a fast-forward); rebuild the rest
+                chunk_fields = set(fields)
+                records[i:] = dataset.build_records(chunk_fields, chunk[i:])
+            yield {f: records[i][f] for f in chunk_fields}
 
 
 @util.allow_redefinition_iter
@@ -58,11 +68,23 @@ def pos_qrels_iter(dataset, fields, minrel=1, shuf=False, random=None, inf=False
 
 
 @util.allow_redefinition_iter
-def record_iter_sample(dataset, cand, shuf, random, inf=False):
+def record_iter_sample(dataset, cand, shuf, random, inf=False, sampler_state=None):
     first = True
     while first or inf:
         first = False
+        if sampler_state is not None:
+            sampler_state.begin_pass()
         if shuf:
             cand = cand.sample(frac=1., random_state=random)
-        for _, sample in cand.iterrows():
+        skip = 0
+        if sampler_state is not None:
+            # each pass shuffles the previous pass's order, so the order is part of the state
+            saved_order = sampler_state.order(cand.index.values)
+            if saved_order is not None:
+                cand = cand.loc[saved_order]
+            skip = sampler_state.resume_cursor()
+        for _, sample in cand.iloc[skip:].iterrows():
+            if sampler_state is not None:
+                sampler_state.advance()
+                sampler_state.record()
             yield sample['qid'], sample['did']
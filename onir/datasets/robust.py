@@ -52,7 +52,7 @@ https://trec.nist.gov/data/cd45/index.html"""
         base_path = util.path_dataset(self)
         self.index = indices.AnseriniIndex(os.path.join(base_path, 'anserini'), stemmer='none')
         self.index_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.porter'), stemmer='porter')
-        self.doc_store = indices.SqliteDocstore(os.path.join(base_path, 'docs.sqllite'))
+        self.doc_store = self._sqlite_docstore(os.path.join(base_path, 'docs.sqllite'))
 
     def _get_index(self, record):
         return self.index
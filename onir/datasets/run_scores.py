@@ -0,0 +1,124 @@
+import os
+import numpy as np
+from scipy.special import ndtr
+from onir.interfaces import trec
+
+
+RUN_SCORES_VERSION = 1
+KDE_GRID_POINTS = 128 # points at which each query's KDE CDF is tabulated
+KDE_GRID_MARGIN = 6. # extent of the grid beyond the scores of the query (in KDE bandwidths)
+
+
+class RunScores:
+    """
+    Per-query score statistics of a run, used for the rank, normscore, and kdescore fields.
+
+    All queries are processed in a single pass: documents are ranked by descending score (ties
+    broken by descending doc_id), and each query's min/max score and the CDF of a Gaussian KDE
+    (with Scott's bandwidth, as in scipy.stats.gaussian_kde) over its scores are computed. The CDF
+    is tabulated on a fixed grid per query and linearly interpolated when looked up.
+    """
+    def __init__(self, qids, dids, offsets, ranked_doc_codes, mins, maxs, kde_bounds, kde_cdf):
+        self.qids = qids
+        self.dids = dids
+        self.offsets = offsets
+        self.ranked_doc_codes = ranked_doc_codes
+        self.mins = mins
+        self.maxs = maxs
+        self.kde_bounds = kde_bounds
+        self.kde_cdf = kde_cdf
+        self._qid_index = {qid: i for i, qid in enumerate(qids)}
+        self._ranks = {}
+
+    @classmethod
+    def build(cls, run):
+        """
+        Computes the statistics from a run (as returned by trec.read_run_arrays).
+        """
+        qids, dids = run['qids'], run['dids']
+        q_codes, d_codes, scores = run['qid_codes'], run['doc_codes'], run['scores']
+        did_order = np.empty(len(dids), dtype=np.int64)
+        did_order[np.argsort(np.array(dids, dtype=object))] = np.arange(len(dids))
+        # group by query, then descending score, then descending doc_id
+        order = np.lexsort((-did_order[d_codes], -scores, q_codes))
+        scores = scores[order]
+        offsets = np.zeros(len(qids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(q_codes, minlength=len(qids)), out=offsets[1:])
+        kde_bounds = np.zeros((len(qids), 2))
+        kde_cdf = np.zeros((len(qids), KDE_GRID_POINTS), dtype=np.float32)
+        for i in range(len(qids)):
+            kde_bounds[i], kde_cdf[i] = _tabulate_kde_cdf(scores[offsets[i]:offsets[i+1]])
+        # scores are in descending order within each query
+        maxs, mins = scores[offsets[:-1]], scores[offsets[1:] - 1]
+        return cls(qids, dids, offsets, d_codes[order].astype(np.int32), mins, maxs, kde_bounds, kde_cdf)
+
+    @classmethod
+    def load_or_build(cls, run_path, logger):
+        """
+        Loads the statistics of the run at run_path from run_path + '.scores.npz', or builds (and
+        saves) them if the file is missing or the run changed.
+        """
+        path = f'{run_path}.scores.npz'
+        stat = _file_stat(run_path)
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as data:
+                if np.array_equal(data['stat'], stat):
+                    return cls(data['qids'].tolist(), data['dids'].tolist(),
+                               *(data[key] for key in ('offsets', 'ranked_doc_codes', 'mins', 'maxs', 'kde_bounds', 'kde_cdf')))
+        with logger.duration(f'computing run score statistics for {run_path}'):
+            result = cls.build(trec.read_run_arrays(run_path, cache=True))
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f,
+                     stat=stat,
+                     qids=np.array(result.qids, dtype=str),
+                     dids=np.array(result.dids, dtype=str),
+                     offsets=result.offsets,
+                     ranked_doc_codes=result.ranked_doc_codes,
+                     mins=result.mins,
+                     maxs=result.maxs,
+                     kde_bounds=result.kde_bounds,
+                     kde_cdf=result.kde_cdf)
+        os.replace(f'{path}.tmp', path)
+        return result
+
+    def rank(self, qid, did, default=1000):
+        if qid not in self._ranks:
+            i = self._qid_index[qid]
+            codes = self.ranked_doc_codes[self.offsets[i]:self.offsets[i+1]].tolist()
+            # reversed, so the first (best) rank is kept for duplicate documents
+            self._ranks[qid] = {self.dids[c]: rank for rank, c in reversed(list(enumerate(codes, start=1)))}
+        return self._ranks[qid].get(did, default)
+
+    def normscore(self, qid, score):
+        i = self._qid_index[qid]
+        mn, mx = float(self.mins[i]), float(self.maxs[i])
+        return (score - mn) / (mx - mn)
+
+    def kdescore(self, qid, score):
+        i = self._qid_index[qid]
+        low, high = self.kde_bounds[i]
+        cdf = self.kde_cdf[i]
+        pos = (score - low) / (high - low) * (KDE_GRID_POINTS - 1)
+        if pos <= 0:
+            return float(cdf[0])
+        if pos >= KDE_GRID_POINTS - 1:
+            return float(cdf[-1])
+        j = int(pos)
+        return float(cdf[j] + (cdf[j+1] - cdf[j]) * (pos - j))
+
+
+def _tabulate_kde_cdf(scores):
+    bandwidth = np.std(scores, ddof=1) * len(scores) ** (-1 / 5) if len(scores) > 1 else 0.
+    if not bandwidth > 0:
+        # degenerate distribution (single score); approximate with a step function at the score
+        grid = np.linspace(scores[0] - 1., scores[0] + 1., KDE_GRID_POINTS)
+        return (grid[0], grid[-1]), (grid >= scores[0]).astype(np.float32)
+    low, high = scores.min() - KDE_GRID_MARGIN * bandwidth, scores.max() + KDE_GRID_MARGIN * bandwidth
+    grid = np.linspace(low, high, KDE_GRID_POINTS)
+    cdf = ndtr((grid[:, None] - scores[None, :]) / bandwidth).mean(axis=1)
+    return (low, high), cdf
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return np.array([RUN_SCORES_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
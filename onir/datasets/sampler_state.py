@@ -0,0 +1,104 @@
+class SamplerState:
+    """
+    Tracks the position of a training sampler (record_iter_sample, pair_iter_sample_by_query, or
+    pair_iter_sample_by_qrel) so that it can be saved and later restored without replaying the
+    sampler.
+
+    The position consists of the pass counter, the cursor within the current pass, the state of
+    random at the start of the pass (from which the pass's permutation is re-drawn), and the state
+    of random after the last record. A snapshot is kept every checkpoint_every records, since the
+    consumer of the records (e.g., a background batching thread) may run ahead of the trainer.
+    """
+    def __init__(self, random, checkpoint_every=None):
+        self.random = random
+        self.checkpoint_every = checkpoint_every
+        self.count = 0 # number of records yielded
+        self.pass_idx = -1
+        self.pass_random_state = None
+        self.pass_order = None
+        self.cursor = 0
+        self.checkpoints = {}
+        self._resume = None
+
+    def begin_pass(self):
+        """
+        Called by the sampler at the start of each pass, before random is used for the pass.
+        """
+        if self._resume is not None and self._resume['pass_random_state'] is None:
+            # saved before the first pass started; it starts from the saved random state
+            self.random.set_state(self._resume['random_state'])
+            self._resume = None
+        if self._resume is not None:
+            self.pass_idx = self._resume['pass']
+            self.pass_random_state = self._resume['pass_random_state']
+            self.random.set_state(self.pass_random_state)
+        else:
+            self.pass_idx += 1
+            self.pass_random_state = self.random.get_state()
+        self.cursor = 0
+        self.pass_order = None
+
+    def order(self, order):
+        """
+        Called by samplers whose order in a pass depends on previous passes (e.g., a shuffle of the
+        previous pass's order) with the order of the current pass, which is saved as part of the
+        state. When resuming, returns the saved order (otherwise None).
+        """
+        if self._resume is not None and self._resume['pass_order'] is not None:
+            self.pass_order = self._resume['pass_order']
+            return self.pass_order
+        self.pass_order = order
+        return None
+
+    def resume_cursor(self):
+        """
+        Called by the sampler once the pass's permutation is drawn. Returns the number of items of
+        the pass to skip (non-zero only when resuming).
+        """
+        if self._resume is None:
+            return 0
+        self.random.set_state(self._resume['random_state'])
+        self.cursor = self._resume['cursor']
+        self._resume = None
+        return self.cursor
+
+    def advance(self):
+        """
+        Called by the sampler for each item it draws from the current pass.
+        """
+        self.cursor += 1
+
+    def record(self):
+        """
+        Called when a record is yielded (after all random draws for the record are made).
+        """
+        self.count += 1
+        if self.checkpoint_every and self.count % self.checkpoint_every == 0:
+            self.checkpoints[self.count] = self.state_dict()
+
+    def state_dict(self):
+        return {
+            'count': self.count,
+            'pass': self.pass_idx,
+            'cursor': self.cursor,
+            'pass_random_state': self.pass_random_state,
+            'pass_order': self.pass_order,
+            'random_state': self.random.get_state(),
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restores the state. Must be called before the sampler starts.
+        """
+        self.count = state['count']
+        self._resume = state
+
+    def pop_checkpoint(self, count):
+        """
+        Returns (and discards) the snapshot taken after count records (along with any earlier
+        snapshots), or None if the sampler did not take one (e.g., it does not track its state).
+        """
+        result = self.checkpoints.get(count)
+        for key in [k for k in self.checkpoints if k <= count]:
+            del self.checkpoints[key]
+        return result
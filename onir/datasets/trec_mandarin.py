@@ -34,7 +34,7 @@ https://trec.nist.gov/data/testq_noneng.html"""
     def __init__(self, config, vocab, logger):
         super().__init__(config, logger, vocab)
         self.index_mandarin = indices.AnseriniIndex(os.path.join(util.path_dataset(self), 'anserini.zh'), lang=self._lang())
-        self.doc_store = indices.SqliteDocstore(os.path.join(util.path_dataset(self), 'docs.sqlite'))
+        self.doc_store = self._sqlite_docstore(os.path.join(util.path_dataset(self), 'docs.sqlite'))
 
     def _get_docstore(self):
         return self.doc_store
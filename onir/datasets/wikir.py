@@ -38,12 +38,12 @@ https://github.com/getalp/wikIR"""
     def __init__(self, config, logger, vocab):
         super().__init__(config, logger, vocab)
         base_path = util.path_dataset(self)
-        self.index1k = indices.AnseriniIndex(os.path.join(base_path, 'anserini.1k'), stemmer='none')
-        self.index1k_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.1k.porter'), stemmer='porter')
-        self.index59k = indices.AnseriniIndex(os.path.join(base_path, 'anserini.59k'), stemmer='none')
-        self.index59k_stem = indices.AnseriniIndex(os.path.join(base_path, 'anserini.59k.porter'), stemmer='porter')
-        self.docstore1k = indices.SqliteDocstore(os.path.join(base_path, 'docs.1k.sqllite'))
-        self.docstore59k = indices.SqliteDocstore(os.path.join(base_path, 'docs.59k.sqllite'))
+        self.index1k = self._lexical_index(os.path.join(base_path, 'anserini.1k'), stemmer='none')
+        self.index1k_stem = self._lexical_index(os.path.join(base_path, 'anserini.1k.porter'), stemmer='porter')
+        self.index59k = self._lexical_index(os.path.join(base_path, 'anserini.59k'), stemmer='none')
+        self.index59k_stem = self._lexical_index(os.path.join(base_path, 'anserini.59k.porter'), stemmer='porter')
+        self.docstore1k = self._sqlite_docstore(os.path.join(base_path, 'docs.1k.sqllite'))
+        self.docstore59k = self._sqlite_docstore(os.path.join(base_path, 'docs.59k.sqllite'))
 
     def _get_index(self, record):
         if self.config['collection'] == '1k':
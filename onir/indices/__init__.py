@@ -4,3 +4,9 @@ from onir.indices.anserini import AnseriniIndex
 from onir.indices.sqlite import SqliteDocstore
 from onir.indices.multifield_anserini import MultifieldAnseriniIndex
 from onir.indices.multifield_sqlite import MultifieldSqliteDocstore
+from onir.indices.tokenized import TokenizedDocstore
+from onir.indices.lexicon import Lexicon, CollectionStats
+from onir.indices.docid_map import DocidMap
+from onir.indices.json_feeder import JsonFeeder
+from onir.indices import scoring, analysis
+from onir.indices.inverted import InvertedIndex
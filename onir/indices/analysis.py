@@ -0,0 +1,243 @@
+import re
+from functools import lru_cache
+
+
+# org.apache.lucene.analysis.en.EnglishAnalyzer.ENGLISH_STOP_WORDS_SET
+ENGLISH_STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it',
+    'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there', 'these',
+    'they', 'this', 'to', 'was', 'will', 'with',
+])
+
+
+# Approximation of the UAX#29 word boundaries used by Lucene's StandardTokenizer: runs of word
+# characters, joined by apostrophes, periods, and colons (e.g., don't, U.S.A) and by commas and
+# semicolons between digits (e.g., 1,000).
+TOKEN_RE = re.compile(r"\w+(?:(?:['’.:]|(?<=\d)[,;](?=\d))\w+)*")
+
+
+class Analyzer:
+    """
+    Python counterpart of the analyzers that AnseriniIndex uses: StandardTokenizer, then (when
+    stemming) English possessive removal, lowercasing, optional stop word removal, and (when
+    stemming) the Porter stemmer.
+
+    With stemmer=None, this matches Lucene's StandardAnalyzer without stop words (used for
+    tokenize and term2idf_unstemmed).
+    """
+    def __init__(self, stemmer='porter', keep_stops=True):
+        if stemmer not in ('porter', 'none', None):
+            raise ValueError(f'unsupported stemmer {stemmer}')
+        self.stemmer = stemmer
+        self.keep_stops = keep_stops
+
+    def __call__(self, text):
+        tokens = TOKEN_RE.findall(text)
+        if self.stemmer is not None:
+            # EnglishPossessiveFilter
+            tokens = [t[:-2] if t[-2:] in ("'s", "'S", "’s", "’S") else t for t in tokens]
+        tokens = [t.lower() for t in tokens]
+        if not self.keep_stops:
+            tokens = [t for t in tokens if t not in ENGLISH_STOP_WORDS]
+        if self.stemmer == 'porter':
+            tokens = [porter_stem(t) for t in tokens]
+        return [t for t in tokens if t]
+
+
+@lru_cache(maxsize=2**18)
+def porter_stem(word):
+    """
+    The Porter stemming algorithm, as implemented by Lucene's PorterStemmer (which follows the
+    original paper, without the later departures of the reference implementation). word should
+    already be lowercased.
+    """
+    if len(word) <= 2:
+        return word
+    stemmer = _PorterStemmer(word)
+    stemmer.step1ab()
+    stemmer.step1c()
+    stemmer.step2()
+    stemmer.step3()
+    stemmer.step4()
+    stemmer.step5()
+    return ''.join(stemmer.b[:stemmer.k+1])
+
+
+class _PorterStemmer:
+    # direct port of Lucene's PorterStemmer: b is the word buffer, k the end of the current stem,
+    # and j the end of the stem before a suffix matched by ends
+    def __init__(self, word):
+        self.b = list(word)
+        self.k = len(word) - 1
+        self.j = 0
+
+    def cons(self, i):
+        ch = self.b[i]
+        if ch in 'aeiou':
+            return False
+        if ch == 'y':
+            return True if i == 0 else not self.cons(i - 1)
+        return True
+
+    def m(self):
+        # number of consonant sequences between 0 and j
+        n, i, j = 0, 0, self.j
+        while True:
+            if i > j:
+                return n
+            if not self.cons(i):
+                break
+            i += 1
+        i += 1
+        while True:
+            while True:
+                if i > j:
+                    return n
+                if self.cons(i):
+                    break
+                i += 1
+            i += 1
+            n += 1
+            while True:
+                if i > j:
+                    return n
+                if not self.cons(i):
+                    break
+                i += 1
+            i += 1
+
+    def vowelinstem(self):
+        return any(not self.cons(i) for i in range(self.j + 1))
+
+    def doublec(self, j):
+        return j >= 1 and self.b[j] == self.b[j-1] and self.cons(j)
+
+    def cvc(self, i):
+        if i < 2 or not self.cons(i) or self.cons(i - 1) or not self.cons(i - 2):
+            return False
+        return self.b[i] not in 'wxy'
+
+    def ends(self, s):
+        length = len(s)
+        if length > self.k + 1:
+            return False
+        if ''.join(self.b[self.k-length+1:self.k+1]) != s:
+            return False
+        self.j = self.k - length
+        return True
+
+    def setto(self, s):
+        self.b[self.j+1:] = list(s)
+        self.k = self.j + len(s)
+
+    def r(self, s):
+        if self.m() > 0:
+            self.setto(s)
+
+    def step1ab(self):
+        # plurals and -ed or -ing
+        if self.b[self.k] == 's':
+            if self.ends('sses'):
+                self.k -= 2
+            elif self.ends('ies'):
+                self.setto('i')
+            elif self.b[self.k-1] != 's':
+                self.k -= 1
+        if self.ends('eed'):
+            if self.m() > 0:
+                self.k -= 1
+        elif (self.ends('ed') or self.ends('ing')) and self.vowelinstem():
+            self.k = self.j
+            if self.ends('at'):
+                self.setto('ate')
+            elif self.ends('bl'):
+                self.setto('ble')
+            elif self.ends('iz'):
+                self.setto('ize')
+            elif self.doublec(self.k):
+                self.k -= 1
+                if self.b[self.k+1] in 'lsz':
+                    self.k += 1
+            elif self.m() == 1 and self.cvc(self.k):
+                self.setto('e')
+        del self.b[self.k+1:]
+
+    def step1c(self):
+        # y -> i when there is another vowel in the stem
+        if self.ends('y') and self.vowelinstem():
+            self.b[self.k] = 'i'
+
+    def step2(self):
+        # double suffixes -> single ones
+        if self.k == 0:
+            return
+        for suffix, replacement in _STEP2.get(self.b[self.k-1], ()):
+            if self.ends(suffix):
+                self.r(replacement)
+                break
+
+    def step3(self):
+        # -ic-, -full, -ness, etc.
+        for suffix, replacement in _STEP3.get(self.b[self.k], ()):
+            if self.ends(suffix):
+                self.r(replacement)
+                break
+
+    def step4(self):
+        # -ant, -ence, etc., in context <c>vcvc<v>
+        if self.k == 0:
+            return
+        for suffix in _STEP4.get(self.b[self.k-1], ()):
+            if self.ends(suffix):
+                if suffix == 'ion' and not (self.j >= 0 and self.b[self.j] in 'st'):
+                    continue
+                break
+        else:
+            return
+        if self.m() > 1:
+            self.k = self.j
+
+    def step5(self):
+        # remove a final -e and change -ll to -l if m() > 1
+        self.j = self.k
+        if self.b[self.k] == 'e':
+            a = self.m()
+            if a > 1 or a == 1 and not self.cvc(self.k - 1):
+                self.k -= 1
+        if self.b[self.k] == 'l' and self.doublec(self.k) and self.m() > 1:
+            self.k -= 1
+
+
+_STEP2 = {
+    'a': [('ational', 'ate'), ('tional', 'tion')],
+    'c': [('enci', 'ence'), ('anci', 'ance')],
+    'e': [('izer', 'ize')],
+    'l': [('abli', 'able'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous')],
+    'o': [('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')],
+    's': [('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous')],
+    't': [('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')],
+}
+
+
+_STEP3 = {
+    'e': [('icate', 'ic'), ('ative', ''), ('alize', 'al')],
+    'i': [('iciti', 'ic')],
+    'l': [('ical', 'ic'), ('ful', '')],
+    's': [('ness', '')],
+}
+
+
+_STEP4 = {
+    'a': ['al'],
+    'c': ['ance', 'ence'],
+    'e': ['er'],
+    'i': ['ic'],
+    'l': ['able', 'ible'],
+    'n': ['ant', 'ement', 'ment', 'ent'],
+    'o': ['ion', 'ou'],
+    's': ['ism'],
+    't': ['ate', 'iti'],
+    'u': ['ous'],
+    'v': ['ive'],
+    'z': ['ize'],
+}
@@ -3,21 +3,33 @@ import math
 import json
 import tempfile
 import itertools
-import time
 import re
 import shutil
 import threading
 import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from pytools import memoize_method
+import numpy as np
 import onir
 from onir.interfaces import trec
 from onir.interfaces.java import J
+from onir.indices.json_feeder import JsonFeeder
 from onir import indices
+from onir.indices.lexicon import Lexicon, CollectionStats
+from onir.indices.docid_map import DocidMap
+from onir.indices import scoring
 
 logger = onir.log.easy()
 
 
+SEARCH_CHUNK_SIZE = 32 # queries handed to a search thread at a time by iter_batch_query
+# defaults of SearchCollection (SearchArgs), which the in-process searchers also use
+SEARCH_STEMMER = 'porter'
+RM3_FB_TERMS, RM3_FB_DOCS, RM3_ORIGINAL_QUERY_WEIGHT = 10, 10, 0.5
+
+
 J.register(jars=["bin/lucene-backward-codecs-8.0.0.jar", "bin/anserini-0.8.0-fatjar.jar"], defs=dict(
     # [L]ucene
     L_FSDirectory='org.apache.lucene.store.FSDirectory',
@@ -77,6 +89,8 @@ class AnseriniIndex(indices.BaseIndex):
         self._path = path
         os.makedirs(path, exist_ok=True)
         self._settings_path = os.path.join(path, 'settings.json')
+        self._lexicon = Lexicon(os.path.join(path, 'lexicon'))
+        self._docid_map = DocidMap(os.path.join(path, 'docids'))
         if os.path.exists(self._settings_path):
             self._load_settings()
             assert self._settings['keep_stops'] == keep_stops
@@ -113,12 +127,25 @@ class AnseriniIndex(indices.BaseIndex):
         return self._settings['built']
 
     def num_docs(self):
+        if self._docid_map.built():
+            return self._docid_map.num_docs()
         return self._reader().numDocs()
 
     def docids(self):
-        index_utils = self._get_index_utils()
-        for i in range(self.num_docs()):
-            yield index_utils.convertLuceneDocidToDocid(i)
+        return self.docid_map().iter_dids()
+
+    def docid_map(self):
+        """
+        Mapping between external document ids and Lucene docids, exported from the index the first
+        time it is needed. Once exported, lookups do not cross JNI.
+        """
+        if not self._docid_map.built():
+            index_utils = self._get_index_utils()
+            self._docid_map.build(index_utils.convertLuceneDocidToDocid(i) for i in range(self._reader().maxDoc()))
+        return self._docid_map
+
+    def _lucene_docid(self, did):
+        return self.docid_map().idx(did)
 
     def get_raw(self, did):
         return self._get_index_utils().getRawDocument(did)
@@ -134,12 +161,38 @@ class AnseriniIndex(indices.BaseIndex):
     def _searcher(self):
         return J.L_IndexSearcher(self._reader().getContext())
 
+    def lexicon(self, analyze_terms=()):
+        """
+        Term and collection statistics of the index, exported from the index the first time they
+        are needed. Once exported, they are served without the JVM. The analyzed forms of the raw
+        analyze_terms (e.g., the query vocabulary) are stored in the lexicon as well.
+        """
+        if not self._lexicon.built():
+            cs = self._searcher().collectionStatistics(J.A_IndexArgs.CONTENTS)
+            stats = CollectionStats(
+                num_docs=self._reader().numDocs(),
+                doc_count=cs.docCount(),
+                sum_total_term_freq=cs.sumTotalTermFreq(),
+                sum_doc_freq=cs.sumDocFreq())
+            analyzed = {term: tuple(self._analyze_stemmed(term)) for term in set(analyze_terms)}
+            self._lexicon.build(self.iter_terms(), stats, analyzed)
+        elif analyze_terms:
+            self._lexicon.add_analyzed(analyze_terms, self._analyze_stemmed)
+        return self._lexicon
+
+    def precompute_analyzed(self, terms):
+        self.lexicon(analyze_terms=terms)
+
+    def _analyze_stemmed(self, term):
+        return J.A_AnalyzerUtils.analyze(self._get_stemmed_analyzer(), term).toArray()
+
     @memoize_method
     def term2idf(self, term):
-        term = J.A_AnalyzerUtils.analyze(self._get_stemmed_analyzer(), term).toArray()
+        lexicon = self.lexicon()
+        term = lexicon.analyze(term, self._analyze_stemmed)
         if term:
-            df = self._reader().docFreq(J.L_Term(J.A_IndexArgs.CONTENTS, term[0]))
-            return math.log((self._reader().numDocs() + 1) / (df + 1))
+            df = lexicon.df(term[0])
+            return math.log((lexicon.collection_stats().num_docs + 1) / (df + 1))
         return 0. # stop word; very common
 
     @memoize_method
@@ -150,14 +203,18 @@ class AnseriniIndex(indices.BaseIndex):
             return math.log((self._reader().numDocs() + 1) / (df + 1))
         return 0. # stop word; very common
 
-    @memoize_method
     def collection_stats(self):
-        return self._searcher().collectionStatistics(J.A_IndexArgs.CONTENTS)
+        return self.lexicon().collection_stats()
 
     def document_vector(self, did):
+        ldid = self._lucene_docid(did)
+        return self._document_vector(ldid)
+
+    def _document_vector(self, ldid):
         result = {}
-        ldid = self._get_index_utils().convertDocidToLuceneDocid(did)
         vec = self._reader().getTermVector(ldid, J.A_IndexArgs.CONTENTS)
+        if vec is None:
+            return result # no terms
         it = vec.iterator()
         while it.next():
             result[it.term().utf8ToString()] = it.totalTermFreq()
@@ -165,7 +222,7 @@ class AnseriniIndex(indices.BaseIndex):
 
     def avg_dl(self):
         cs = self.collection_stats()
-        return cs.sumTotalTermFreq() / cs.docCount()
+        return cs.sum_total_term_freq / cs.doc_count
 
     @memoize_method
     def _get_index_utils(self):
@@ -173,7 +230,7 @@ class AnseriniIndex(indices.BaseIndex):
 
     @lru_cache(maxsize=16)
     def get_doc(self, did):
-        ldid = self._get_index_utils().convertDocidToLuceneDocid(did)
+        ldid = self._lucene_docid(did)
         if ldid == -1:
             return ["a"] # hack -- missing doc
         return self._get_index_utils().getTransformedDocument(did) or ["a"]
@@ -234,7 +291,7 @@ class AnseriniIndex(indices.BaseIndex):
     def get_query_doc_scores(self, query, did, model, skip_invividual=False):
         sim = self._model(model)
         self._searcher().setSimilarity(sim)
-        ldid = self._get_index_utils().convertDocidToLuceneDocid(did)
+        ldid = self._lucene_docid(did)
         if ldid == -1:
             return -999. * len(query), [-999.] * len(query)
         analyzer = self._get_stemmed_analyzer()
@@ -251,10 +308,28 @@ class AnseriniIndex(indices.BaseIndex):
         explain = self._searcher().explain(lquery, ldid)
         return explain.getValue()
 
+    def batch_query_doc_scores(self, queries, run, model):
+        """
+        Computes the scores of get_query_doc_scores for all the pairs of run ({qid: [did, ...]}) at
+        once, from the documents' term vectors and the lexicon (see scoring.batch_query_doc_scores).
+        Returns a scoring.QueryDocScores, or None if the model is not supported.
+        """
+        params = scoring.parse_model(model)
+        if params is None:
+            return None
+        lexicon = self.lexicon()
+        docid_map = self.docid_map()
+        def doc_vector(did):
+            ldid = docid_map.idx(did)
+            return self._document_vector(ldid) if ldid != -1 else None
+        return scoring.batch_query_doc_scores(queries, run, params,
+                                              lambda term: lexicon.analyze(term, self._analyze_stemmed),
+                                              doc_vector, lexicon)
+
     def get_query_doc_scores_batch(self, query, dids, model):
         sim = self._model(model)
         self._searcher().setSimilarity(sim)
-        ldids = {self._get_index_utils().convertDocidToLuceneDocid(did): did for did in dids}
+        ldids = dict(zip(self.docid_map().idxs(dids).tolist(), dids))
         analyzer = self._get_stemmed_analyzer()
         query = J.A_AnalyzerUtils.analyze(analyzer, query).toArray()
         query = ' '.join(_anserini_escape(q, J) for q in query)
@@ -270,7 +345,7 @@ class AnseriniIndex(indices.BaseIndex):
 
     def build(self, doc_iter, replace=False, optimize=True, store_term_weights=False):
         with logger.duration(f'building {self._path}'), J.listen_java_log(_surpress_log('io.anserini.index.IndexCollection')):
-            thread_count = onir.util.safe_thread_count()
+            thread_count = max(onir.util.safe_thread_count(), 1)
             with tempfile.TemporaryDirectory() as d:
                 if self._settings['built']:
                     if replace:
@@ -278,11 +353,9 @@ class AnseriniIndex(indices.BaseIndex):
                         shutil.rmtree(self._path)
                     else:
                         logger.warn(f'adding to existing index: {self._path}')
-                fifos = []
-                for t in range(thread_count):
-                    fifo = os.path.join(d, f'{t}.json')
-                    os.mkfifo(fifo)
-                    fifos.append(fifo)
+                self._lexicon.remove() # statistics change with the index
+                self._docid_map.remove()
+                feeder = JsonFeeder(d, thread_count)
                 index_args = J.A_IndexArgs()
                 index_args.collectionClass = 'JsonCollection'
                 index_args.generatorClass = 'LuceneDocumentGenerator'
@@ -300,20 +373,8 @@ class AnseriniIndex(indices.BaseIndex):
                 indexer = J.A_IndexCollection(index_args)
                 thread = threading.Thread(target=indexer.run)
                 thread.start()
-                time.sleep(1) # give it some time to start up, otherwise fails due to race condition
-                for i, doc in enumerate(doc_iter):
-                    f = fifos[hash(i) % thread_count]
-                    if isinstance(f, str):
-                        f = open(f, 'wt')
-                        fifos[hash(i) % thread_count] = f
-                    json.dump({'id': doc.did, 'contents': doc.data[self._settings['field']]}, f)
-                    f.write('\n')
-                for f in fifos:
-                    if not isinstance(f, str):
-                        f.close()
-                    else:
-                        with open(f, 'wt'):
-                            pass # open and close to indicate file is done
+                field = self._settings['field']
+                feeder.feed(({'id': doc.did, 'contents': doc.data[field]} for doc in doc_iter), indexer_alive=thread.is_alive)
                 logger.debug('waiting to join')
                 thread.join()
                 self._settings['built'] = True
@@ -327,6 +388,8 @@ class AnseriniIndex(indices.BaseIndex):
                     shutil.rmtree(self._path)
                 else:
                     logger.warn(f'adding to existing index: {self._path}')
+            self._lexicon.remove() # statistics change with the index
+            self._docid_map.remove()
             thread_count = onir.util.safe_thread_count()
             index_args = J.A_IndexArgs()
             index_args.collectionClass = 'TrecCollection'
@@ -352,6 +415,75 @@ class AnseriniIndex(indices.BaseIndex):
         return self.batch_query([('0', query)], model, topk, destf=destf, quiet=quiet)['0']
 
     def batch_query(self, queries, model, topk, destf=None, quiet=False):
+        """
+        Runs queries ((qid, text) pairs) and writes the run to destf, or returns it as a dict if
+        destf is not provided. Models that a SimpleSearcher supports are searched in-process (see
+        iter_batch_query); others (e.g., sdm) go through SearchCollection.
+        """
+        if self._batch_searcher(model) is None:
+            return self._batch_query_collection(queries, model, topk, destf, quiet)
+        results = self.iter_batch_query(queries, model, topk, quiet=quiet)
+        if destf:
+            trec.write_run_queries(destf, results, runid='Anserini')
+        else:
+            return {qid: dict(zip(dids, scores.tolist())) for qid, dids, scores in results}
+
+    def batch_query_table(self, queries, model, topk, quiet=False):
+        """
+        Like batch_query, but returns the run as a trec.RunTable.
+        """
+        if self._batch_searcher(model) is None:
+            with tempfile.TemporaryDirectory() as run_d:
+                run_f = os.path.join(run_d, 'run')
+                self._batch_query_collection(queries, model, topk, run_f, quiet)
+                return trec.read_run_table(run_f)
+        return trec.RunTable.from_queries(self.iter_batch_query(queries, model, topk, quiet=quiet))
+
+    def iter_batch_query(self, queries, model, topk, quiet=False):
+        """
+        Runs queries ((qid, text) pairs) with the long-lived searcher of model (see _batch_searcher),
+        yielding (qid, dids, scores) for each query as results become available (in the order of
+        queries), where dids is a list in rank order and scores a float32 array. Chunks of
+        SEARCH_CHUNK_SIZE queries are searched by a pool of threads.
+        """
+        searcher = self._batch_searcher(model)
+        if searcher is None:
+            raise ValueError(f'model {model} cannot be searched in-process')
+        thread_count = max(onir.util.safe_thread_count(), 1)
+        def search_chunk(chunk):
+            from jnius import detach
+            try:
+                result = []
+                for qid, text in chunk:
+                    hits = searcher.search(text, topk)
+                    result.append((qid, [hit.docid for hit in hits], np.array([hit.score for hit in hits], dtype=np.float32)))
+                return result
+            finally:
+                # pool threads are not known to the JVM; release them after each chunk
+                detach()
+        total = len(queries) if hasattr(queries, '__len__') else None
+        with contextlib.ExitStack() as stack:
+            pbar = None
+            if not quiet:
+                pbar = stack.enter_context(logger.pbar_raw(desc=f'batch_query ({model})', total=total))
+            pool = stack.enter_context(ThreadPoolExecutor(thread_count))
+            pending = deque()
+            for chunk in onir.util.chunked(queries, SEARCH_CHUNK_SIZE):
+                pending.append(pool.submit(search_chunk, chunk))
+                # bound the number of chunks in flight, so that results stream back in order
+                while len(pending) > thread_count * 2 or (pending and pending[0].done()):
+                    results = pending.popleft().result()
+                    if pbar is not None:
+                        pbar.update(len(results))
+                    yield from results
+            while pending:
+                results = pending.popleft().result()
+                if pbar is not None:
+                    pbar.update(len(results))
+                yield from results
+
+    def _batch_query_collection(self, queries, model, topk, destf=None, quiet=False):
+        # runs queries through SearchCollection, via temporary topic and run files
         THREADS = onir.util.safe_thread_count()
         query_file_splits = 1000
         if hasattr(queries, '__len__'):
@@ -469,24 +601,61 @@ class AnseriniIndex(indices.BaseIndex):
                 return trec.read_run_dict(run_f)
 
     @memoize_method
-    def simple_searcher(self, model):
-        result = J.A_SimpleSearcher(self._path)
-        if model.startswith('bm25'):
-            k1, b = 0.9, 0.4
-            model_args = [arg.split('-', 1) for arg in model.split('_')[1:]]
+    def _batch_searcher(self, model):
+        """
+        Returns a SimpleSearcher configured for model (bm25 with optional rm3, or ql), which is
+        kept for the lifetime of the index object and shared by all search threads. Returns None
+        for models that SimpleSearcher does not support (e.g., sdm, or languages other than en).
+        """
+        if self._settings['lang'] != 'en':
+            return None
+        name, *model_args = model.split('_')
+        model_args = [arg.split('-', 1) for arg in model_args]
+        if name == 'bm25':
+            k1, b, rm3, fb_terms, fb_docs = 0.9, 0.4, False, RM3_FB_TERMS, RM3_FB_DOCS
             for arg in model_args:
-                if len(arg) == 1:
-                    k, v = arg[0], None
-                elif len(arg) == 2:
-                    k, v = arg
+                k, v = arg if len(arg) == 2 else (arg[0], None)
                 if k == 'k1':
-                    k1 = v
+                    k1 = float(v)
                 elif k == 'b':
-                    b = v
+                    b = float(v)
+                elif k == 'rm3':
+                    rm3 = True
+                elif k == 'rm3.fbTerms':
+                    fb_terms = int(v)
+                elif k == 'rm3.fbDocs':
+                    fb_docs = int(v)
                 else:
                     raise ValueError(f'unknown bm25 parameter {arg}')
+            result = self._new_simple_searcher()
             result.setBM25Similarity(k1, b)
-        else:
+            if rm3:
+                result.setRM3Reranker(fb_terms, fb_docs, RM3_ORIGINAL_QUERY_WEIGHT)
+            return result
+        if name == 'ql':
+            mu = 1000.
+            for arg in model_args:
+                k, v = arg if len(arg) == 2 else (arg[0], None)
+                if k == 'mu':
+                    mu = float(v)
+                else:
+                    raise ValueError(f'unknown ql parameter {arg}')
+            result = self._new_simple_searcher()
+            result.setLMDirichletSimilarity(mu)
+            return result
+        if name == 'sdm':
+            return None
+        raise ValueError(f'unknown model {model}')
+
+    def _new_simple_searcher(self):
+        # SearchCollection is not given -stemmer or -keepstopwords by _batch_query_collection, so
+        # it analyzes queries with its default analyzer; the searcher is given the same one (rather
+        # than relying on SimpleSearcher's default matching it)
+        return J.A_SimpleSearcher(self._path, J.A_DefaultEnglishAnalyzer.newStemmingInstance(SEARCH_STEMMER))
+
+    def simple_searcher(self, model):
+        result = self._batch_searcher(model)
+        if result is None:
             raise ValueError(f'unsupported model {model}')
         return result
 
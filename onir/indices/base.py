@@ -1,4 +1,4 @@
-from typing import Iterator
+from typing import Iterable, Iterator, List
 from onir import indices
 
 
@@ -17,3 +17,11 @@ class BaseIndex:
 
     def get_raw(self, did: str) -> str:
         raise NotImplementedError
+
+    def get_raws(self, dids: List[str]) -> List[str]:
+        return [self.get_raw(did) for did in dids]
+
+    def precompute_analyzed(self, terms: Iterable[str]):
+        # indices that analyze terms outside of Python (e.g., in the JVM) can prepare the analyzed
+        # forms of known terms (e.g., the query vocabulary) ahead of term2idf
+        pass
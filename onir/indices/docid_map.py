@@ -0,0 +1,166 @@
+import os
+import json
+import shutil
+import numpy as np
+import onir
+
+
+DOCID_MAP_VERSION = 1
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+_logger = onir.log.easy()
+
+
+class DocidMap:
+    """
+    Mapping between the external document ids of an index and its internal (e.g., Lucene)
+    document numbers, exported once so that lookups do not need to go through the index (e.g., a
+    JNI call per document for an Anserini index).
+
+    The external ids are stored in internal id order as a single UTF-8 byte array (dids.bin) with
+    the start offset of each id (offsets.npy), so the id of internal document i is a slice. The
+    reverse mapping is a hash index: the 64-bit FNV-1a hash of each id in sorted order
+    (hashes.npy), alongside the internal id of each hash (hash_order.npy). All arrays are
+    memory-mapped read-only.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._arrays = None
+
+    def path(self):
+        return self._path
+
+    def built(self):
+        return os.path.exists(os.path.join(self._path, 'meta.json'))
+
+    def build(self, dids):
+        """
+        Writes the mapping from an iterator of the external ids of all documents, in internal id
+        order.
+        """
+        tmp_path = f'{self._path}.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with _logger.duration(f'building {self._path}'):
+            encoded = [did.encode('utf8') for did in _logger.pbar(dids, desc='exporting docids')]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(did) for did in encoded], out=offsets[1:])
+            data = b''.join(encoded)
+            del encoded
+            with open(os.path.join(tmp_path, 'dids.bin'), 'wb') as f:
+                f.write(data)
+            hashes = _fnv1a(np.frombuffer(data, dtype=np.uint8), offsets)
+            order = np.argsort(hashes, kind='stable')
+            np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+            np.save(os.path.join(tmp_path, 'hashes.npy'), hashes[order])
+            np.save(os.path.join(tmp_path, 'hash_order.npy'), order.astype(np.int64))
+            # meta is written last; its presence indicates that the mapping is built
+            with open(os.path.join(tmp_path, 'meta.json'), 'wt') as f:
+                json.dump({'version': DOCID_MAP_VERSION, 'num_docs': len(offsets) - 1}, f)
+            if os.path.exists(self._path):
+                shutil.rmtree(self._path)
+            os.replace(tmp_path, self._path)
+        self._arrays = None
+
+    def remove(self):
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+        self._arrays = None
+
+    def _load(self):
+        if self._arrays is None:
+            with open(os.path.join(self._path, 'meta.json'), 'rt') as f:
+                meta = json.load(f)
+            if meta['version'] != DOCID_MAP_VERSION:
+                raise ValueError(f'unsupported docid map version {meta["version"]} at {self._path}')
+            offsets = np.load(os.path.join(self._path, 'offsets.npy'), mmap_mode='r')
+            if offsets[-1] > 0:
+                data = np.memmap(os.path.join(self._path, 'dids.bin'), dtype=np.uint8, mode='r')
+            else:
+                data = np.zeros(0, dtype=np.uint8) # empty files cannot be memory-mapped
+            self._arrays = {
+                'meta': meta,
+                'data': data,
+                'offsets': offsets,
+                'hashes': np.load(os.path.join(self._path, 'hashes.npy'), mmap_mode='r'),
+                'hash_order': np.load(os.path.join(self._path, 'hash_order.npy'), mmap_mode='r'),
+            }
+        return self._arrays
+
+    def num_docs(self):
+        return self._load()['meta']['num_docs']
+
+    def did(self, idx):
+        """
+        Returns the external id of internal document idx.
+        """
+        arrays = self._load()
+        data, offsets = arrays['data'], arrays['offsets']
+        return data[offsets[idx]:offsets[idx+1]].tobytes().decode('utf8')
+
+    def dids(self, start=0, stop=None):
+        """
+        Returns the external ids of internal documents start to stop (exclusive) as a list, decoded
+        from a single slice of the id data.
+        """
+        arrays = self._load()
+        data, offsets = arrays['data'], arrays['offsets']
+        offsets = np.asarray(offsets[start:(stop + 1 if stop is not None else None)])
+        if len(offsets) < 2:
+            return []
+        chunk = data[offsets[0]:offsets[-1]].tobytes()
+        bounds = (offsets - offsets[0]).tolist()
+        return [chunk[s:e].decode('utf8') for s, e in zip(bounds, bounds[1:])]
+
+    def iter_dids(self, chunk_size=100_000):
+        for start in range(0, self.num_docs(), chunk_size):
+            yield from self.dids(start, start + chunk_size)
+
+    def idx(self, did):
+        """
+        Returns the internal id of document did, or -1 if it is not present.
+        """
+        did = did.encode('utf8')
+        h = int(FNV_OFFSET)
+        for byte in did:
+            h = ((h ^ byte) * int(FNV_PRIME)) & 0xffffffffffffffff
+        return self._probe(did, h, int(np.searchsorted(self._load()['hashes'], np.uint64(h))))
+
+    def idxs(self, dids):
+        """
+        Returns the internal id of each of dids as an int64 array, with -1 for missing documents.
+        """
+        encoded = [did.encode('utf8') for did in dids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(did) for did in encoded], out=offsets[1:])
+        hashes = _fnv1a(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+        positions = np.searchsorted(self._load()['hashes'], hashes)
+        return np.array([self._probe(did, h, pos) for did, h, pos in zip(encoded, hashes.tolist(), positions.tolist())],
+                        dtype=np.int64).reshape(len(encoded))
+
+    def _probe(self, did, h, pos):
+        # scans the entries with hash h from position pos of the hash index (more than one only on
+        # collisions) for did (encoded)
+        arrays = self._load()
+        data, offsets, hashes, hash_order = arrays['data'], arrays['offsets'], arrays['hashes'], arrays['hash_order']
+        while pos < len(hashes) and hashes[pos] == h:
+            idx = int(hash_order[pos])
+            if data[offsets[idx]:offsets[idx+1]].tobytes() == did:
+                return idx
+            pos += 1
+        return -1
+
+
+def _fnv1a(data, offsets):
+    # 64-bit FNV-1a hash of each string data[offsets[i]:offsets[i+1]] (a byte array), computed one
+    # byte position at a time across all strings
+    lens = np.diff(offsets)
+    hashes = np.full(len(lens), FNV_OFFSET, dtype=np.uint64)
+    starts = offsets[:-1]
+    for pos in range(int(lens.max()) if len(lens) else 0):
+        mask = lens > pos
+        hashes[mask] = (hashes[mask] ^ data[starts[mask] + pos].astype(np.uint64)) * FNV_PRIME
+    return hashes
@@ -0,0 +1,359 @@
+import os
+import json
+import math
+import shutil
+from array import array
+from collections import Counter, defaultdict
+import numpy as np
+import onir
+from onir import indices, util
+from onir.interfaces import trec
+from onir.indices import scoring
+from onir.indices.analysis import Analyzer
+from onir.indices.lexicon import Lexicon, CollectionStats
+
+
+ACCUMULATOR_CELLS = 2 ** 24 # maximum size of the (queries x documents) score accumulators in batch_query
+
+
+_logger = onir.log.easy()
+
+
+class InvertedIndex(indices.BaseIndex):
+    """
+    Inverted index implemented with NumPy, as an alternative to AnseriniIndex that does not need
+    the JVM. It supports the same operations and settings (the analyzers in indices.analysis
+    follow Anserini's), but is built in memory, so it is meant for small and medium collections.
+
+    Postings are sorted by document, with the document gaps and term frequencies of each term
+    compressed with variable-byte encoding (postings.docs.bin and postings.tfs.bin, with the byte
+    offsets of each term in *.offsets.npy). The term dictionary and statistics are kept in a
+    Lexicon (term ids are positions in the lexicon), and the analyzed terms of each document in a
+    forward index (tokens.npy and doc_offsets.npy) for document vectors. All arrays are
+    memory-mapped read-only.
+
+    batch_query evaluates BM25 and QL term-at-a-time for batches of queries at once, accumulating
+    the scores of each term's postings into a (queries x documents) matrix.
+    """
+    def __init__(self, path, keep_stops=False, stemmer='porter', field='text', store_raw_docs=False, lang='en'):
+        if lang != 'en':
+            raise ValueError(f'unsupported language {lang}')
+        self._path = path
+        self._settings_path = os.path.join(path, 'settings.json')
+        self._settings = {
+            'keep_stops': keep_stops,
+            'stemmer': stemmer,
+            'field': field,
+            'built': False,
+            'store_raw_docs': store_raw_docs,
+            'lang': lang,
+        }
+        if os.path.exists(self._settings_path):
+            with open(self._settings_path, 'rt') as f:
+                settings = json.load(f)
+            for key in ('keep_stops', 'stemmer', 'field', 'store_raw_docs', 'lang'):
+                assert settings[key] == self._settings[key]
+            self._settings = settings
+        # the analyzer used for indexing and searching, and the one used by term2idf (which, as in
+        # AnseriniIndex, keeps stop words)
+        self._analyzer = Analyzer(stemmer, keep_stops=keep_stops)
+        self._term_analyzer = Analyzer(stemmer, keep_stops=True)
+        self._unstemmed_analyzer = Analyzer(None, keep_stops=True)
+        self._data = None
+        self._docstore = None
+
+    def path(self):
+        return self._path
+
+    def built(self):
+        if not os.path.exists(self._settings_path):
+            return False
+        with open(self._settings_path, 'rt') as f:
+            return json.load(f)['built']
+
+    def build(self, doc_iter, replace=False):
+        if self.built() and not replace:
+            _logger.warn(f'rebuilding index (adding to an existing index is not supported): {self._path}')
+        tmp_path = f'{self._path}.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with _logger.duration(f'building {self._path}'):
+            if self._settings['store_raw_docs']:
+                docstore = indices.SqliteDocstore(os.path.join(tmp_path, 'docs.sqlite'), field=self._settings['field'])
+                util.fan_out(doc_iter, [lambda docs: self._build_index(tmp_path, docs), docstore.build])
+            else:
+                self._build_index(tmp_path, doc_iter)
+            settings = dict(self._settings, built=True)
+            # settings are written last; their presence indicates that the index is built
+            with open(os.path.join(tmp_path, 'settings.json'), 'wt') as f:
+                json.dump(settings, f)
+            if os.path.exists(self._path):
+                shutil.rmtree(self._path)
+            os.replace(tmp_path, self._path)
+        self._settings = settings
+        self._data = None
+        self._docstore = None
+
+    def _build_index(self, path, doc_iter):
+        term_ids = {}
+        post_terms, post_docs, post_tfs = array('I'), array('I'), array('I')
+        tokens, doc_offsets = array('I'), array('q', [0])
+        with open(os.path.join(path, 'docids.txt'), 'wt') as f_dids:
+            for doc_idx, doc in enumerate(_logger.pbar(doc_iter, desc='indexing documents')):
+                ids = [term_ids.setdefault(t, len(term_ids)) for t in self._analyzer(doc.data[self._settings['field']])]
+                counts = Counter(ids)
+                post_terms.extend(counts.keys())
+                post_tfs.extend(counts.values())
+                post_docs.extend([doc_idx] * len(counts))
+                tokens.extend(ids)
+                doc_offsets.append(len(tokens))
+                f_dids.write(f'{doc.did}\n')
+        # term ids are the positions of the terms in the lexicon, which are sorted by UTF-8 encoding
+        terms = [t.encode('utf8') for t in term_ids]
+        order = np.array(sorted(range(len(terms)), key=terms.__getitem__), dtype=np.int64)
+        remap = np.empty(len(terms), dtype=np.int64)
+        remap[order] = np.arange(len(terms))
+        post_terms = remap[np.frombuffer(post_terms, dtype=np.uint32)] if post_terms else np.zeros(0, dtype=np.int64)
+        perm = np.argsort(post_terms, kind='stable') # documents stay in order within each term
+        post_terms = post_terms[perm]
+        post_docs = np.frombuffer(post_docs, dtype=np.uint32).astype(np.int64)[perm]
+        post_tfs = np.frombuffer(post_tfs, dtype=np.uint32).astype(np.int64)[perm]
+        dfs = np.bincount(post_terms, minlength=len(terms))
+        cfs = np.bincount(post_terms, weights=post_tfs, minlength=len(terms)).astype(np.int64)
+        term_starts = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(dfs, out=term_starts[1:])
+        gaps = post_docs.copy()
+        gaps[1:] -= post_docs[:-1]
+        gaps[term_starts[:-1][dfs > 0]] = post_docs[term_starts[:-1][dfs > 0]] # first posting of each term
+        for name, values in [('docs', gaps), ('tfs', post_tfs)]:
+            encoded, lens = _vbyte_encode(values)
+            with open(os.path.join(path, f'postings.{name}.bin'), 'wb') as f:
+                f.write(encoded.tobytes())
+            byte_offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(lens, out=byte_offsets[1:])
+            np.save(os.path.join(path, f'postings.{name}.offsets.npy'), byte_offsets[term_starts])
+        np.save(os.path.join(path, 'tokens.npy'), remap[np.frombuffer(tokens, dtype=np.uint32)].astype(np.int32) if tokens else np.zeros(0, dtype=np.int32))
+        doc_offsets = np.frombuffer(doc_offsets, dtype=np.int64)
+        np.save(os.path.join(path, 'doc_offsets.npy'), doc_offsets)
+        doc_lens = np.diff(doc_offsets)
+        stats = CollectionStats(
+            num_docs=len(doc_lens),
+            doc_count=int((doc_lens > 0).sum()),
+            sum_total_term_freq=int(doc_lens.sum()),
+            sum_doc_freq=len(post_docs))
+        sorted_terms = ({'term': terms[i].decode('utf8'), 'df': int(dfs[t]), 'cf': int(cfs[t])} for t, i in enumerate(order))
+        Lexicon(os.path.join(path, 'lexicon')).build(sorted_terms, stats)
+
+    def _load(self):
+        if self._data is None:
+            postings = {}
+            for name in ('docs', 'tfs'):
+                bin_path = os.path.join(self._path, f'postings.{name}.bin')
+                if os.path.getsize(bin_path) > 0:
+                    postings[name] = np.memmap(bin_path, dtype=np.uint8, mode='r')
+                else:
+                    postings[name] = np.zeros(0, dtype=np.uint8) # empty files cannot be memory-mapped
+                postings[f'{name}_offsets'] = np.load(os.path.join(self._path, f'postings.{name}.offsets.npy'), mmap_mode='r')
+            doc_offsets = np.load(os.path.join(self._path, 'doc_offsets.npy'), mmap_mode='r')
+            with open(os.path.join(self._path, 'docids.txt'), 'rt') as f:
+                dids = [did.rstrip('\n') for did in f]
+            did_rank = np.empty(len(dids), dtype=np.int64)
+            did_rank[np.argsort(np.array(dids, dtype=object))] = np.arange(len(dids))
+            lexicon = Lexicon(os.path.join(self._path, 'lexicon'))
+            self._data = {
+                'postings': postings,
+                'tokens': np.load(os.path.join(self._path, 'tokens.npy'), mmap_mode='r'),
+                'doc_offsets': doc_offsets,
+                'doc_lens': np.diff(doc_offsets),
+                'dids': dids,
+                'did2idx': {did: i for i, did in enumerate(dids)},
+                'did_rank': did_rank, # for breaking score ties by doc_id
+                'lexicon': lexicon,
+            }
+        return self._data
+
+    def _postings(self, term_id):
+        postings = self._load()['postings']
+        result = []
+        for name in ('docs', 'tfs'):
+            offsets = postings[f'{name}_offsets']
+            result.append(_vbyte_decode(postings[name][offsets[term_id]:offsets[term_id+1]]))
+        docs, tfs = result
+        return np.cumsum(docs), tfs
+
+    def lexicon(self):
+        return self._load()['lexicon']
+
+    def num_docs(self):
+        return len(self._load()['dids'])
+
+    def docids(self):
+        return iter(self._load()['dids'])
+
+    def get_raw(self, did):
+        if not self._settings['store_raw_docs']:
+            raise ValueError(f'raw documents are not stored in {self._path}')
+        return self._get_docstore().get_raw(did)
+
+    def _get_docstore(self):
+        # opened once (rather than per document)
+        if self._docstore is None:
+            self._docstore = indices.SqliteDocstore(os.path.join(self._path, 'docs.sqlite'), field=self._settings['field'])
+        return self._docstore
+
+    def term2idf(self, term):
+        term = self._term_analyzer(term)
+        if term:
+            df = self.lexicon().df(term[0])
+            return math.log((self.num_docs() + 1) / (df + 1))
+        return 0. # stop word; very common
+
+    def term2idf_unstemmed(self, term):
+        term = self._unstemmed_analyzer(term)
+        if len(term) == 1:
+            df = self.lexicon().df(term[0])
+            return math.log((self.num_docs() + 1) / (df + 1))
+        return 0. # stop word; very common
+
+    def collection_stats(self):
+        return self.lexicon().collection_stats()
+
+    def avg_dl(self):
+        cs = self.collection_stats()
+        return cs.sum_total_term_freq / cs.doc_count
+
+    def _doc_terms(self, did):
+        data = self._load()
+        idx = data['did2idx'].get(did)
+        if idx is None:
+            return None
+        ids = data['tokens'][data['doc_offsets'][idx]:data['doc_offsets'][idx+1]]
+        return [data['lexicon'].term(i) for i in ids]
+
+    def document_vector(self, did):
+        terms = self._doc_terms(did)
+        return dict(Counter(terms)) if terms is not None else None
+
+    def get_doc(self, did):
+        return self._doc_terms(did) or ["a"] # hack -- missing doc
+
+    def tokenize(self, text):
+        result = self._unstemmed_analyzer(text)
+        # split off contractions, as in AnseriniIndex
+        return [t for token in result for t in token.split("'")]
+
+    def iter_terms(self):
+        return self.lexicon().iter_terms()
+
+    def get_query_doc_scores(self, query, did, model, skip_invividual=False):
+        params = scoring.parse_model(model)
+        if params is None:
+            raise ValueError(f'unsupported model {model}')
+        vec = self.document_vector(did)
+        if vec is None:
+            return scoring.MISSING_DOC_SCORE * len(query), [scoring.MISSING_DOC_SCORE] * len(query)
+        lexicon = self.lexicon()
+        terms = [t for raw in query for t in self._term_analyzer(raw)]
+        tfs = np.array([[vec.get(t, 0) for t in terms]], dtype=np.float32)
+        scores = scoring.score_terms(params, tfs, [sum(vec.values())], [lexicon.df(t) for t in terms],
+                                     [lexicon.cf(t) for t in terms], lexicon.collection_stats())
+        result = [float(s) for s in scores[0]]
+        if skip_invividual:
+            return sum(result)
+        return sum(result), result
+
+    def batch_query_doc_scores(self, queries, run, model):
+        """
+        Computes the scores of get_query_doc_scores for all the pairs of run ({qid: [did, ...]}) at
+        once (see scoring.batch_query_doc_scores). Returns a scoring.QueryDocScores, or None if the
+        model is not supported.
+        """
+        params = scoring.parse_model(model)
+        if params is None:
+            return None
+        return scoring.batch_query_doc_scores(queries, run, params, self._term_analyzer, self.document_vector, self.lexicon())
+
+    def query(self, query, model, topk, destf=None, quiet=False):
+        return self.batch_query([('0', query)], model, topk, destf=destf, quiet=quiet)['0']
+
+    def batch_query(self, queries, model, topk, destf=None, quiet=False):
+        results = self.iter_batch_query(queries, model, topk, quiet=quiet)
+        if destf:
+            trec.write_run_queries(destf, results, runid='numpy')
+        else:
+            return {qid: dict(zip(dids, scores.tolist())) for qid, dids, scores in results}
+
+    def batch_query_table(self, queries, model, topk, quiet=False):
+        """
+        Like batch_query, but returns the run as a trec.RunTable.
+        """
+        return trec.RunTable.from_queries(self.iter_batch_query(queries, model, topk, quiet=quiet))
+
+    def iter_batch_query(self, queries, model, topk, quiet=False):
+        """
+        Runs queries ((qid, text) pairs), yielding (qid, dids, scores) for each query (in order),
+        where dids is a list in rank order and scores a float32 array.
+        """
+        params = scoring.parse_model(model)
+        if params is None:
+            raise ValueError(f'unsupported model {model}')
+        data = self._load()
+        lexicon = data['lexicon']
+        stats = lexicon.collection_stats()
+        doc_lens, dids, did_rank = data['doc_lens'], data['dids'], data['did_rank']
+        batch_size = max(1, ACCUMULATOR_CELLS // max(len(dids), 1))
+        queries = list(queries)
+        for batch in util.chunked(_logger.pbar(queries, desc=f'batch_query ({model})', quiet=quiet), batch_size):
+            # the rows (and the number of occurrences) of each term in the batch's queries
+            term_rows = defaultdict(list)
+            for row, (_, text) in enumerate(batch):
+                for term, count in Counter(self._analyzer(text)).items():
+                    term_id = lexicon.term_id(term)
+                    if term_id != -1:
+                        term_rows[term_id].append((row, count))
+            scores = np.zeros((len(batch), len(dids)), dtype=np.float32)
+            matched = np.zeros((len(batch), len(dids)), dtype=bool)
+            for term_id in sorted(term_rows):
+                docs, tfs = self._postings(term_id)
+                term_scores = scoring.score_terms(params, tfs[:, None], doc_lens[docs], lexicon.dfs()[term_id:term_id+1],
+                                                  lexicon.cfs()[term_id:term_id+1], stats)[:, 0]
+                rows, counts = (np.array(x) for x in zip(*term_rows[term_id]))
+                scores[rows[:, None], docs[None, :]] += counts[:, None].astype(np.float32) * term_scores[None, :]
+                matched[rows[:, None], docs[None, :]] = True
+            for row, (qid, _) in enumerate(batch):
+                docs = np.flatnonzero(matched[row])
+                doc_scores = scores[row, docs]
+                if len(docs) > topk:
+                    # keep the top-k scores (and any ties with the k-th), then break ties by doc_id
+                    kth = -np.partition(-doc_scores, topk - 1)[topk - 1]
+                    docs, doc_scores = docs[doc_scores >= kth], doc_scores[doc_scores >= kth]
+                order = np.lexsort((did_rank[docs], -doc_scores))[:topk]
+                yield qid, [dids[i] for i in docs[order].tolist()], doc_scores[order]
+
+
+def _vbyte_encode(values):
+    # variable-byte encoding (7 bits per byte, high bit marking the last byte of each value);
+    # returns the encoded bytes and the number of bytes of each value
+    values = np.asarray(values, dtype=np.uint64)
+    lens = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 10):
+        lens += values >= np.uint64(1 << (7 * i))
+    starts = np.cumsum(lens) - lens
+    positions = (np.arange(lens.sum()) - np.repeat(starts, lens)).astype(np.uint64)
+    encoded = ((np.repeat(values, lens) >> (np.uint64(7) * positions)) & np.uint64(0x7f)).astype(np.uint8)
+    encoded[starts + lens - 1] |= 0x80
+    return encoded, lens
+
+
+def _vbyte_decode(encoded):
+    encoded = np.asarray(encoded)
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(encoded & 0x80)
+    starts = np.zeros(len(ends), dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+    value_idx = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    positions = (np.arange(len(encoded)) - starts[value_idx]).astype(np.uint64)
+    parts = (encoded & 0x7f).astype(np.uint64) << (np.uint64(7) * positions)
+    return np.add.reduceat(parts, starts).astype(np.int64)
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import queue
+import multiprocessing
+import onir
+
+
+FEED_BATCH_SIZE = 1000 # documents handed to a serializer process at a time
+FEED_BUFFER_SIZE = 2 ** 20 # bytes buffered by each serializer process between writes to its FIFO
+POLL_INTERVAL = 1. # seconds between checks that the indexer and serializers are still running
+
+
+_logger = onir.log.easy()
+
+
+class JsonFeeder:
+    """
+    Feeds documents to an indexer that reads newline-delimited JSON files from a directory (e.g.,
+    Anserini's IndexCollection with JsonCollection) through count FIFOs, one per indexer thread.
+
+    Records are serialized by a pool of processes (one per FIFO), each writing to its own FIFO in
+    large buffered writes; batches of records are handed to whichever process is free, so a slow
+    indexer thread does not hold up the others. Each process signals that it is ready once the
+    indexer has opened its FIFO for reading, and feeding only starts once all of them are ready.
+    """
+    def __init__(self, directory, count):
+        if count < 1:
+            raise ValueError(f'at least one FIFO is needed (got {count})')
+        self.fifos = []
+        for i in range(count):
+            fifo = os.path.join(directory, f'{i}.json')
+            os.mkfifo(fifo)
+            self.fifos.append(fifo)
+
+    def feed(self, records, indexer_alive=lambda: True):
+        """
+        Writes records (dicts) to the FIFOs and closes them once records is exhausted.
+        indexer_alive is polled while waiting on the indexer, so that feeding fails (rather than
+        blocking forever) if the indexer stops. Returns {'docs', 'bytes', 'seconds'}.
+        """
+        # spawn (rather than fork) so that serializers do not inherit JVM state
+        ctx = multiprocessing.get_context('spawn')
+        batches = ctx.Queue(maxsize=len(self.fifos) * 2)
+        results = ctx.Queue()
+        ready = [ctx.Event() for _ in self.fifos]
+        workers = [ctx.Process(target=_serialize, args=(fifo, batches, results, ev), daemon=True)
+                   for fifo, ev in zip(self.fifos, ready)]
+        for worker in workers:
+            worker.start()
+        try:
+            with _logger.duration('waiting for indexer to open its input'):
+                for ev in ready:
+                    while not ev.wait(POLL_INTERVAL):
+                        _check(workers, indexer_alive)
+            start = time.perf_counter()
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) == FEED_BATCH_SIZE:
+                    _put(batches, batch, workers, indexer_alive)
+                    batch = []
+            if batch:
+                _put(batches, batch, workers, indexer_alive)
+            for _ in workers:
+                _put(batches, None, workers, indexer_alive) # end of input; the serializer closes its FIFO
+            docs, size = 0, 0
+            for _ in workers:
+                while True:
+                    try:
+                        error, worker_docs, worker_bytes = results.get(timeout=POLL_INTERVAL)
+                        break
+                    except queue.Empty:
+                        _check(workers, indexer_alive)
+                if error is not None:
+                    raise RuntimeError(f'JSON serializer failed: {error}')
+                docs += worker_docs
+                size += worker_bytes
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+        _logger.debug(f'fed {docs} documents ({size/1024/1024:.1f}MB) in {seconds:.1f}s: '
+                      f'{docs/max(seconds, 1e-9):.0f} docs/s, {size/1024/1024/max(seconds, 1e-9):.1f}MB/s')
+        return {'docs': docs, 'bytes': size, 'seconds': seconds}
+
+
+def _check(workers, indexer_alive):
+    if not indexer_alive():
+        raise RuntimeError('indexer stopped before consuming all documents')
+    for worker in workers:
+        if worker.exitcode not in (None, 0):
+            raise RuntimeError(f'JSON serializer exited with code {worker.exitcode}')
+
+
+def _put(batches, batch, workers, indexer_alive):
+    while True:
+        try:
+            batches.put(batch, timeout=POLL_INTERVAL)
+            return
+        except queue.Full:
+            _check(workers, indexer_alive)
+
+
+def _serialize(fifo, batches, results, ready):
+    docs, size = 0, 0
+    try:
+        # opening a FIFO for writing blocks until the indexer opens it for reading
+        with open(fifo, 'wt', buffering=FEED_BUFFER_SIZE) as f:
+            ready.set()
+            dumps = json.JSONEncoder().encode
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                data = '\n'.join(map(dumps, batch)) + '\n'
+                f.write(data)
+                docs += len(batch)
+                size += len(data) # ASCII, since non-ASCII characters are escaped
+    except Exception as ex:
+        results.put((repr(ex), docs, size))
+        raise
+    results.put((None, docs, size))
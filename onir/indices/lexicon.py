@@ -0,0 +1,210 @@
+import os
+import json
+import bisect
+import shutil
+from collections import namedtuple
+import numpy as np
+import onir
+
+
+LEXICON_VERSION = 1
+
+
+_logger = onir.log.easy()
+
+
+CollectionStats = namedtuple('CollectionStats', ['num_docs', 'doc_count', 'sum_total_term_freq', 'sum_doc_freq'])
+
+
+class Lexicon:
+    """
+    Term statistics of an index, exported once so that they can be served without the index itself
+    (e.g., without starting the JVM for an Anserini index).
+
+    Terms are stored sorted by their UTF-8 encoding (the order in which Lucene enumerates them) as
+    a single byte array (terms.bin) with the start offset of each term (offsets.npy), alongside
+    the document frequency (df.npy) and collection frequency (cf.npy) of each term. All arrays are
+    memory-mapped read-only; terms are looked up by binary search. Collection statistics are kept
+    in meta.json.
+
+    Since the terms in the index are already analyzed (e.g., stemmed), the lexicon also keeps raw
+    term -> analyzed term mappings (analyzed.json) for known raw terms (e.g., the query
+    vocabulary), so that the analyzer does not need to run for them in every process. The mappings
+    are written when the lexicon is built and replaced atomically when terms are added.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._arrays = None
+        self._analyzed = None
+
+    def path(self):
+        return self._path
+
+    def built(self):
+        return os.path.exists(os.path.join(self._path, 'meta.json'))
+
+    def build(self, terms, stats, analyzed=None):
+        """
+        Writes the lexicon from an iterator of {'term', 'df', 'cf'} dicts (as from iter_terms) and
+        a CollectionStats. Terms that appear multiple times (e.g., once per index segment) are
+        merged. analyzed optionally maps raw terms to their analyzed tokens (see analyze).
+        """
+        tmp_path = f'{self._path}.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with _logger.duration(f'building {self._path}'):
+            counts = {}
+            for record in _logger.pbar(terms, desc='exporting terms'):
+                term = record['term'].encode('utf8')
+                df, cf = counts.get(term, (0, 0))
+                counts[term] = (df + record['df'], cf + record['cf'])
+            sorted_terms = sorted(counts)
+            offsets = np.zeros(len(sorted_terms) + 1, dtype=np.int64)
+            np.cumsum([len(t) for t in sorted_terms], out=offsets[1:])
+            with open(os.path.join(tmp_path, 'terms.bin'), 'wb') as f:
+                f.write(b''.join(sorted_terms))
+            np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+            np.save(os.path.join(tmp_path, 'df.npy'), np.array([counts[t][0] for t in sorted_terms], dtype=np.int64))
+            np.save(os.path.join(tmp_path, 'cf.npy'), np.array([counts[t][1] for t in sorted_terms], dtype=np.int64))
+            if analyzed:
+                _write_analyzed(os.path.join(tmp_path, 'analyzed.json'), analyzed)
+            # meta is written last; its presence indicates that the lexicon is built
+            with open(os.path.join(tmp_path, 'meta.json'), 'wt') as f:
+                json.dump({'version': LEXICON_VERSION, 'num_terms': len(sorted_terms), **stats._asdict()}, f)
+            if os.path.exists(self._path):
+                shutil.rmtree(self._path)
+            os.replace(tmp_path, self._path)
+        self._arrays = None
+        self._analyzed = None
+
+    def remove(self):
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+        self._arrays = None
+        self._analyzed = None
+
+    def _load(self):
+        if self._arrays is None:
+            with open(os.path.join(self._path, 'meta.json'), 'rt') as f:
+                meta = json.load(f)
+            if meta['version'] != LEXICON_VERSION:
+                raise ValueError(f'unsupported lexicon version {meta["version"]} at {self._path}')
+            if meta['num_terms']:
+                data = np.memmap(os.path.join(self._path, 'terms.bin'), dtype=np.uint8, mode='r')
+            else:
+                data = np.zeros(0, dtype=np.uint8) # empty files cannot be memory-mapped
+            self._arrays = {
+                'meta': meta,
+                'terms': _TermArray(data, np.load(os.path.join(self._path, 'offsets.npy'), mmap_mode='r')),
+                'df': np.load(os.path.join(self._path, 'df.npy'), mmap_mode='r'),
+                'cf': np.load(os.path.join(self._path, 'cf.npy'), mmap_mode='r'),
+            }
+        return self._arrays
+
+    def collection_stats(self):
+        meta = self._load()['meta']
+        return CollectionStats(*(meta[field] for field in CollectionStats._fields))
+
+    def num_terms(self):
+        return self._load()['meta']['num_terms']
+
+    def term_id(self, term):
+        """
+        Returns the position of (analyzed) term in the lexicon, or -1 if it is not present.
+        """
+        terms = self._load()['terms']
+        term = term.encode('utf8')
+        idx = bisect.bisect_left(terms, term)
+        if idx < len(terms) and terms[idx] == term:
+            return idx
+        return -1
+
+    def term(self, term_id):
+        return self._load()['terms'][term_id].decode('utf8')
+
+    def dfs(self):
+        """
+        Document frequencies of all terms, by term id (position in the lexicon).
+        """
+        return self._load()['df']
+
+    def cfs(self):
+        """
+        Collection frequencies of all terms, by term id (position in the lexicon).
+        """
+        return self._load()['cf']
+
+    def df(self, term):
+        idx = self.term_id(term)
+        return int(self._load()['df'][idx]) if idx != -1 else 0
+
+    def cf(self, term):
+        idx = self.term_id(term)
+        return int(self._load()['cf'][idx]) if idx != -1 else 0
+
+    def iter_terms(self):
+        arrays = self._load()
+        terms, df, cf = arrays['terms'], arrays['df'], arrays['cf']
+        for i in range(len(terms)):
+            yield {'term': terms[i].decode('utf8'), 'df': int(df[i]), 'cf': int(cf[i])}
+
+    def _load_analyzed(self):
+        if self._analyzed is None:
+            self._analyzed = _read_analyzed(os.path.join(self._path, 'analyzed.json'))
+        return self._analyzed
+
+    def analyze(self, term, analyzer):
+        """
+        Returns the analyzed tokens of term (as a tuple). analyzer(term) is only called if the term
+        is not among the stored mappings (see add_analyzed); its result is kept for this process.
+        """
+        analyzed = self._load_analyzed()
+        if term not in analyzed:
+            analyzed[term] = tuple(analyzer(term))
+        return analyzed[term]
+
+    def add_analyzed(self, terms, analyzer):
+        """
+        Stores the analyzed tokens of all the raw terms (e.g., the query vocabulary) that are not
+        stored yet, so that other processes do not need to run analyzer for them.
+        """
+        path = os.path.join(self._path, 'analyzed.json')
+        analyzed = self._load_analyzed()
+        # another process may have stored some of the terms in the meantime
+        stored = _read_analyzed(path)
+        missing = sorted(set(terms) - stored.keys())
+        if missing:
+            for term in missing:
+                stored[term] = analyzed[term] if term in analyzed else tuple(analyzer(term))
+            _write_analyzed(path, stored)
+        analyzed.update(stored)
+
+
+def _read_analyzed(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rt', encoding='utf8') as f:
+        return {term: tuple(toks) for term, toks in json.load(f).items()}
+
+
+def _write_analyzed(path, analyzed):
+    # written to a temporary file first, so that readers (in other processes) never see a partial
+    # file; concurrent writers each replace the file as a whole
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wt', encoding='utf8') as f:
+        json.dump({term: list(toks) for term, toks in analyzed.items()}, f)
+    os.replace(tmp_path, path)
+
+
+class _TermArray:
+    # sequence of the terms of the lexicon (as bytes), for bisect
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._data[self._offsets[idx]:self._offsets[idx+1]].tobytes()
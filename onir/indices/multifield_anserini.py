@@ -3,7 +3,6 @@ import math
 import json
 import tempfile
 import itertools
-import time
 import re
 import shutil
 import threading
@@ -15,6 +14,7 @@ import onir
 from onir import indices
 from onir.interfaces import trec
 from onir.interfaces.java import J
+from onir.indices.json_feeder import JsonFeeder
 
 logger = onir.log.easy()
 
@@ -281,7 +281,7 @@ class MultifieldAnseriniIndex(indices.BaseIndex):
 
     def build(self, doc_iter, replace=False, optimize=True, store_term_weights=False):
         with logger.duration(f'building {self._base_path}'):
-            thread_count = onir.util.safe_thread_count()
+            thread_count = max(onir.util.safe_thread_count(), 1)
             with tempfile.TemporaryDirectory() as d:
                 if self._settings['built']:
                     if replace:
@@ -289,11 +289,7 @@ class MultifieldAnseriniIndex(indices.BaseIndex):
                         shutil.rmtree(self._base_path)
                     else:
                         logger.warn(f'adding to existing index: {self._base_path}')
-                fifos = []
-                for t in range(thread_count):
-                    fifo = os.path.join(d, f'{t}.json')
-                    os.mkfifo(fifo)
-                    fifos.append(fifo)
+                feeder = JsonFeeder(d, thread_count)
                 index_args = J.A_IndexArgs()
                 index_args.collectionClass = 'JsonCollection'
                 index_args.generatorClass = 'LuceneDocumentGenerator'
@@ -309,22 +305,7 @@ class MultifieldAnseriniIndex(indices.BaseIndex):
                 indexer = J.A_IndexCollection(index_args)
                 thread = threading.Thread(target=indexer.run)
                 thread.start()
-                time.sleep(1) # give it some time to start up, otherwise fails due to race condition
-                for i, doc in enumerate(doc_iter):
-                    f = fifos[hash(i) % thread_count]
-                    if isinstance(f, str):
-                        f = open(f, 'wt')
-                        fifos[hash(i) % thread_count] = f
-                    data = {'id': doc.did, 'contents': 'a'}
-                    data.update(doc.data)
-                    json.dump(data, f)
-                    f.write('\n')
-                for f in fifos:
-                    if not isinstance(f, str):
-                        f.close()
-                    else:
-                        with open(f, 'wt'):
-                            pass # open and close to indicate file is done
+                feeder.feed(({'id': doc.did, 'contents': 'a', **doc.data} for doc in doc_iter), indexer_alive=thread.is_alive)
                 logger.debug('waiting to join')
                 thread.join()
                 self._settings['built'] = True
@@ -1,20 +1,21 @@
 import os
 import onir
-from onir.interfaces.sqlite import Sqlite2KeyDict
+from onir.interfaces.sqlite import open_2key, bulk_build_2key
 
 
 _logger = onir.log.easy()
 
 
 class MultifieldSqliteDocstore:
-    def __init__(self, path, primary_field='text'):
+    def __init__(self, path, primary_field='text', compress=False):
         self._path = path
         self._primary_field = primary_field
+        self._compress = compress # only applies when building
         self._sql = None
 
     def sql(self):
         if self._sql is None:
-            self._sql = Sqlite2KeyDict(self._path, tablename='default', autocommit=False)
+            self._sql = open_2key(self._path, 'default')
         return self._sql
 
     def built(self):
@@ -27,27 +28,16 @@ class MultifieldSqliteDocstore:
         if self._sql:
             self._sql.close()
             self._sql = None
-        MAX_BATCH = 50_000
-        tmp_sql = Sqlite2KeyDict(f'{self._path}.tmp', tablename='default', autocommit=False)
         with _logger.duration(f'building {self._path}'):
-            batch = []
-            for doc in documents:
-                for field in doc.data:
-                    batch.append((field, doc.did, doc.data[field]))
-                if len(batch) >= MAX_BATCH:
-                    tmp_sql.update(batch)
-                    tmp_sql.commit()
-                    batch = []
-            if batch:
-                tmp_sql.update(batch)
-                tmp_sql.commit()
-            os.replace(f'{self._path}.tmp', self._path)
+            items = ((field, doc.did, doc.data[field]) for doc in documents for field in doc.data)
+            bulk_build_2key(self._path, 'default', items, compress=self._compress)
 
     def get_raw(self, did, field=None):
         return self.sql()[field or self._primary_field, did]
 
     def get_raws(self, dids, field=None):
-        return self.sql().lookup(field or self._primary_field, dids)
+        values = self.sql().lookup(field or self._primary_field, dids)
+        return [values[did] for did in dids]
 
     def path(self):
         return self._path
@@ -0,0 +1,218 @@
+import os
+import numpy as np
+import onir
+
+
+QUERY_DOC_SCORES_VERSION = 1
+MISSING_DOC_SCORE = -999.
+
+
+_logger = onir.log.easy()
+
+
+def _long_to_int4(i):
+    # org.apache.lucene.util.SmallFloat.longToInt4
+    num_bits = int(i).bit_length()
+    if num_bits < 4:
+        return i # subnormal value
+    shift = num_bits - 4
+    return ((i >> shift) & 0x07) | ((shift + 1) << 3)
+
+
+def _int4_to_long(i):
+    # org.apache.lucene.util.SmallFloat.int4ToLong
+    bits, shift = i & 0x07, (i >> 3) - 1
+    return bits if shift == -1 else (bits | 0x08) << shift
+
+
+_NUM_FREE_VALUES = 255 - _long_to_int4(2 ** 31 - 1)
+
+
+def _int_to_byte4(i):
+    # org.apache.lucene.util.SmallFloat.intToByte4 (the encoding of document lengths in norms)
+    if i < _NUM_FREE_VALUES:
+        return i
+    return _NUM_FREE_VALUES + _long_to_int4(i - _NUM_FREE_VALUES)
+
+
+def _byte4_to_int(b):
+    # org.apache.lucene.util.SmallFloat.byte4ToInt
+    if b < _NUM_FREE_VALUES:
+        return b
+    return _NUM_FREE_VALUES + _int4_to_long(b - _NUM_FREE_VALUES)
+
+
+LENGTH_TABLE = np.array([_byte4_to_int(b) for b in range(256)], dtype=np.float32)
+
+
+def encoded_lengths(doc_lens):
+    """
+    Document lengths as seen by Lucene's similarities, which only store an approximate (one-byte)
+    encoding of each document's length.
+    """
+    # the encoding truncates, so each length maps to the largest table entry not above it
+    return LENGTH_TABLE[np.searchsorted(LENGTH_TABLE, np.asarray(doc_lens, dtype=np.float64), side='right') - 1]
+
+
+def parse_model(model):
+    """
+    Returns the parameters of a ranking model (e.g., bm25_k1-1.2_b-0.5 or ql_mu-1000) that can be
+    scored by score_terms, or None if the model is not supported (e.g., vsm or models with query
+    expansion).
+    """
+    if model == 'randomqrels':
+        model = 'bm25_k1-0.6_b-0.5'
+    name, *args = model.split('_')
+    try:
+        args = dict(arg.split('-', 1) for arg in args)
+    except ValueError:
+        return None # argument without a value, e.g., rm3
+    if name == 'bm25' and set(args) <= {'k1', 'b'}:
+        return {'model': 'bm25', 'k1': float(args.get('k1', 0.9)), 'b': float(args.get('b', 0.4))}
+    if name == 'ql' and set(args) <= {'mu'}:
+        return {'model': 'ql', 'mu': float(args.get('mu', 1000.))}
+    return None
+
+
+def score_terms(params, tfs, doc_lens, dfs, cfs, stats):
+    """
+    Scores each of the terms of a query against each of a set of documents, following Lucene's
+    BM25Similarity and LMDirichletSimilarity (including their single-precision arithmetic).
+
+    tfs is a [docs, terms] matrix of term frequencies and doc_lens the length of each document;
+    dfs and cfs hold the document and collection frequency of each term, and stats is a
+    CollectionStats. Returns a [docs, terms] float32 matrix, with 0 where the term does not occur.
+    """
+    tfs = np.asarray(tfs, dtype=np.float32)
+    lens = encoded_lengths(doc_lens)[:, None]
+    dfs = np.asarray(dfs, dtype=np.float64)
+    if params['model'] == 'bm25':
+        k1, b = np.float32(params['k1']), np.float32(params['b'])
+        avgdl = np.float32(stats.sum_total_term_freq / stats.doc_count)
+        idf = np.log(1 + (stats.doc_count - dfs + 0.5) / (dfs + 0.5)).astype(np.float32)
+        norm_inverse = np.float32(1) / (k1 * ((np.float32(1) - b) + b * lens / avgdl))
+        scores = idf - idf / (np.float32(1) + tfs * norm_inverse)
+    elif params['model'] == 'ql':
+        mu = np.float32(params['mu'])
+        prob = (np.asarray(cfs, dtype=np.float32) + np.float32(1)) / (np.float32(stats.sum_total_term_freq) + np.float32(1))
+        scores = np.log(1 + tfs / (mu * prob).astype(np.float64)) + np.log(np.float64(mu) / (lens.astype(np.float64) + np.float64(mu)))
+        scores = np.maximum(scores, 0.).astype(np.float32)
+    else:
+        raise ValueError(f'unknown model {params["model"]}')
+    return np.where(tfs > 0, scores, np.float32(0))
+
+
+def batch_query_doc_scores(queries, run, params, analyze, doc_vector, lexicon):
+    """
+    Scores all the pairs of run ({qid: [did, ...]}) with the model params (from parse_model), in the
+    format of get_query_doc_scores: the score of each analyzed query term, or MISSING_DOC_SCORE
+    for each raw query term if the document is not found.
+
+    queries maps each qid to its query text (a sequence of raw terms), analyze maps a raw term to
+    its analyzed tokens, doc_vector returns the {term: tf} of a document (or None if it is not
+    found), and lexicon provides the term and collection statistics. Each document's vector is
+    only fetched once. Returns a QueryDocScores.
+    """
+    stats = lexicon.collection_stats()
+    qids = [qid for qid in run if qid in queries]
+    query_terms = {qid: [t for raw in queries[qid] for t in analyze(raw)] for qid in qids}
+    all_terms = {t for terms in query_terms.values() for t in terms}
+    # only the length and the frequencies of query terms are kept from each document vector
+    doc_vectors = {}
+    dids = {did for qid in qids for did in run[qid]}
+    for did in _logger.pbar(dids, desc='document vectors', total=len(dids)):
+        vec = doc_vector(did)
+        if vec is not None:
+            vec = (sum(vec.values()), {t: tf for t, tf in vec.items() if t in all_terms})
+        doc_vectors[did] = vec
+    query_offsets, result_dids, totals, term_offsets, term_scores = [0], [], [], [0], []
+    for qid in qids:
+        terms, missing_len = query_terms[qid], len(queries[qid])
+        dfs, cfs = [lexicon.df(t) for t in terms], [lexicon.cf(t) for t in terms]
+        dids = list(run[qid])
+        vecs = [doc_vectors[did] for did in dids if doc_vectors[did] is not None]
+        tfs = np.array([[vec.get(t, 0) for t in terms] for _, vec in vecs], dtype=np.float32).reshape(len(vecs), len(terms))
+        scores = iter(score_terms(params, tfs, [l for l, _ in vecs], dfs, cfs, stats).astype(np.float64))
+        for did in dids:
+            if doc_vectors[did] is None:
+                doc_scores = np.full(missing_len, MISSING_DOC_SCORE)
+            else:
+                doc_scores = next(scores)
+            result_dids.append(did)
+            totals.append(doc_scores.sum())
+            term_scores.append(doc_scores)
+            term_offsets.append(term_offsets[-1] + len(doc_scores))
+        query_offsets.append(len(result_dids))
+    return QueryDocScores(
+        qids,
+        np.array(query_offsets, dtype=np.int64),
+        result_dids,
+        np.array(totals, dtype=np.float64),
+        np.array(term_offsets, dtype=np.int64),
+        np.concatenate(term_scores) if term_scores else np.zeros(0),
+        [tuple(queries[qid]) for qid in qids])
+
+
+class QueryDocScores:
+    """
+    Per-term and total ranking scores of all the (query, document) pairs of a run, as computed by
+    batch_query_doc_scores. Pairs are grouped by query; the per-term scores of each pair
+    are stored consecutively in term_scores.
+    """
+    def __init__(self, qids, query_offsets, dids, totals, term_offsets, term_scores, query_texts):
+        self.qids = qids
+        self.query_offsets = query_offsets
+        self.dids = dids
+        self.totals = totals
+        self.term_offsets = term_offsets
+        self.term_scores = term_scores
+        self.query_texts = query_texts
+        self._qid_index = {qid: i for i, qid in enumerate(qids)}
+        self._pairs = {}
+
+    def get(self, qid, did, query_text):
+        """
+        Returns (total, term_scores) for the pair, or None if the pair is not part of the run (or
+        the scores were computed for a different query text).
+        """
+        if qid not in self._qid_index:
+            return None
+        i = self._qid_index[qid]
+        if tuple(self.query_texts[i]) != tuple(query_text):
+            return None
+        if qid not in self._pairs:
+            start, end = self.query_offsets[i], self.query_offsets[i+1]
+            self._pairs[qid] = {d: p for p, d in enumerate(self.dids[start:end], start=start)}
+        p = self._pairs[qid].get(did)
+        if p is None:
+            return None
+        return float(self.totals[p]), self.term_scores[self.term_offsets[p]:self.term_offsets[p+1]].tolist()
+
+    def save(self, path, stat):
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f,
+                     version=QUERY_DOC_SCORES_VERSION,
+                     stat=stat,
+                     qids=np.array(self.qids, dtype=str),
+                     query_offsets=self.query_offsets,
+                     dids=np.array(self.dids, dtype=str),
+                     totals=self.totals,
+                     term_offsets=self.term_offsets,
+                     term_scores=self.term_scores,
+                     query_texts=np.array(['\t'.join(t) for t in self.query_texts], dtype=str))
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path, stat):
+        """
+        Loads the scores saved at path, or returns None if they are missing or were saved with a
+        different stat (e.g., the run has changed since).
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            if data['version'] != QUERY_DOC_SCORES_VERSION or not np.array_equal(data['stat'], stat):
+                return None
+            query_texts = [tuple(t.split('\t')) if t else () for t in data['query_texts'].tolist()]
+            return cls(data['qids'].tolist(), data['query_offsets'], data['dids'].tolist(), data['totals'],
+                       data['term_offsets'], data['term_scores'], query_texts)
@@ -1,6 +1,6 @@
 import os
 import onir
-from onir.interfaces.sqlite import Sqlite2KeyDict
+from onir.interfaces.sqlite import open_2key, bulk_build_2key
 from onir import indices
 
 
@@ -11,14 +11,15 @@ _logger = onir.log.easy()
 
 
 class SqliteDocstore(indices.BaseIndex):
-    def __init__(self, path, field='text'):
+    def __init__(self, path, field='text', compress=False):
         self._path = path
         self._field = field
+        self._compress = compress # only applies when building
         self._sql = None
 
     def sql(self):
         if self._sql is None:
-            self._sql = Sqlite2KeyDict(self._path, tablename=self._field, autocommit=False)
+            self._sql = open_2key(self._path, self._field)
         return self._sql
 
     def built(self):
@@ -30,37 +31,20 @@ class SqliteDocstore(indices.BaseIndex):
         if self._sql:
             self._sql.close()
             self._sql = None
-        MAX_BATCH = 1000
-        tmp_sql = Sqlite2KeyDict(f'{self._path}.tmp', tablename=self._field, autocommit=False)
         with _logger.duration(f'building {self._path}'):
-            batch = []
-            for doc in documents:
-                batch.append((FIELD_RAW, doc.did, doc.data[self._field]))
-                if len(batch) >= MAX_BATCH:
-                    tmp_sql.update(batch)
-                    tmp_sql.commit()
-                    batch = []
-            if batch:
-                tmp_sql.update(batch)
-                tmp_sql.commit()
-            os.replace(f'{self._path}.tmp', self._path)
+            items = ((FIELD_RAW, doc.did, doc.data[self._field]) for doc in documents)
+            bulk_build_2key(self._path, self._field, items, compress=self._compress)
 
     def get_raw(self, did):
         return self.sql()[FIELD_RAW, did]
 
+    def get_raws(self, dids):
+        values = self.sql().lookup(FIELD_RAW, dids)
+        return [values[did] for did in dids]
+
     def path(self):
         return self._path
 
-    def get_tokenized(self, did, vocabulary):
-        lexicon = vocabulary.lexicon_path_segment()
-        if (lexicon, did) not in self.sql():
-            doc_tok = vocabulary.tokenize(self.get_raw(did))
-            doc_tok = [vocabulary.tok2id(tok) for tok in doc_tok]
-            self.sql()[lexicon, did] = doc_tok
-            self.sql().commit()
-            return doc_tok
-        return self.sql()[lexicon, did]
-
     def docids(self):
         if self.built():
             for did in self.sql().iterkey2s():
@@ -0,0 +1,109 @@
+import os
+import shutil
+import numpy as np
+from pytools import memoize_method
+import onir
+from onir import indices
+
+
+_logger = onir.log.easy()
+
+
+class TokenizedDocstore(indices.BaseIndex):
+    """
+    Pre-tokenized version of a docstore for a particular vocabulary lexicon.
+
+    Token ids for the entire collection are stored in a single flat int32 array (tokens.npy),
+    along with the start offset of each document (offsets.npy). Both are memory-mapped read-only,
+    so get_tok returns a zero-copy slice of the collection's tokens.
+    """
+    def __init__(self, path, docstore, vocab, field='text'):
+        self._base_path = path
+        self._path = os.path.join(path, vocab.lexicon_path_segment())
+        self._docstore = docstore
+        self._vocab = vocab
+        self._field = field
+
+    def path(self):
+        return self._path
+
+    def built(self):
+        return os.path.exists(os.path.join(self._path, 'offsets.npy'))
+
+    def build(self, doc_iter=None, replace=False):
+        if not replace and self.built():
+            return
+        if doc_iter is None:
+            # tokenize the contents of the source docstore
+            docs = ((did, self._docstore.get_raw(did)) for did in self._docstore.docids())
+            total = self._docstore.num_docs()
+        else:
+            docs = ((doc.did, doc.data[self._field]) for doc in doc_iter)
+            total = None
+        tmp_path = f'{self._path}.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with _logger.duration(f'building {self._path}'):
+            offsets = [0]
+            with open(os.path.join(tmp_path, 'tokens.bin'), 'wb') as f_toks, \
+                 open(os.path.join(tmp_path, 'docids.txt'), 'wt') as f_dids:
+                for did, text in _logger.pbar(docs, desc='tokenizing documents', total=total):
+                    toks = [self._vocab.tok2id(t) for t in self._vocab.tokenize(text)]
+                    f_toks.write(np.array(toks, dtype=np.int32).tobytes())
+                    f_dids.write(f'{did}\n')
+                    offsets.append(offsets[-1] + len(toks))
+            # copy the raw token ids over to a .npy file in chunks so that it can be memory-mapped
+            # without ever needing to hold the entire collection in memory.
+            raw_path = os.path.join(tmp_path, 'tokens.bin')
+            tokens = np.lib.format.open_memmap(os.path.join(tmp_path, 'tokens.npy'), mode='w+', dtype=np.int32, shape=(offsets[-1],))
+            if offsets[-1] > 0:
+                raw = np.memmap(raw_path, dtype=np.int32, mode='r')
+                CHUNK = 2 ** 24
+                for i in range(0, offsets[-1], CHUNK):
+                    tokens[i:i+CHUNK] = raw[i:i+CHUNK]
+                del raw
+            tokens.flush()
+            del tokens
+            os.remove(raw_path)
+            # offsets are written last; their presence indicates that the store is built
+            np.save(os.path.join(tmp_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+            if os.path.exists(self._path):
+                shutil.rmtree(self._path)
+            os.replace(tmp_path, self._path)
+
+    @memoize_method
+    def _tokens(self):
+        return np.load(os.path.join(self._path, 'tokens.npy'), mmap_mode='r')
+
+    @memoize_method
+    def _offsets(self):
+        return np.load(os.path.join(self._path, 'offsets.npy'), mmap_mode='r')
+
+    @memoize_method
+    def _did2idx(self):
+        with open(os.path.join(self._path, 'docids.txt'), 'rt') as f:
+            return {did.rstrip('\n'): i for i, did in enumerate(f)}
+
+    def get_tok(self, did):
+        idx = self._did2idx()[did]
+        offsets = self._offsets()
+        return self._tokens()[offsets[idx]:offsets[idx+1]]
+
+    def get_len(self, did):
+        idx = self._did2idx()[did]
+        offsets = self._offsets()
+        return int(offsets[idx+1] - offsets[idx])
+
+    def get_raw(self, did):
+        return self._docstore.get_raw(did)
+
+    def docids(self):
+        if self.built():
+            with open(os.path.join(self._path, 'docids.txt'), 'rt') as f:
+                for did in f:
+                    yield did.rstrip('\n')
+
+    def num_docs(self):
+        if self.built():
+            return len(self._offsets()) - 1
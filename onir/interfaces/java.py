@@ -1,4 +1,6 @@
 import os
+import time
+import shlex
 import atexit
 import shutil
 import tempfile
@@ -10,12 +12,29 @@ logger = onir.log.easy()
 
 
 class _JavaInterface:
+    """
+    Entry point to Java classes, via jnius. Classes are registered by name (e.g., J.register(defs=
+    {'File': 'java.io.File'})) and resolved on first access (J.File); the JVM itself is started the
+    first time any class is accessed.
+
+    The JVM is configured from the following onir.config arguments:
+     - java.heap: maximum heap size (-Xmx), e.g., java.heap=16g
+     - java.tiered_stop_at_level: -XX:TieredStopAtLevel (1 starts faster, at the cost of peak
+       performance; good for short commands)
+     - java.cds_archive: class data sharing archive to use (-XX:SharedArchiveFile), e.g., one
+       created with java.options=-XX:ArchiveClassesAtExit=<path> (JDK 13+)
+     - java.options: any other JVM options
+     - java.log_bridge: when true (default), Java log messages are forwarded to the Python log and
+       log listeners through a FIFO; when false, Java only logs warnings and errors to stderr
+    """
     def __init__(self):
         self._autoclass = None
         self._defs = {}
         self._cache = {}
         self._jars = []
         self._log_listeners = []
+        self._startup = {}
+        self._lock = threading.RLock()
 
     def register(self, jars=None, defs=None):
         if jars is not None:
@@ -41,27 +60,80 @@ class _JavaInterface:
         self._log_listeners.pop(0)
 
     def __getattr__(self, key):
-        if self._autoclass is None:
-            self.initialize()
+        if key.startswith('_') or key not in self._defs:
+            raise AttributeError(key)
         if key not in self._cache:
-            self._cache[key] = self._autoclass(self._defs[key])
+            with self._lock: # classes may be first accessed by several threads at once
+                if self._autoclass is None:
+                    self.initialize()
+                if key not in self._cache:
+                    start = time.perf_counter()
+                    self._cache[key] = self._autoclass(self._defs[key])
+                    self._startup['class_count'] += 1
+                    self._startup['class_time'] += time.perf_counter() - start
         return self._cache[key]
 
     def initialize(self):
         if self._autoclass is not None:
             logger.debug('jnius already initialized')
             return
+        try:
+            args = onir.config.args()
+        except (FileNotFoundError, ValueError):
+            # e.g., sys.argv holds the arguments of a test runner rather than onir configuration
+            logger.debug('could not read configuration; starting the JVM with default options')
+            args = {}
+        log_bridge = args.get('java.log_bridge', 'true').lower() == 'true'
+        options = self._jvm_options(args)
         with logger.duration('initializing jnius'):
-            log_fifo, l4j12_file, l4j24_file = self._init_java_logger_interface()
+            start = time.perf_counter()
+            l4j12_file, l4j24_file = self._init_java_logger_interface(log_bridge)
             import jnius_config
             jnius_config.set_classpath(*self._jars, os.path.dirname(l4j12_file))
             jnius_config.add_options(f'-Dlog4j.configuration={l4j12_file}')
             jnius_config.add_options(f'-Dlog4j.configurationFile={l4j24_file}')
-            from jnius import autoclass
+            jnius_config.add_options(*options)
+            from jnius import autoclass # starts the JVM
             self._autoclass = autoclass
             # self.PropertyConfigurator.configure(l4j12_file)
-            for key, path in self._defs.items():
-                self._cache[key] = self._autoclass(path)
+            self._startup = {
+                'jvm_time': time.perf_counter() - start,
+                'options': options,
+                'log_bridge': log_bridge,
+                'class_count': 0,
+                'class_time': 0.,
+            }
+        logger.debug(f'JVM started in {self._startup["jvm_time"]*1000:.0f}ms (options: {" ".join(options) or "none"}, '
+                     f'log bridge: {"on" if log_bridge else "off"}); {len(self._defs)} classes registered')
+        atexit.register(self._log_startup_report)
+
+    def startup_report(self):
+        """
+        Returns the time spent starting the JVM (jvm_time, in seconds), the options it was started
+        with, and the number of classes resolved so far (class_count) and the time spent resolving
+        them (class_time). Empty if the JVM has not been started.
+        """
+        return dict(self._startup)
+
+    def _log_startup_report(self):
+        report = self._startup
+        logger.debug(f'JVM startup: {report["jvm_time"]*1000:.0f}ms; resolved {report["class_count"]} of '
+                     f'{len(self._defs)} registered classes in {report["class_time"]*1000:.0f}ms')
+
+    def _jvm_options(self, args):
+        options = []
+        if args.get('java.heap'):
+            options.append(f'-Xmx{args["java.heap"]}')
+        if args.get('java.tiered_stop_at_level'):
+            options.append(f'-XX:TieredStopAtLevel={args["java.tiered_stop_at_level"]}')
+        if args.get('java.cds_archive'):
+            if os.path.exists(args['java.cds_archive']):
+                options.append('-Xshare:auto')
+                options.append(f'-XX:SharedArchiveFile={args["java.cds_archive"]}')
+            else:
+                logger.warn(f'CDS archive {args["java.cds_archive"]} not found; starting without it')
+        options.extend(shlex.split(args.get('java.options', '')))
+        return options
 
     def _java_log_listen(self, fifo):
         while True:
@@ -78,11 +150,40 @@ class _JavaInterface:
                     else:
                         buf += line
 
-    def _init_java_logger_interface(self):
+    def _init_java_logger_interface(self, log_bridge=True):
         base_tmp = tempfile.mkdtemp()
         atexit.register(shutil.rmtree, base_tmp)
         l4j12_config_file = os.path.join(base_tmp, 'log4j.properties')
         l4j24_config_file = os.path.join(base_tmp, 'log4j24.xml')
+        if not log_bridge:
+            # no listener thread; only warnings and errors are logged (to stderr)
+            with open(l4j12_config_file, 'wt') as f:
+                f.write('''
+log4j.rootLogger=WARN, stderr
+
+log4j.appender.stderr=org.apache.log4j.ConsoleAppender
+log4j.appender.stderr.Target=System.err
+log4j.appender.stderr.layout=org.apache.log4j.PatternLayout
+log4j.appender.stderr.layout.ConversionPattern=%p %c [%t] %m%n
+''')
+            with open(l4j24_config_file, 'wt') as f:
+                f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<Configuration>
+  <Appenders>
+    <Console name="Stderr" target="SYSTEM_ERR">
+      <PatternLayout>
+        <Pattern>%p %c [%t] %m%n</Pattern>
+      </PatternLayout>
+    </Console>
+  </Appenders>
+  <Loggers>
+    <Root level="warn">
+      <AppenderRef ref="Stderr"/>
+    </Root>
+  </Loggers>
+</Configuration>
+''')
+            return l4j12_config_file, l4j24_config_file
         log_fifo = os.path.join(base_tmp, 'log_interface.fifo')
         os.mkfifo(log_fifo)
         log_thread = threading.Thread(target=self._java_log_listen, args=(log_fifo,), daemon=True)
@@ -116,7 +217,7 @@ log4j.appender.fifo.layout.ConversionPattern=%p %c [%t] %m%n%n
   </Loggers>
 </Configuration>
 ''')
-        return log_fifo, l4j12_config_file, l4j24_config_file
+        return l4j12_config_file, l4j24_config_file
 
 J = _JavaInterface()
 
@@ -1,4 +1,14 @@
+import os
+import sqlite3
+import itertools
+import contextlib
+import threading
 import sqlitedict
+import onir
+from onir import util
+
+
+_logger = onir.log.easy()
 
 
 class Sqlite2KeyDict(sqlitedict.SqliteDict):
@@ -6,6 +16,7 @@ class Sqlite2KeyDict(sqlitedict.SqliteDict):
     Adapated from sqlitedict.SqliteDict with support for two keys
     """
     VALID_FLAGS = ['c', 'r', 'w', 'n']
+    MAX_LOOKUP = 500 # keep under SQLITE_MAX_VARIABLE_NUMBER (999 on older versions)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -112,6 +123,21 @@ class Sqlite2KeyDict(sqlitedict.SqliteDict):
             raise ValueError('must provide at least one key')
         self.conn.execute(DEL_ITEM, del_args)
 
+    def lookup(self, key1, key2s):
+        """
+        Looks up the values for many key2s (for a single key1). Returns a dict of key2 -> value
+        (keys that are not found are omitted).
+        """
+        result = {}
+        key2s = list(dict.fromkeys(key2s)) # unique (preserving order)
+        for i in range(0, len(key2s), self.MAX_LOOKUP):
+            chunk = key2s[i:i+self.MAX_LOOKUP]
+            params = ', '.join('?' for _ in chunk)
+            GET_ITEMS = f'SELECT key2, value FROM "{self.tablename}" WHERE key1 = ? AND key2 IN ({params})'
+            for key2, value in self.conn.select(GET_ITEMS, (key1, *chunk)):
+                result[key2] = self.decode(value)
+        return result
+
     def lookup_value(self, value):
         GET_ITEM = 'SELECT key1, key2 FROM "%s" WHERE value = ?' % self.tablename
         item = self.conn.select_one(GET_ITEM, (value, ))
@@ -129,3 +155,253 @@ class Sqlite2KeyDict(sqlitedict.SqliteDict):
 
         UPDATE_ITEMS = 'REPLACE INTO "%s" (key1, key2, value) VALUES (?, ?, ?)' % self.tablename
         self.conn.executemany(UPDATE_ITEMS, items)
+
+
+class SqliteReadPool:
+    """
+    Read-only connections to an SQLite database file: one per thread (and per process, so that
+    connections are never shared across a fork). Connections are opened with query_only and
+    memory-mapped I/O, and keep a cache of prepared statements.
+    """
+    MMAP_SIZE = 2 ** 30
+    CACHED_STATEMENTS = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True, check_same_thread=False,
+                                   cached_statements=self.CACHED_STATEMENTS)
+            conn.execute('PRAGMA query_only = ON')
+            conn.execute(f'PRAGMA mmap_size = {self.MMAP_SIZE}')
+            local.conn, local.pid = conn, os.getpid()
+            with self._lock:
+                self._conns.append((conn, local.pid))
+        return local.conn
+
+    def close(self):
+        with self._lock:
+            for conn, pid in self._conns:
+                if pid == os.getpid():
+                    conn.close()
+            self._conns = []
+        self._local = threading.local()
+
+
+class Sqlite2KeyTable:
+    """
+    Read-only access to a two-key table, safe to use concurrently from multiple threads and
+    processes (each uses its own connection; see SqliteReadPool).
+
+    Tables written by bulk_build_2key store values as raw text (rather than pickles) in a WITHOUT
+    ROWID table keyed by (key1, key2), with the seq column keeping the insertion order. Values
+    compressed with a zstd dictionary (compress=True) are decompressed transparently. With
+    legacy=True, reads tables written by Sqlite2KeyDict (pickled values, ordered by rowid).
+    """
+    MAX_LOOKUP = Sqlite2KeyDict.MAX_LOOKUP
+
+    def __init__(self, filename, tablename, legacy=False):
+        self.filename = filename
+        self.legacy = legacy
+        self.basename = tablename
+        self.tablename = f'{tablename}-2' if legacy else f'{tablename}-bulk'
+        self.pool = SqliteReadPool(filename)
+        self._has_manifest = None
+        self._zdict = None
+        self._local = threading.local()
+        if not legacy:
+            GET_DICT = f'SELECT dict FROM "{tablename}-zdict"'
+            if _has_table(self.pool.conn(), f'{tablename}-zdict'):
+                self._zdict = self.pool.conn().execute(GET_DICT).fetchone()[0]
+
+    def __str__(self):
+        return f'Sqlite2KeyTable({self.filename})'
+
+    def _decode(self, value):
+        if self.legacy:
+            return sqlitedict.decode(value)
+        if self._zdict is not None:
+            # decompressors are not thread-safe; keep one per thread
+            if not hasattr(self._local, 'decompressor'):
+                self._local.decompressor = _zstd().ZstdDecompressor(dict_data=_zstd().ZstdCompressionDict(self._zdict))
+            return self._local.decompressor.decompress(value).decode('utf8')
+        return value
+
+    def __getitem__(self, key):
+        key1, key2 = key
+        GET_ITEM = f'SELECT value FROM "{self.tablename}" WHERE key1 = ? AND key2 = ?'
+        row = self.pool.conn().execute(GET_ITEM, (key1, key2)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._decode(row[0])
+
+    def __contains__(self, key):
+        key1, key2 = key
+        HAS_ITEM = f'SELECT 1 FROM "{self.tablename}" WHERE key1 = ? AND key2 = ?'
+        return self.pool.conn().execute(HAS_ITEM, (key1, key2)).fetchone() is not None
+
+    def lookup(self, key1, key2s):
+        """
+        Looks up the values for many key2s (for a single key1). Returns a dict of key2 -> value
+        (keys that are not found are omitted).
+        """
+        result = {}
+        conn = self.pool.conn()
+        key2s = list(dict.fromkeys(key2s)) # unique (preserving order)
+        for i in range(0, len(key2s), self.MAX_LOOKUP):
+            chunk = key2s[i:i+self.MAX_LOOKUP]
+            # pad to a power of 2 (with NULLs, which match nothing), so that only a few distinct
+            # statements are prepared (and cached)
+            size = 1 << (len(chunk) - 1).bit_length()
+            params = ', '.join('?' for _ in range(size))
+            GET_ITEMS = f'SELECT key2, value FROM "{self.tablename}" WHERE key1 = ? AND key2 IN ({params})'
+            for key2, value in conn.execute(GET_ITEMS, (key1, *chunk, *([None] * (size - len(chunk))))):
+                result[key2] = self._decode(value)
+        return result
+
+    def iterkey2s(self):
+        if self._ensure_manifest():
+            GET_KEYS = f'SELECT key2 FROM "{self.basename}-key2s" ORDER BY rowid'
+        else:
+            GET_KEYS = _select_key2s(self.tablename, self.legacy)
+        for row in self.pool.conn().execute(GET_KEYS):
+            yield row[0]
+
+    def countkey2s(self):
+        if self._ensure_manifest():
+            LEN_KEYS = f'SELECT value FROM "{self.basename}-manifest" WHERE name = ?'
+            return self.pool.conn().execute(LEN_KEYS, ('key2_count',)).fetchone()[0]
+        LEN_KEYS = f'SELECT COUNT(DISTINCT key2) FROM "{self.tablename}"'
+        return self.pool.conn().execute(LEN_KEYS).fetchone()[0]
+
+    def _ensure_manifest(self):
+        # Files written by older versions do not have a manifest; it is added the first time it is
+        # needed (unless the file is not writable, in which case the table is scanned each time).
+        if self._has_manifest is None:
+            self._has_manifest = _has_table(self.pool.conn(), f'{self.basename}-manifest')
+        if not self._has_manifest:
+            try:
+                with contextlib.closing(sqlite3.connect(self.filename, isolation_level=None)) as conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    if not _has_table(conn, f'{self.basename}-manifest'):
+                        _write_manifest(conn, self.basename, _select_key2s(self.tablename, self.legacy))
+                    conn.execute('COMMIT')
+                self._has_manifest = True
+            except sqlite3.OperationalError:
+                pass # read-only
+        return self._has_manifest
+
+    def close(self):
+        self.pool.close()
+
+
+def open_2key(filename, tablename):
+    """
+    Opens a two-key table for reading (see Sqlite2KeyTable), for files written either by
+    bulk_build_2key or by older versions (through Sqlite2KeyDict).
+    """
+    with contextlib.closing(sqlite3.connect(f'file:{filename}?mode=ro', uri=True)) as conn:
+        is_bulk = _has_table(conn, f'{tablename}-bulk')
+    return Sqlite2KeyTable(filename, tablename, legacy=not is_bulk)
+
+
+def _has_table(conn, name):
+    FIND_TABLE = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(FIND_TABLE, (name,)).fetchone() is not None
+
+
+def _select_key2s(table, legacy):
+    # distinct key2s in insertion order
+    if legacy:
+        return f'SELECT DISTINCT key2 FROM "{table}" ORDER BY rowid'
+    return f'SELECT key2 FROM "{table}" GROUP BY key2 ORDER BY MIN(seq)'
+
+
+def _write_manifest(conn, tablename, select_key2s):
+    # The manifest holds the distinct key2s (in insertion order) and their count, so that they can
+    # be enumerated and counted without scanning the table.
+    conn.execute(f'CREATE TABLE "{tablename}-key2s" (key2 TEXT)')
+    conn.execute(f'INSERT INTO "{tablename}-key2s" (key2) {select_key2s}')
+    conn.execute(f'CREATE TABLE "{tablename}-manifest" (name TEXT PRIMARY KEY, value)')
+    conn.execute(f'INSERT INTO "{tablename}-manifest" VALUES (?, (SELECT COUNT(*) FROM "{tablename}-key2s"))', ('key2_count',))
+
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        _logger.warn('Module zstandard not installed (needed for compressed docstores). Install with `pip install zstandard`')
+        raise
+
+
+ZSTD_DICT_SAMPLE = 10_000 # number of values used for training the compression dictionary
+ZSTD_DICT_SIZE = 112 * 1024
+ZSTD_LEVEL = 3
+
+
+def bulk_build_2key(filename, tablename, items, batch_size=50_000, compress=False):
+    """
+    Writes (key1, key2, value) items (with str values) to a new table for Sqlite2KeyTable. As with
+    REPLACE INTO, the last value for duplicate keys is kept.
+
+    With compress=True, a zstd dictionary is trained on the first ZSTD_DICT_SAMPLE values (the
+    items are a stream, so a random sample is not available), stored in the database, and used to
+    compress every value.
+
+    Journaling and syncing are disabled during the load, since the file is written to a temporary
+    path and only renamed to filename once it is complete. Items are first appended to an
+    unindexed staging table (in a separate file), and the primary key index is built at the end by
+    inserting them into the final table in key order. A manifest of the distinct key2s (e.g., the
+    docids) and their count is written along with the table.
+    """
+    tmp_filename = f'{filename}.tmp'
+    staging_filename = f'{filename}.staging'
+    for path in [tmp_filename, staging_filename]:
+        if os.path.exists(path):
+            os.remove(path)
+    conn = sqlite3.connect(tmp_filename, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS staging', (staging_filename,))
+        for db in ['main', 'staging']:
+            conn.execute(f'PRAGMA {db}.journal_mode = OFF')
+            conn.execute(f'PRAGMA {db}.synchronous = OFF')
+        conn.execute('CREATE TABLE staging.items (key1 TEXT, key2 TEXT, value TEXT)')
+        if compress:
+            items = _compress_items(conn, tablename, iter(items))
+        for batch in util.chunked(items, batch_size):
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO staging.items VALUES (?, ?, ?)', batch)
+            conn.execute('COMMIT')
+        table = f'{tablename}-bulk'
+        conn.execute(f'CREATE TABLE "{table}" (key1 TEXT, key2 TEXT, seq INTEGER, value TEXT, PRIMARY KEY (key1, key2)) WITHOUT ROWID')
+        conn.execute(f'INSERT OR REPLACE INTO "{table}" SELECT key1, key2, rowid, value FROM staging.items ORDER BY key1, key2, rowid')
+        _write_manifest(conn, tablename, _select_key2s(table, legacy=False))
+        conn.execute('DETACH DATABASE staging')
+    finally:
+        conn.close()
+        if os.path.exists(staging_filename):
+            os.remove(staging_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _compress_items(conn, tablename, items):
+    zstd = _zstd()
+    sample = list(itertools.islice(items, ZSTD_DICT_SAMPLE))
+    try:
+        zdict = zstd.train_dictionary(ZSTD_DICT_SIZE, [v.encode('utf8') for _, _, v in sample])
+        zdict_data = zdict.as_bytes()
+    except zstd.ZstdError:
+        # too few (or too small) samples to train a dictionary; compress without one
+        zdict = None
+        zdict_data = b''
+    conn.execute(f'CREATE TABLE "{tablename}-zdict" (dict BLOB)')
+    conn.execute(f'INSERT INTO "{tablename}-zdict" VALUES (?)', (zdict_data,))
+    compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+    for key1, key2, value in itertools.chain(sample, items):
+        yield key1, key2, compressor.compress(value.encode('utf8'))
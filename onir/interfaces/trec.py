@@ -1,19 +1,168 @@
 import os
 import re
+import csv
 import gzip
 import tempfile
 import subprocess
+from array import array
 from typing import Iterator, Tuple, Dict
 from collections.abc import Iterable as IterableAbc
 from multiprocessing import Pool
 from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from bs4 import BeautifulSoup
 from onir.interfaces import plaintext
 from onir import indices, util
 
 
+BULK_CHUNK_SIZE = 1_000_000
+RUN_SIDECAR_VERSION = 1
+# (index, name, dtype) of the columns read from run and qrels files
+RUN_COLUMNS = [(0, 'qid', str), (2, 'did', str), (3, 'rank', np.int64), (4, 'score', np.float64)]
+QRELS_COLUMNS = [(0, 'qid', str), (2, 'did', str), (3, 'score', np.int64)]
+
+
+class _InternedTable:
+    """
+    Compact representation of (qid, did, score) records. qids and dids are interned as int32 codes
+    into string tables, and the records of each query are stored contiguously: the records of the
+    i-th query (self.qids[i]) are doc_codes[offsets[i]:offsets[i+1]] and scores[offsets[i]:offsets[i+1]].
+    The records of each query keep the order in which they were provided (e.g., rank order for runs
+    read from a file).
+    """
+    SCORE_DTYPE = None
+
+    def __init__(self, qids, dids, offsets, doc_codes, scores):
+        self.qids = qids
+        self.dids = dids
+        self.offsets = offsets
+        self.doc_codes = doc_codes
+        self.scores = scores
+        self._qid_index = {qid: i for i, qid in enumerate(qids)}
+
+    @classmethod
+    def from_iter(cls, it):
+        """
+        Builds a table from an iterator of (qid, did, score). The records of a query do not need to
+        be contiguous.
+        """
+        qid_codes, did_codes = {}, {}
+        q_codes, d_codes, scores = array('i'), array('i'), array('d')
+        for qid, did, score in it:
+            q_codes.append(qid_codes.setdefault(qid, len(qid_codes)))
+            d_codes.append(did_codes.setdefault(did, len(did_codes)))
+            scores.append(score)
+        return cls._from_codes(list(qid_codes), list(did_codes),
+                               np.array(q_codes, dtype=np.int32),
+                               np.array(d_codes, dtype=np.int32),
+                               np.array(scores))
+
+    @classmethod
+    def from_queries(cls, it):
+        """
+        Builds a table from an iterator of (qid, dids, scores), one per query (e.g., from a batch
+        search), where dids is a sequence of document ids and scores an array of the same length.
+        Each qid should only appear once.
+        """
+        qids, did_codes, offsets, doc_codes, scores = [], {}, [0], array('i'), []
+        for qid, dids, query_scores in it:
+            qids.append(qid)
+            doc_codes.extend(did_codes.setdefault(did, len(did_codes)) for did in dids)
+            scores.append(np.asarray(query_scores))
+            offsets.append(len(doc_codes))
+        return cls(qids, list(did_codes),
+                   np.array(offsets, dtype=np.int64),
+                   np.array(doc_codes, dtype=np.int32),
+                   np.concatenate(scores).astype(cls.SCORE_DTYPE) if scores else np.zeros(0, dtype=cls.SCORE_DTYPE))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls.from_iter((qid, did, score) for qid, docs in data.items() for did, score in docs.items())
+
+    @classmethod
+    def from_df(cls, df):
+        q_codes, qids = pd.factorize(df['qid'])
+        d_codes, dids = pd.factorize(df['did'])
+        return cls._from_codes(list(qids), list(dids), q_codes.astype(np.int32), d_codes.astype(np.int32), df['score'].values)
+
+    @classmethod
+    def _from_codes(cls, qids, dids, q_codes, doc_codes, scores):
+        if len(q_codes) > 1 and np.any(q_codes[1:] < q_codes[:-1]):
+            # group records by query (stable, so order within each query is kept)
+            order = np.argsort(q_codes, kind='stable')
+            doc_codes, scores = doc_codes[order], scores[order]
+        offsets = np.zeros(len(qids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(q_codes, minlength=len(qids)), out=offsets[1:])
+        return cls(qids, dids, offsets, doc_codes.astype(np.int32), scores.astype(cls.SCORE_DTYPE))
+
+    def query(self, qid):
+        """
+        Returns (doc_codes, scores) arrays (views) for the given query. Raises KeyError if the query
+        is not in the table.
+        """
+        i = self._qid_index[qid]
+        start, end = self.offsets[i], self.offsets[i+1]
+        return self.doc_codes[start:end], self.scores[start:end]
+
+    def query_dict(self, qid):
+        doc_codes, scores = self.query(qid)
+        return dict(zip((self.dids[c] for c in doc_codes.tolist()), scores.tolist()))
+
+    def num_records(self):
+        return len(self.doc_codes)
+
+    def __len__(self):
+        return len(self.qids)
+
+    def __contains__(self, qid):
+        return qid in self._qid_index
+
+    def __iter__(self):
+        dids, scores = self.dids, self.scores.tolist()
+        for i, qid in enumerate(self.qids):
+            start, end = self.offsets[i], self.offsets[i+1]
+            for code, score in zip(self.doc_codes[start:end].tolist(), scores[start:end]):
+                yield qid, dids[code], score
+
+    def to_dict(self):
+        return {qid: self.query_dict(qid) for qid in self.qids}
+
+    def to_df(self):
+        return pd.DataFrame({
+            'qid': np.repeat(np.array(self.qids, dtype=object), np.diff(self.offsets)),
+            'did': np.array(self.dids, dtype=object)[self.doc_codes],
+            'score': self.scores,
+        })
+
+
+class RunTable(_InternedTable):
+    """
+    Run in the compact table representation (see _InternedTable), with float32 scores.
+    """
+    SCORE_DTYPE = np.float32
+
+    def save_file(self, file, runid='run'):
+        # within each query, rank by descending score
+        q_idx = np.repeat(np.arange(len(self.qids)), np.diff(self.offsets))
+        order = np.lexsort((-self.scores, q_idx))
+        ranks = np.arange(len(order)) - np.repeat(self.offsets[:-1], np.diff(self.offsets)) + 1
+        qids, dids = self.qids, self.dids
+        it = ((qids[q], 'Q0', dids[d], r, s, runid) for q, d, r, s in zip(q_idx.tolist(), self.doc_codes[order].tolist(), ranks.tolist(), self.scores[order].tolist()))
+        plaintext.write_sv(file, it, sep=' ')
+
+
+class QrelsTable(_InternedTable):
+    """
+    Qrels in the compact table representation (see _InternedTable), with int32 relevance scores.
+    """
+    SCORE_DTYPE = np.int32
+
+    def save_file(self, file, sep=' '):
+        it = ((qid, '0', did, score) for qid, did, score in self)
+        plaintext.write_sv(file, it, sep=sep)
+
+
 class Qrels:
     def __init__(self, data, sep=None):
         self._data = {}
@@ -21,6 +170,8 @@ class Qrels:
         self._iter = None
         if isinstance(data, str):
             self._data['trec'] = data
+        elif isinstance(data, QrelsTable):
+            self._data['table'] = data
         elif isinstance(data, dict):
             self._data['dict'] = data
         elif isinstance(data, pd.DataFrame):
@@ -44,6 +195,8 @@ class Qrels:
             return it
         if 'df' in self._data:
             return self._data['df']
+        if 'table' in self._data:
+            return iter(self._data['table'])
         if 'dict' in self._data:
             return ((qid, did, score) for qid, docs in self._data['dict'].items() \
                                       for did, score in docs.items())
@@ -71,16 +224,25 @@ class Qrels:
             self._data['df'] = pd.DataFrame(iter(self), columns=['qid', 'did', 'score'])
         return self._data['df']
 
+    def table(self):
+        if 'table' not in self._data:
+            if 'df' in self._data:
+                self._data['table'] = QrelsTable.from_df(self._data['df'])
+            else:
+                self._data['table'] = QrelsTable.from_iter(iter(self))
+        return self._data['table']
+
     def get(self, fmt):
         return {
             'trec': self.trec,
             'dict': self.dict,
             'df': self.df,
+            'table': self.table,
         }[fmt]()
 
     def _iter_file(self, file, sep=None):
-        for qid, _, docid, score in plaintext.read_sv(file, sep=(sep or self._sep)):
-            yield qid, docid, int(score)
+        for chunk in _read_sv_chunks(file, QRELS_COLUMNS, sep=(sep or self._sep)):
+            yield from zip(chunk['qid'].tolist(), chunk['did'].tolist(), chunk['score'].tolist())
 
     def save_file(self, path, link_ok=True, sep=None):
         if link_ok and 'trec' in self._data and os.path.exists(self._data['file']):
@@ -128,53 +290,214 @@ def read_run(file):
     Returns:
         iter<tuple<str,str,int,float>> -- iterator with <qid, docid, rank, score>
     """
-    for qid, _, docid, rank, score, _ in plaintext.read_sv(file, sep=' '):
-        yield qid, docid, int(rank), float(score)
+    for chunk in _read_sv_chunks(file, RUN_COLUMNS, sep=' '):
+        yield from zip(chunk['qid'].tolist(), chunk['did'].tolist(), chunk['rank'].tolist(), chunk['score'].tolist())
+
+
+def read_run_arrays(file, cache=False):
+    """
+    Reads query-document run file in bulk
+
+    Args:
+        file (str|Stream) file path (str) or stream (Stream) to read run from
+        cache (bool) when file is a path, read from (or write) a binary sidecar file (file + '.npz')
+                     that is used as long as the size and modification time of file are unchanged
+
+    Returns:
+        dict with qid and did string tables (qids, dids; lists), and the qid_codes, doc_codes,
+        ranks, and scores of each record (in file order; np.ndarray)
+    """
+    if cache and isinstance(file, str):
+        result = _read_run_sidecar(file)
+        if result is None:
+            result = _read_run_arrays(file)
+            _write_run_sidecar(file, result)
+        return result
+    return _read_run_arrays(file)
 
 
-def read_run_dict(file, top=None):
+def read_run_dict(file, top=None, cache=False):
     """
     Reads query-document run file and returns results as a dictionary
 
     Args:
         file (str|Stream) file path (str) or stream (Stream) to read run from
         top (int|None) return only at most this many records per run (highest-scoring)
+        cache (bool) use a binary sidecar file (see read_run_arrays)
 
     Returns:
         dict<str,dict<str,float>> -- dictionary like {qid: {docid: score}}
     """
+    run = _top_run_arrays(read_run_arrays(file, cache), top)
+    qids, dids = run['qids'], run['dids']
     result = {}
-    for qid, docid, rank, score in read_run(file):
-        if top is None or rank <= top:
-            result.setdefault(qid, {})[docid] = score
+    for q, d, score in zip(run['qid_codes'].tolist(), run['doc_codes'].tolist(), run['scores'].tolist()):
+        result.setdefault(qids[q], {})[dids[d]] = score
     return result
 
 
-def read_run_df(file, top=None):
-    return pd.DataFrame(((qid, did, score) for qid, did, rank, score in tqdm(read_run(file), leave=False) if top is None or rank <= top), columns=['qid', 'did', 'score'])
+def read_run_df(file, top=None, cache=False):
+    run = _top_run_arrays(read_run_arrays(file, cache), top)
+    return pd.DataFrame({
+        'qid': np.array(run['qids'], dtype=object)[run['qid_codes']],
+        'did': np.array(run['dids'], dtype=object)[run['doc_codes']],
+        'score': run['scores'],
+    })
+
 
+def read_run_table(file, top=None, cache=False):
+    """
+    Reads query-document run file and returns results as a RunTable
+
+    Args:
+        file (str|Stream) file path (str) or stream (Stream) to read run from
+        top (int|None) return only at most this many records per run (highest-scoring)
+        cache (bool) use a binary sidecar file (see read_run_arrays)
+
+    Returns:
+        RunTable -- run with interned qids and dids
+    """
+    run = _top_run_arrays(read_run_arrays(file, cache), top)
+    return RunTable._from_codes(run['qids'], run['dids'], run['qid_codes'], run['doc_codes'], run['scores'])
 
-def read_run_fmt(file, fmt, top=None):
+
+def read_run_fmt(file, fmt, top=None, cache=False):
     """
     Reads query-document run file and returns results in the specified format
 
     Args:
         file (str|Stream) file path (str) or stream (Stream) to read qrels from
-        fmt (str) format to read run as from {'trec', 'dict', 'df'}
+        fmt (str) format to read run as from {'trec', 'dict', 'df', 'table'}
+        cache (bool) use a binary sidecar file (see read_run_arrays)
 
     Returns:
         depends on fmt:
           fmt == 'trec': str representing a file that contains the qrels in trec format
           fmt == 'dict': dict<str,dict<str,int>> dictionary like {qid: {docid: score}}
           fmt == 'df': pd.DataFrame with qid, did, and score columns
+          fmt == 'table': RunTable with interned qids and dids
     """
     return {
         'trec': lambda file: file.name if hasattr(file, 'name') else file,
-        'dict': lambda file: read_run_dict(file, top),
-        'df': lambda file: read_run_df(file, top),
+        'dict': lambda file: read_run_dict(file, top, cache),
+        'df': lambda file: read_run_df(file, top, cache),
+        'table': lambda file: read_run_table(file, top, cache),
     }[fmt](file)
 
 
+def _read_sv_chunks(file, columns, sep=None):
+    # Parses the file in large chunks with pandas' C engine. columns is a list of
+    # (index, name, dtype) of the columns to read.
+    try:
+        reader = pd.read_csv(file,
+                             sep=r'\s+' if sep in (None, ' ') else sep,
+                             header=None,
+                             usecols=[i for i, _, _ in columns],
+                             dtype={i: dtype for i, _, dtype in columns},
+                             na_filter=False,
+                             float_precision='round_trip',
+                             quoting=csv.QUOTE_NONE,
+                             engine='c',
+                             chunksize=BULK_CHUNK_SIZE)
+        for chunk in reader:
+            yield chunk.rename(columns={i: name for i, name, _ in columns})
+    except pd.errors.EmptyDataError:
+        return
+
+
+def _intern(values, table):
+    # Returns the int32 codes of values in table (a dict of value -> code), adding new values
+    codes, uniques = pd.factorize(values)
+    remap = np.array([table.setdefault(u, len(table)) for u in uniques.tolist()], dtype=np.int32)
+    return remap[codes]
+
+
+def _read_run_arrays(file):
+    qid_table, did_table = {}, {}
+    qid_codes, doc_codes, ranks, scores = [], [], [], []
+    for chunk in _read_sv_chunks(file, RUN_COLUMNS, sep=' '):
+        qid_codes.append(_intern(chunk['qid'], qid_table))
+        doc_codes.append(_intern(chunk['did'], did_table))
+        ranks.append(chunk['rank'].values.astype(np.int32))
+        scores.append(chunk['score'].values)
+    return {
+        'qids': list(qid_table),
+        'dids': list(did_table),
+        'qid_codes': np.concatenate(qid_codes) if qid_codes else np.zeros(0, dtype=np.int32),
+        'doc_codes': np.concatenate(doc_codes) if doc_codes else np.zeros(0, dtype=np.int32),
+        'ranks': np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.int32),
+        'scores': np.concatenate(scores) if scores else np.zeros(0, dtype=np.float64),
+    }
+
+
+def _top_run_arrays(run, top):
+    if top is None:
+        return run
+    mask = run['ranks'] <= top
+    return {**run, **{key: run[key][mask] for key in ('qid_codes', 'doc_codes', 'ranks', 'scores')}}
+
+
+def _run_sidecar_stat(path):
+    stat = os.stat(path)
+    return np.array([RUN_SIDECAR_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def _read_run_sidecar(path):
+    sidecar_path = f'{path}.npz'
+    if not os.path.exists(sidecar_path) or not os.path.exists(path):
+        return None
+    with np.load(sidecar_path, allow_pickle=False) as data:
+        if not np.array_equal(data['stat'], _run_sidecar_stat(path)):
+            return None # outdated (or from a different version)
+        result = {key: data[key] for key in ('qid_codes', 'doc_codes', 'ranks', 'scores')}
+        result['qids'] = data['qids'].tolist()
+        result['dids'] = data['dids'].tolist()
+    return result
+
+
+def _write_run_sidecar(path, run):
+    sidecar_path = f'{path}.npz'
+    tmp_path = f'{sidecar_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 stat=_run_sidecar_stat(path),
+                 qids=np.array(run['qids'], dtype=str),
+                 dids=np.array(run['dids'], dtype=str),
+                 **{key: run[key] for key in ('qid_codes', 'doc_codes', 'ranks', 'scores')})
+    os.replace(tmp_path, sidecar_path)
+
+
+def truncate_run(source, dest, top):
+    """
+    Writes the records of the run file source with rank <= top to dest, streaming over source.
+    Assumes that the records of each query are contiguous and in rank order (as written by
+    batch_query), so once a query passes the cutoff its remaining lines are skipped with a prefix
+    check rather than being split and parsed.
+
+    Args:
+        source (str) file path of the run to truncate
+        dest (str) file path to write the truncated run to (written atomically)
+        top (int) maximum rank to keep
+    """
+    tmp_dest = f'{dest}.tmp'
+    with open(source, 'rb') as fin, open(tmp_dest, 'wb') as fout:
+        skip_prefix = None
+        for line in fin:
+            if skip_prefix is not None and line.startswith(skip_prefix):
+                continue
+            cols = line.split(None, 4)
+            if not cols:
+                continue # blank line
+            qid, _, _, rank, _ = cols
+            if int(rank) <= top:
+                fout.write(line)
+                skip_prefix = None
+            else:
+                # includes the separator that follows the qid (a space or a tab)
+                skip_prefix = line[:len(qid) + 1]
+    os.replace(tmp_dest, dest)
+
+
 def read_sample_dict(file):
     result = {}
     for qid, _, docid, cat, rel in plaintext.read_sv(file, sep=' '):
@@ -198,6 +521,23 @@ def write_run_dict(file, run_dict, runid='run'):
     plaintext.write_sv(file, run_iter(), sep=' ')
 
 
+def write_run_queries(file, query_iter, runid='run'):
+    """
+    Writes the results of a batch search to the given file as they are produced
+
+    Args:
+        file (str|Stream) file path (str) or stream (Stream) to write to
+        query_iter (iter<tuple<str,list<str>,np.ndarray>>) (qid, dids, scores) of each query, with
+                   the documents of each query in rank order
+        runid (str, optional) run name to output (optional)
+    """
+    def run_iter():
+        for qid, dids, scores in query_iter:
+            for i, (docid, score) in enumerate(zip(dids, np.asarray(scores).tolist())):
+                yield qid, 'Q0', docid, i+1, score, runid
+    plaintext.write_sv(file, run_iter(), sep=' ')
+
+
 def write_run_dict_(run_dict, file, runid='run'):
     return write_run_dict(file, run_dict, runid)
 
@@ -20,8 +20,8 @@ class FallbackMetrics(_metrics.BaseMetrics):
         return False
 
     def calc_metrics(self,
-                     qrels: Union[str, dict],
-                     run: Union[str, dict],
+                     qrels: Union[str, dict, trec.QrelsTable],
+                     run: Union[str, dict, trec.RunTable],
                      metrics: Iterable[Union[str, _metrics.Metric]],
                      verbose: bool = False) -> dict:
         metrics = set(map(_metrics.Metric.parse, metrics))
@@ -58,7 +58,7 @@ class FallbackMetrics(_metrics.BaseMetrics):
             run.close()
 
     class FormatManager:
-        def __init__(self, item: Union[str, dict], to_dict: Callable[[TextIO], dict], to_file: Callable[[dict, TextIO], None]):
+        def __init__(self, item: Union[str, dict, trec.RunTable, trec.QrelsTable], to_dict: Callable[[TextIO], dict], to_file: Callable[[dict, TextIO], None]):
             self.item = item
             if isinstance(self.item, str):
                 self.file = self.item
@@ -66,6 +66,10 @@ class FallbackMetrics(_metrics.BaseMetrics):
             elif isinstance(self.item, dict):
                 self.file = None
                 self.dict = self.item
+            elif isinstance(self.item, (trec.RunTable, trec.QrelsTable)):
+                # converted to the format needed by each metric source on demand
+                self.file = None
+                self.dict = None
             else:
                 raise ValueError(f'unsupported format {type(item)}')
             self.tmp_file = None
@@ -77,13 +81,19 @@ class FallbackMetrics(_metrics.BaseMetrics):
                 return self.item
             if fmt == 'dict':
                 if self.dict is None:
-                    with open(self.file, 'rt') as f:
-                        self.dict = self.to_dict(f)
+                    if self.file is None:
+                        self.dict = self.item.to_dict()
+                    else:
+                        with open(self.file, 'rt') as f:
+                            self.dict = self.to_dict(f)
                 return self.dict
             if fmt == 'file':
                 if self.file is None:
                     self.tmp_file = NamedTemporaryFile('w+t')
-                    self.to_file(self.dict, self.tmp_file)
+                    if self.dict is None:
+                        self.item.save_file(self.tmp_file)
+                    else:
+                        self.to_file(self.dict, self.tmp_file)
                     self.file = self.tmp_file.name
                 return self.file
             raise ValueError(f'unsuported fmt={fmt}')
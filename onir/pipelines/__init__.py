@@ -10,3 +10,4 @@ from onir.pipelines.extract_bert_weights import ExtractBertWeights
 from onir.pipelines.epic_vectorize import EpicVectorize
 from onir.pipelines.tune_rerank_threshold import TuneRerankThreshold
 from onir.pipelines.epic_predict import EpicPredictionPipeline
+from onir.pipelines.compile_shards import CompileShardsPipeline
@@ -0,0 +1,28 @@
+from onir import pipelines
+
+
+@pipelines.register('compile_shards')
+class CompileShardsPipeline(pipelines.BasePipeline):
+    """
+    Resolves the trainer's training records for a number of epochs and writes them to binary
+    shards. Train with trainer.shards=True to read records from the shards, which avoids building
+    records on the fly and lets training resume at any epoch without fast-forwarding.
+    """
+    name = None
+
+    @staticmethod
+    def default_config():
+        return {
+            'epochs': 100,
+            'skip_ds_init': False,
+        }
+
+    def __init__(self, config, trainer, logger):
+        super().__init__(config, logger)
+        self.trainer = trainer
+
+    def run(self):
+        if not self.config['skip_ds_init']:
+            self.trainer.dataset.init(force=False)
+        self.trainer.compile_shards(self.config['epochs'])
+        self.logger.info('training shards written to {}'.format(self.trainer.shard_path()))
@@ -69,12 +69,9 @@ class GridSearchPipeline(pipelines.BasePipeline):
                 combo = '_'.join((default_rankfn,) + tuple(f'{k}-{v}' for k, v in combo))
                 pbar.set_description(combo)
 
+                # the dataset's record cache is cleared when rankfn changes
                 self.valid_pred.dataset.config['rankfn'] = combo
 
-                # gahhhhh, this screwed me up forever
-                if hasattr(self.valid_pred.dataset, '_record_cache'):
-                    self.valid_pred.dataset._record_cache.clear()
-
                 valid_ctxt = self.valid_pred.run(train_ctxt)
                 message = self._build_valid_msg(valid_ctxt, combo)
 
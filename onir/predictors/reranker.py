@@ -1,5 +1,6 @@
 import os
 import json
+import numpy as np
 import torch
 import onir
 from onir import util, spec, predictors, datasets
@@ -19,7 +20,10 @@ class Reranker(predictors.BasePredictor):
             'preload': False,
             'run_threshold': 0,
             'measures': 'map,ndcg,p@20,ndcg@20,mrr',
-            'source': 'run'
+            'source': 'run',
+            'data_workers': 0, # number of processes used to build batches (0 builds them in-process)
+            'bucket_by_length': False, # batch documents of similar lengths (uses doc_len; fast with the dataset's tokstore)
+            'bucket_window': 4096, # number of records sorted by length at a time with bucket_by_length
         }
 
     def __init__(self, config, ranker, trainer, dataset, vocab, logger, random):
@@ -31,26 +35,70 @@ class Reranker(predictors.BasePredictor):
         self.vocab = vocab
         self.random = random
         self.input_spec = ranker.input_spec()
+        self.batch_pool = None
+        if self.config['data_workers'] > 0:
+            fields = set(self.input_spec['fields']) | {'query_id', 'doc_id'}
+            self.batch_pool = datasets.BatchWorkerPool(dataset, fields, self.input_spec, self.config['data_workers'])
+        self.bucket_by_length = self.config['bucket_by_length']
+        if self.bucket_by_length and self.batch_pool is not None and not dataset.config.get('tokstore'):
+            # the lengths would need the documents to be fetched and tokenized here as well as in
+            # the data workers
+            self.logger.warn('bucket_by_length with data_workers needs the dataset\'s tokstore; not bucketing by length')
+            self.bucket_by_length = False
 
-    def _iter_batches(self, device):
+    def _iter_raw_batches(self):
         fields = set(self.input_spec['fields']) | {'query_id', 'doc_id'}
         it = datasets.record_iter(self.dataset,
-                                  fields=fields,
+                                  fields={'query_id', 'doc_id'},
                                   source=self.config['source'],
                                   run_threshold=self.config['run_threshold'],
                                   minrel=None,
                                   shuf=False,
                                   random=self.random,
                                   inf=False)
+        if self.bucket_by_length:
+            it = self._iter_length_bucketed(it, fields)
         for batch_items in util.chunked(it, self.config['batch_size']):
-            batch = {}
-            for record in batch_items:
-                for k, seq in record.items():
-                    batch.setdefault(k, []).append(seq)
-            batch = spec.apply_spec_batch(batch, self.input_spec, device)
-            # ship 'em
+            batch = {k: [r[k] for r in batch_items] for k in batch_items[0]}
+            missing_fields = fields - set(batch)
+            if self.batch_pool is None and missing_fields:
+                # build the records for the whole batch at once
+                records = self.dataset.build_records(missing_fields, zip(batch['query_id'], batch['doc_id']))
+                for f in missing_fields:
+                    batch[f] = [r[f] for r in records]
+            # (otherwise, the records are built by the worker processes)
             yield batch
 
+    def _iter_length_bucketed(self, it, fields):
+        # Reorders records by document length (longest first) within windows of bucket_window
+        # records, so that batches need less padding. Scores are re-grouped by query in iter_scores.
+        for window in util.chunked(it, self.config['bucket_window']):
+            pairs = [(r['query_id'], r['doc_id']) for r in window]
+            if self.batch_pool is None:
+                # the records are built once, both for their lengths and for the batches
+                records = self.dataset.build_records(fields | {'doc_len'}, pairs)
+                window = [{f: r[f] for f in fields} for r in records]
+            else:
+                # only the lengths (served by the tokstore); the data workers build the records
+                records = self.dataset.build_records({'doc_len'}, pairs)
+            lens = np.array([r['doc_len'] for r in records])
+            for i in np.argsort(-lens, kind='stable'):
+                yield window[i]
+
+    def _iter_batches(self, device):
+        batches = self._iter_raw_batches()
+        if self.batch_pool is None:
+            for batch in batches:
+                yield spec.apply_spec_batch(batch, self.input_spec, device, pin_memory=device.type == 'cuda')
+        else:
+            try:
+                for batch in self.batch_pool.imap(batches):
+                    # ship 'em
+                    yield {k: (v.to(device) if torch.is_tensor(v) else v) for k, v in batch.items()}
+            finally:
+                # the workers are started again for the next prediction run
+                self.batch_pool.close()
+
     def _preload_batches(self, device):
         with self.logger.duration('loading evaluation data'):
             batches = list(self.logger.pbar(self._iter_batches(device), desc='preloading eval data (batches)'))
@@ -98,16 +146,32 @@ class Reranker(predictors.BasePredictor):
                     total = sum(len(v) for v in self.dataset.run().values())
             elif self.config['source'] == 'qrels':
                 total = sum(len(v) for v in self.dataset.qrels().values())
+            # with bucket_by_length, records arrive out of order; scores are grouped by query and
+            # yielded at the end
+            by_query = {} if self.bucket_by_length else None
+            real_toks, padded_toks = 0, 0
             with self.logger.pbar_raw(total=total, desc='pred', quiet=True) as pbar:
                 for batch in util.background(ds):
                     batch = {k: (v.to(device) if torch.is_tensor(v) else v) for k, v in batch.items()}
                     rel_scores = self.ranker(**batch).cpu()
                     if len(rel_scores.shape) == 2:
                         rel_scores = rel_scores[:, 0]
+                    if 'doc_tok' in batch:
+                        real_toks += (batch['doc_tok'] != -1).sum().item()
+                        padded_toks += batch['doc_tok'].numel()
                     triples = list(zip(batch['query_id'], batch['doc_id'], rel_scores))
                     for qid, did, score in triples:
-                        yield qid, did, score.item()
+                        if by_query is None:
+                            yield qid, did, score.item()
+                        else:
+                            by_query.setdefault(qid, []).append((did, score.item()))
                     pbar.update(len(batch['query_id']))
+            if padded_toks > 0:
+                self.logger.info(f'doc_tok padding efficiency: {real_toks / padded_toks:.1%}')
+            if by_query is not None:
+                for qid, scores in by_query.items():
+                    for did, score in scores:
+                        yield qid, did, score
 
     def rerank_dict(self, ranker, device):
         datasource = self._reload_batches(device)
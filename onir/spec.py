@@ -1,7 +1,8 @@
+import numpy as np
 import torch
 
 
-def apply_spec_batch(batch, input_spec, device=None):
+def apply_spec_batch(batch, input_spec, device=None, pin_memory=False):
     result = {}
     for k in batch:
         result[k] = []
@@ -42,36 +43,53 @@ def apply_spec_batch(batch, input_spec, device=None):
             continue
 
         if seq_type in ('list[int]', 'list[float]'):
-            if len_mode == 'strict':
-                result[k] = [clip_crop(r, maxlen) for r in result[k]]
-            elif len_mode == 'max':
-                max_seq_len = min(maxlen, max(len(r) for r in result[k]))
-                result[k] = [clip_crop(r, max_seq_len) for r in result[k]]
-            elif len_mode == 'none':
-                pass
-            else:
-                raise ValueError(f'unkonwn len_mode {len_mode}')
-            if minlen is not None:
-                result[k] = [pad_min_len(r, minlen) for r in result[k]]
-
-        result[k] = torch.tensor(result[k])
-        if seq_type == 'list[float]':
-            result[k] = result[k].float()
-        elif seq_type == 'list[int]':
-            result[k] = result[k].long()
+            # sequences are copied directly into a padded buffer, which is shared with the tensor
+            dtype = np.int64 if seq_type == 'list[int]' else np.float32
+            result[k] = torch.from_numpy(padded_array(result[k], len_mode, maxlen, minlen, dtype))
+        else:
+            result[k] = torch.tensor(result[k])
+        if pin_memory:
+            result[k] = result[k].pin_memory()
         if device:
-            result[k] = result[k].to(device)
+            result[k] = result[k].to(device, non_blocking=pin_memory)
     return result
 
 
+def padded_array(seqs, len_mode, maxlen, minlen=None, dtype=np.int64, pad_val=-1):
+    """
+    Builds a 2D array from seqs (lists or numpy arrays), padded with pad_val. The width follows
+    len_mode: 'strict' (always maxlen), 'max' (longest sequence, up to maxlen), or 'none' (sequences
+    must all have the same length). Sequences are padded up to minlen (if given) in all modes.
+    """
+    lens = [len(seq) for seq in seqs]
+    if len_mode == 'strict':
+        width = maxlen
+    elif len_mode == 'max':
+        width = min(maxlen, max(lens))
+    elif len_mode == 'none':
+        padded_lens = {max(l, minlen or 0) for l in lens}
+        if len(padded_lens) > 1:
+            raise ValueError(f'sequences of different lengths with len_mode none: {sorted(padded_lens)}')
+        width = max(lens)
+    else:
+        raise ValueError(f'unkonwn len_mode {len_mode}')
+    cliplen = width # sequences are clipped before padding up to minlen
+    if minlen is not None:
+        width = max(width, minlen)
+    result = np.full((len(seqs), width), pad_val, dtype=dtype)
+    for i, seq in enumerate(seqs):
+        count = min(len(seq), cliplen)
+        result[i, :count] = seq[:count]
+    return result
+
 
 def clip_crop(seq, maxlen, pad_val=-1):
-    seq = seq[:maxlen] # clip
+    seq = list(seq[:maxlen]) # clip (seq may be a list or a numpy array)
     seq += [pad_val] * (maxlen - len(seq)) # pad
     return seq
 
 
 def pad_min_len(seq, min_len, pad_val=-1):
     if len(seq) < min_len:
-        seq += [pad_val] * (min_len - len(seq)) # pad
+        seq = list(seq) + [pad_val] * (min_len - len(seq)) # pad
     return seq
@@ -1,6 +1,11 @@
+import os
+import pickle
 from tqdm import tqdm
 import torch
-from onir import util, trainers
+from pytools import memoize_method
+import onir
+from onir import util, trainers, spec, datasets
+from onir.trainers import shards
 from onir.interfaces import apex
 
 
@@ -17,7 +22,9 @@ class Trainer:
             'lr': 0.001,
             'gpu': True,
             'gpu_determ': True,
-            'encoder_lr': 0.
+            'encoder_lr': 0.,
+            'data_workers': 0, # number of processes used to build batches (0 builds them in-process)
+            'shards': False, # read training records from shards written by the compile_shards pipeline
         }
 
     def __init__(self, config, ranker, vocab, train_ds, logger, random):
@@ -35,8 +42,19 @@ class Trainer:
             self.batch_size = self.config['grad_acc_batch']
 
         self.device = util.device(self.config, self.logger)
+        self.batch_pool = None
+        # snapshots of the sampler are taken at the end of each epoch
+        self.sampler_state = datasets.SamplerState(self.random, checkpoint_every=self.config['batches_per_epoch'] * self.config['batch_size'])
 
     def iter_train(self, only_cached=False):
+        try:
+            yield from self._iter_train(only_cached)
+        finally:
+            # runs once the caller stops iterating (or the generator is collected)
+            if self.batch_pool is not None:
+                self.batch_pool.close()
+
+    def _iter_train(self, only_cached):
         epoch = -1
         base_path = util.path_model_trainer(self.ranker, self.vocab, self, self.dataset)
         context = {
@@ -52,6 +70,7 @@ class Trainer:
         self.logger.info(f'train path: {base_path}')
 
         b_count = context['batches_per_epoch'] * context['num_microbatches'] * self.batch_size
+        skipped_records = 0
 
         ranker = self.ranker.to(self.device)
         optimizer = self.create_optimizer()
@@ -88,7 +107,11 @@ class Trainer:
                     'cached': True,
                 })
                 if not only_cached:
-                    self.fast_forward(b_count) # skip this epoch
+                    skipped_records += b_count # skip this epoch
+                    if epoch + 1 not in files['complete.tsv']:
+                        # last cached epoch; resume the sampler from its saved state if possible
+                        self._skip_records(files['sampler'][f'{epoch}.p'], skipped_records)
+                        skipped_records = 0
                 yield context
                 continue
 
@@ -169,6 +192,10 @@ class Trainer:
             # save stuff
             ranker.save(files['weights'][f'{epoch}.p'])
             torch.save(optimizer.state_dict(), files['optimizer'][f'{epoch}.p'])
+            sampler_state = self.sampler_state.pop_checkpoint((epoch + 1) * b_count)
+            if sampler_state is not None:
+                with open(files['sampler'][f'{epoch}.p'], 'wb') as f:
+                    pickle.dump(sampler_state, f)
             files['loss.txt'][epoch] = context['loss']
             for lname, lvalue in context['losses'].items():
                 files[f'loss_{lname}.txt'][epoch] = lvalue
@@ -210,10 +237,80 @@ class Trainer:
     def train_batch(self):
         raise NotImplementedError()
 
+    def _batch_worker_fields(self, fields):
+        # When using data workers, the training iterator only needs to provide the keys of each
+        # record; the remaining fields are built (and the input spec applied) by the workers.
+        if self.config['data_workers'] > 0:
+            self.batch_pool = datasets.BatchWorkerPool(self.dataset, fields, self.input_spec, self.config['data_workers'])
+            return {'query_id', 'doc_id'}
+        return fields
+
+    def _apply_spec_batches(self, batches):
+        if self.batch_pool is None:
+            for batch in batches:
+                yield spec.apply_spec_batch(batch, self.input_spec, self.device, pin_memory=self.device.type == 'cuda')
+        else:
+            for batch in self.batch_pool.imap(batches):
+                yield {k: (v.to(self.device) if torch.is_tensor(v) else v) for k, v in batch.items()}
+
+    def _train_iter(self, it):
+        if self.config['shards']:
+            return util.background(self._iter_shard_batches())
+        return util.background(self.iter_batches(it))
+
+    def _iter_shard_batches(self):
+        # records in the shards are already resolved, so they never go through the batch workers
+        for batch in self._shard_reader().iter_batches(self.batch_size):
+            yield spec.apply_spec_batch(batch, self.input_spec, self.device, pin_memory=self.device.type == 'cuda')
+
+    def shard_path(self):
+        return os.path.join(util.path_model_trainer(self.ranker, self.vocab, self, self.dataset), 'shards')
+
+    def _shard_group_size(self):
+        # number of values per field in each training record (None if records are not grouped)
+        return None
+
+    def _shard_meta(self):
+        return {
+            'records_per_epoch': self.config['batches_per_epoch'] * self.config['batch_size'],
+            'random_seed': onir.config.args()['random_seed'],
+            'group_size': self._shard_group_size(),
+            'field_names': sorted(self.iter_fields),
+        }
+
+    @memoize_method
+    def _shard_reader(self):
+        return shards.ShardReader(self.shard_path(), self._shard_meta())
+
+    def compile_shards(self, epochs):
+        if self.batch_pool is not None:
+            raise ValueError('compile_shards does not support data_workers')
+        meta = self._shard_meta()
+        count = epochs * meta['records_per_epoch']
+        shards.compile_shards(self.shard_path(), self.train_iter_core, count, self.input_spec, meta['group_size'], meta, self.logger)
+
+    def _skip_records(self, sampler_path, record_count):
+        if not self.config['shards'] and os.path.exists(sampler_path):
+            with open(sampler_path, 'rb') as f:
+                state = pickle.load(f)
+            if state['count'] == record_count:
+                self.sampler_state.load_state_dict(state)
+                return
+            self.logger.warn(f'sampler state at {sampler_path} is at record {state["count"]} (expected {record_count}); fast-forwarding instead')
+        elif not self.config['shards']:
+            # samplers that do not track their state (e.g., sampler_engine=numpy) save no snapshot
+            self.logger.info(f'no sampler state at {sampler_path}; fast-forwarding {record_count} records instead')
+        self.fast_forward(record_count)
+
     def fast_forward(self, record_count):
         raise NotImplementedError()
 
     def _fast_forward(self, train_it, fields, record_count):
+        if self.config['shards']:
+            # records have a fixed size in the shards, so we can seek directly to the position
+            reader = self._shard_reader()
+            reader.seek(reader.cursor + record_count)
+            return
         # Since the train_it holds a refernece to fields, we can greatly speed up the "fast forward"
         # process by temporarily clearing the requested fields (meaning that the train iterator
         # should simply find the records/pairs to return, but yield an empty payload).
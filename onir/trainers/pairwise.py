@@ -2,7 +2,7 @@ import sys
 import torch
 import torch.nn.functional as F
 import onir
-from onir import trainers, spec, util
+from onir import trainers
 
 
 @trainers.register('pairwise')
@@ -19,6 +19,7 @@ class PairwiseTrainer(trainers.Trainer):
             'unjudged_rel': 0,
             'num_neg': 1,
             'margin': 0.,
+            'sampler_engine': onir.config.Choices(['pandas', 'numpy']),
         })
         return result
 
@@ -33,6 +34,7 @@ class PairwiseTrainer(trainers.Trainer):
         self.dataset = train_ds
         self.input_spec = ranker.input_spec()
         self.iter_fields = self.input_spec['fields'] | {'runscore'}
+        self.iter_fields = self._batch_worker_fields(self.iter_fields)
         self.train_iter_core = onir.datasets.pair_iter(
             train_ds,
             fields=self.iter_fields,
@@ -43,8 +45,10 @@ class PairwiseTrainer(trainers.Trainer):
             unjudged_rel=self.config['unjudged_rel'],
             num_neg=self.config['num_neg'],
             random=self.random,
-            inf=True)
-        self.train_iter = util.background(self.iter_batches(self.train_iter_core))
+            inf=True,
+            engine=self.config['sampler_engine'],
+            sampler_state=self.sampler_state)
+        self.train_iter = self._train_iter(self.train_iter_core)
         self.numneg = config['num_neg']
 
     def path_segment(self):
@@ -61,11 +65,16 @@ class PairwiseTrainer(trainers.Trainer):
         if loss == 'hinge':
             loss += '-{margin}'.format(**self.config)
         result = 'pairwise_{path}_{loss}_{pos}_{neg}'.format(**self.config, loss=loss, pos=pos, neg=neg, path=path)
+        if self.config['sampler_engine'] != 'pandas':
+            result += '_sampler-{sampler_engine}'.format(**self.config)
         if self.config['gpu'] and not self.config['gpu_determ']:
             result += '_nondet'
         return result
 
     def iter_batches(self, it):
+        return self._apply_spec_batches(self._iter_raw_batches(it))
+
+    def _iter_raw_batches(self, it):
         while True: # breaks on StopIteration
             input_data = {}
             for _, record in zip(range(self.batch_size), it):
@@ -73,7 +82,6 @@ class PairwiseTrainer(trainers.Trainer):
                     assert len(v) == self.numneg + 1
                     for seq in v:
                         input_data.setdefault(k, []).append(seq)
-            input_data = spec.apply_spec_batch(input_data, self.input_spec, self.device)
             yield input_data
 
     def train_batch(self):
@@ -95,6 +103,9 @@ class PairwiseTrainer(trainers.Trainer):
             'unsup_acc': self.acc(run_scores_by_record)
         }
 
+    def _shard_group_size(self):
+        return self.numneg + 1
+
     def fast_forward(self, record_count):
         self._fast_forward(self.train_iter_core, self.iter_fields, record_count)
 
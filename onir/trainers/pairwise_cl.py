@@ -2,7 +2,7 @@ import sys
 import torch
 import torch.nn.functional as F
 import onir
-from onir import trainers, spec, util
+from onir import trainers
 
 
 @trainers.register('pairwise-cl')
@@ -25,6 +25,7 @@ class PairwiseClTrainer(trainers.Trainer):
             'unjudged_rel': 0,
             'num_neg': 1,
             'margin': 0.,
+            'sampler_engine': onir.config.Choices(['pandas', 'numpy']),
             'curriculum': onir.config.Choices(['reciprank', 'kdescore', 'normscore']),
             'eoc_epoch': 20,
             'anti': False,
@@ -48,6 +49,7 @@ class PairwiseClTrainer(trainers.Trainer):
             self.iter_fields = self.iter_fields | {'kdescore'}
         if self.config['curriculum'] == 'normscore':
             self.iter_fields = self.iter_fields | {'normscore'}
+        self.iter_fields = self._batch_worker_fields(self.iter_fields)
         self.train_iter_core = onir.datasets.pair_iter(
             train_ds,
             fields=self.iter_fields,
@@ -58,8 +60,10 @@ class PairwiseClTrainer(trainers.Trainer):
             unjudged_rel=self.config['unjudged_rel'],
             num_neg=self.config['num_neg'],
             random=self.random,
-            inf=True)
-        self.train_iter = util.background(self.iter_batches(self.train_iter_core))
+            inf=True,
+            engine=self.config['sampler_engine'],
+            sampler_state=self.sampler_state)
+        self.train_iter = self._train_iter(self.train_iter_core)
         self.numneg = config['num_neg']
         self.notified_end_of_curriculum = False
 
@@ -79,11 +83,16 @@ class PairwiseClTrainer(trainers.Trainer):
         result = 'pairwise-cl_{path}_{loss}_{pos}_{neg}_{curriculum}-{eoc_epoch}'.format(**self.config, loss=loss, pos=pos, neg=neg, path=path)
         if self.config['anti']:
             result += '-anti'
+        if self.config['sampler_engine'] != 'pandas':
+            result += '_sampler-{sampler_engine}'.format(**self.config)
         if self.config['gpu'] and not self.config['gpu_determ']:
             result += '_nondet'
         return result
 
     def iter_batches(self, it):
+        return self._apply_spec_batches(self._iter_raw_batches(it))
+
+    def _iter_raw_batches(self, it):
         while True: # breaks on StopIteration
             input_data = {}
             for _, record in zip(range(self.batch_size), it):
@@ -91,7 +100,6 @@ class PairwiseClTrainer(trainers.Trainer):
                     assert len(v) == self.numneg + 1
                     for seq in v:
                         input_data.setdefault(k, []).append(seq)
-            input_data = spec.apply_spec_batch(input_data, self.input_spec, self.device)
             yield input_data
 
     def train_batch(self):
@@ -158,6 +166,9 @@ class PairwiseClTrainer(trainers.Trainer):
             'unsup_acc': self.acc(run_scores_by_record)
         }
 
+    def _shard_group_size(self):
+        return self.numneg + 1
+
     def fast_forward(self, record_count):
         self._fast_forward(self.train_iter_core, self.iter_fields, record_count)
 
@@ -1,7 +1,7 @@
 import sys
 import torch
 import torch.nn.functional as F
-from onir import trainers, spec, datasets
+from onir import trainers, datasets
 
 
 @trainers.register('pointwise')
@@ -21,14 +21,16 @@ class PointwiseTrainer(trainers.Trainer):
         self.dataset = train_ds
         self.input_spec = ranker.input_spec()
         self.iter_fields = self.input_spec['fields'] | {'relscore'}
+        self.iter_fields = self._batch_worker_fields(self.iter_fields)
         self.train_iter_core = datasets.record_iter(train_ds,
                                                     fields=self.iter_fields,
                                                     source=self.config['source'],
                                                     minrel=None if self.config['minrel'] == -999 else self.config['minrel'],
                                                     shuf=True,
                                                     random=self.random,
-                                                    inf=True)
-        self.train_iter = self.iter_batches(self.train_iter_core)
+                                                    inf=True,
+                                                    sampler_state=self.sampler_state)
+        self.train_iter = self._train_iter(self.train_iter_core)
 
     def path_segment(self):
         path = super().path_segment()
@@ -42,12 +44,14 @@ class PointwiseTrainer(trainers.Trainer):
         return result
 
     def iter_batches(self, it):
+        return self._apply_spec_batches(self._iter_raw_batches(it))
+
+    def _iter_raw_batches(self, it):
         while True: # breaks on StopIteration
             input_data = {}
             for _, record in zip(range(self.batch_size), it):
                 for k, seq in record.items():
                     input_data.setdefault(k, []).append(seq)
-            input_data = spec.apply_spec_batch(input_data, self.input_spec, self.device)
             yield input_data
 
     def train_batch(self):
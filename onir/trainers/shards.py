@@ -0,0 +1,119 @@
+import os
+import json
+import itertools
+import shutil
+import numpy as np
+
+
+SHARD_VERSION = 1
+
+
+def compile_shards(path, records, count, input_spec, group_size, meta, logger):
+    """
+    Writes the first count training records from records to fixed-size binary arrays in path (one
+    .npy file per field, with an extra .len.npy file for sequence fields).
+
+    Sequences are clipped to the maximum length from input_spec and padded with -1. Each record
+    holds group_size values per field (e.g., the positive and negative documents of a training
+    pair), or a single value if group_size is None.
+    """
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    arrays, lens, fields = {}, {}, {}
+    with logger.duration(f'compiling {count} training records to {path}'):
+        written = 0
+        for i, record in enumerate(logger.pbar(itertools.islice(records, count), desc='compiling shards', total=count)):
+            if i == 0:
+                for field, value in record.items():
+                    value = value[0] if group_size is not None else value
+                    fields[field] = _field_info(field, value, input_spec)
+                    shape = (count, group_size or 1)
+                    if fields[field]['kind'] == 'seq':
+                        shape += (fields[field]['width'],)
+                        lens[field] = np.lib.format.open_memmap(os.path.join(tmp_path, f'{field}.len.npy'), mode='w+', dtype=np.int32, shape=shape[:2])
+                    arrays[field] = np.lib.format.open_memmap(os.path.join(tmp_path, f'{field}.npy'), mode='w+', dtype=fields[field]['dtype'], shape=shape)
+            for field, values in record.items():
+                if group_size is None:
+                    values = [values]
+                if field in lens:
+                    for g, seq in enumerate(values):
+                        width = min(len(seq), fields[field]['width'])
+                        arrays[field][i, g, :width] = seq[:width]
+                        arrays[field][i, g, width:] = -1
+                        lens[field][i, g] = width
+                else:
+                    arrays[field][i] = values
+            written += 1
+        if written < count:
+            raise ValueError(f'training records exhausted after {written} records (expected {count})')
+        for array in list(arrays.values()) + list(lens.values()):
+            array.flush()
+        del arrays, lens
+        # meta is written last; its presence indicates that the shards are complete
+        with open(os.path.join(tmp_path, 'meta.json'), 'wt') as f:
+            json.dump({'version': SHARD_VERSION, 'count': count, 'group_size': group_size, 'fields': fields, **meta}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+
+def _field_info(field, value, input_spec):
+    if field.endswith('_tok') or field.endswith('_idf') or field.endswith('_score'):
+        width = input_spec['qlen'] if field.startswith('query_') else input_spec['dlen']
+        if input_spec['qlen_mode' if field.startswith('query_') else 'dlen_mode'] == 'none':
+            raise ValueError(f'training shards do not support len_mode none (for {field})')
+        dtype = 'int32' if field.endswith('_tok') else 'float32'
+        return {'kind': 'seq', 'dtype': dtype, 'width': width}
+    if isinstance(value, (int, np.integer)):
+        return {'kind': 'scalar', 'dtype': 'int64'}
+    if isinstance(value, (float, np.floating)):
+        return {'kind': 'scalar', 'dtype': 'float32'}
+    raise ValueError(f'field {field} cannot be stored in training shards')
+
+
+class ShardReader:
+    """
+    Reads training records from shards written by compile_shards. Since all records have a fixed
+    size, seeking to any position (e.g., the start of an epoch) is O(1).
+    """
+    def __init__(self, path, expected_meta):
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f'training shards not found at {path}; run the compile_shards pipeline first')
+        with open(meta_path, 'rt') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SHARD_VERSION:
+            raise ValueError(f'unsupported training shard version {self.meta["version"]} at {path}')
+        for key, value in expected_meta.items():
+            if self.meta.get(key) != value:
+                raise ValueError(f'training shards at {path} have {key}={self.meta.get(key)} (expected {value}); re-run compile_shards')
+        self.arrays = {f: np.load(os.path.join(path, f'{f}.npy'), mmap_mode='r') for f in self.meta['fields']}
+        self.lens = {f: np.load(os.path.join(path, f'{f}.len.npy'), mmap_mode='r') for f, info in self.meta['fields'].items() if info['kind'] == 'seq'}
+        self.cursor = 0
+
+    def seek(self, record):
+        self.cursor = record
+
+    def iter_batches(self, batch_size):
+        """
+        Yields batches of batch_size records (flattened across each record's group) from the
+        current position, in the same format as the trainers' iter_batches.
+        """
+        while True:
+            start, end = self.cursor, self.cursor + batch_size
+            if end > self.meta['count']:
+                raise ValueError(f'training shards exhausted at record {start} ({self.meta["count"]} compiled); '
+                                 're-run compile_shards with more epochs')
+            self.cursor = end
+            batch = {}
+            for field, array in self.arrays.items():
+                values = array[start:end]
+                if field in self.lens:
+                    values = values.reshape(-1, values.shape[-1])
+                    lens = self.lens[field][start:end].reshape(-1)
+                    batch[field] = [row[:l] for row, l in zip(values, lens)]
+                else:
+                    batch[field] = values.reshape(-1)
+            yield batch
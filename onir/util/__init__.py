@@ -17,9 +17,10 @@ from tqdm import tqdm
 import numpy as np
 from scipy.stats import gaussian_kde
 from onir import config, log
-from onir.util.concurrency import safe_thread_count, blocking_tee, background, CtxtThread, iter_noop, Lazy
+from onir.util.concurrency import safe_thread_count, blocking_tee, background, fan_out, FanOut, FanOutCancelled, CtxtThread, iter_noop, Lazy
 from onir.util.download import download, download_stream, download_iter, download_if_needed, download_tmp
 from onir.util.matheval import matheval
+from onir.util.cache import LruCache
 
 
 
@@ -0,0 +1,67 @@
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class LruCache:
+    """
+    Least-recently-used cache bounded by the (approximate) number of bytes of the values it holds.
+    Keeps hit/miss counts. Safe to use from multiple threads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fn):
+        """
+        Returns the value cached for key, or computes (and caches) it with fn().
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+        value = fn()
+        size = sizeof(value)
+        if size <= self.max_bytes:
+            with self._lock:
+                if key not in self._data:
+                    self._data[key] = (value, size)
+                    self.nbytes += size
+                    while self.nbytes > self.max_bytes:
+                        _, (_, evicted_size) = self._data.popitem(last=False)
+                        self.nbytes -= evicted_size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.
+        return f'{len(self)} items ({self.nbytes // 1024}KB), {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)'
+
+
+def sizeof(value):
+    """
+    Approximate size of value in bytes (including the contents of lists and tuples).
+    """
+    if isinstance(value, np.ndarray):
+        return sys.getsizeof(value) # includes the data of arrays that own it
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
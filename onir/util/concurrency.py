@@ -1,9 +1,12 @@
 import os
-from typing import Tuple, Iterable
-from threading import Thread, Event, Lock
+import time
+from collections import deque
+from typing import Tuple, Iterable, Callable, List
+from threading import Thread, Event, Lock, Condition
+from onir.util.cache import sizeof
 
 
-__all__ = ['safe_thread_count', 'blocking_tee', 'background']
+__all__ = ['safe_thread_count', 'blocking_tee', 'background', 'fan_out', 'FanOut', 'FanOutCancelled']
 
 
 def safe_thread_count(pct=0.8):
@@ -29,6 +32,182 @@ def background(it: Iterable) -> Iterable:
     return blocking_tee(it, n=1)[0]
 
 
+def fan_out(it: Iterable, fns: List[Callable], max_items: int = 1024, max_bytes: int = None, logger=None) -> None:
+    """
+    Runs each of fns in its own thread with an iterator over the items of it (see FanOut), and waits
+    for them to finish. Throughput and backpressure statistics are logged to logger (if provided).
+    """
+    fanout = FanOut(it, len(fns), max_items=max_items, max_bytes=max_bytes)
+    try:
+        fanout.run(fns)
+    finally:
+        if logger is not None:
+            for i, stats in enumerate(fanout.stats()):
+                logger.debug(f'fan-out consumer {i}: {stats["items"]} items ({stats["items_per_sec"]:.1f}/s), '
+                             f'waited {stats["starved"]:.1f}s for items, blocked producer for {stats["backpressure"]:.1f}s')
+
+
+class FanOutCancelled(Exception):
+    pass
+
+
+class FanOut:
+    """
+    Distributes the items of an iterator to n consumers (self.iters). Unlike blocking_tee, each
+    consumer has its own bounded buffer (of at most max_items items, and max_bytes bytes if
+    provided), so a fast consumer can run ahead of a slow one until the slow one's buffer is full.
+
+    An exception raised by the iterator is re-raised in every consumer. After cancel(), the producer
+    stops and consumers raise FanOutCancelled. Consumers that are closed (e.g., that stop early) no
+    longer receive items, and the producer stops once all consumers are closed.
+    """
+    def __init__(self, it: Iterable, n: int, max_items: int = 1024, max_bytes: int = None, sizefn: Callable = sizeof):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizefn = sizefn
+        self._it = iter(it)
+        self._cond = Condition()
+        self._buffers = [_FanOutBuffer() for _ in range(n)]
+        self._error = None
+        self._done = False
+        self._cancelled = False
+        self._thread = Thread(target=self._produce, daemon=True)
+        self._start_lock = Lock()
+        self._started = None
+        self.iters = tuple(self._consume(buf) for buf in self._buffers)
+
+    def run(self, fns: List[Callable]) -> None:
+        """
+        Runs fn(iter) for each consumer in its own thread and waits for all of them. If any raises
+        an exception, the fan-out is cancelled and the exception is re-raised here.
+        """
+        errors = []
+        def _target(fn, it, buf):
+            try:
+                fn(it)
+            except FanOutCancelled:
+                pass
+            except Exception as ex:
+                errors.append(ex)
+                self.cancel()
+            finally:
+                # the consumer may not have exhausted (or even started) its iterator
+                it.close()
+                self._close(buf)
+        threads = [Thread(target=_target, args=(fn, it, buf)) for fn, it, buf in zip(fns, self.iters, self._buffers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def cancel(self) -> None:
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def stats(self) -> List[dict]:
+        """
+        Per-consumer statistics: items consumed, throughput, time spent waiting for the producer
+        (starved), and time the producer spent blocked on the consumer's full buffer (backpressure).
+        """
+        result = []
+        with self._cond:
+            for buf in self._buffers:
+                elapsed = ((buf.end or time.time()) - self._started) if self._started else 0.
+                result.append({
+                    'items': buf.count,
+                    'items_per_sec': buf.count / elapsed if elapsed > 0 else 0.,
+                    'starved': buf.starved,
+                    'backpressure': buf.backpressure,
+                    'buffered': len(buf.items),
+                })
+        return result
+
+    def _start_if_needed(self):
+        with self._start_lock:
+            if self._started is None:
+                self._started = time.time()
+                self._thread.start()
+
+    def _produce(self):
+        try:
+            for item in self._it:
+                size = self.sizefn(item) if self.max_bytes is not None else 0
+                with self._cond:
+                    for buf in self._buffers:
+                        if buf.full(self.max_items, self.max_bytes) and not buf.closed and not self._cancelled:
+                            start = time.time()
+                            while buf.full(self.max_items, self.max_bytes) and not buf.closed and not self._cancelled:
+                                self._cond.wait()
+                            buf.backpressure += time.time() - start
+                        if self._cancelled:
+                            return
+                        if not buf.closed:
+                            buf.items.append((item, size))
+                            buf.nbytes += size
+                    self._cond.notify_all()
+                    if all(buf.closed for buf in self._buffers):
+                        return
+        except Exception as ex:
+            with self._cond:
+                self._error = ex
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _consume(self, buf):
+        self._start_if_needed()
+        try:
+            while True:
+                with self._cond:
+                    if not buf.items and not self._done and not self._cancelled:
+                        start = time.time()
+                        while not buf.items and not self._done and not self._cancelled:
+                            self._cond.wait()
+                        buf.starved += time.time() - start
+                    if self._cancelled:
+                        raise FanOutCancelled()
+                    if not buf.items:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    item, size = buf.items.popleft()
+                    buf.nbytes -= size
+                    buf.count += 1
+                    self._cond.notify_all()
+                yield item
+        finally:
+            self._close(buf)
+
+    def _close(self, buf):
+        with self._cond:
+            if not buf.closed:
+                buf.closed = True
+                buf.end = time.time()
+                buf.items.clear()
+                self._cond.notify_all()
+
+
+class _FanOutBuffer:
+    def __init__(self):
+        self.items = deque()
+        self.nbytes = 0
+        self.closed = False
+        self.count = 0
+        self.starved = 0.
+        self.backpressure = 0.
+        self.end = None
+
+    def full(self, max_items, max_bytes):
+        if len(self.items) >= max_items:
+            return True
+        # a single item larger than max_bytes is still accepted by an empty buffer
+        return max_bytes is not None and self.items and self.nbytes >= max_bytes
+
+
 class CtxtThread(Thread):
     def __init__(self, fn):
         super().__init__(target=fn)
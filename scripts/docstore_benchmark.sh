@@ -0,0 +1 @@
+python -m onir.bin.docstore_benchmark "$@"
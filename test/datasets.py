@@ -0,0 +1,311 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+import itertools
+import numpy as np
+import pandas as pd
+from onir import datasets, log, spec, util
+from onir.datasets.pair_iter import pair_iter_sample_numpy, _sample_without_replacement
+from onir.datasets.record_iter import record_iter_sample
+from onir.interfaces import trec
+
+
+RUN_LINES = [
+    'q1 Q0 d1 1 12.5 run',
+    'q1 Q0 d2 2 11.0 run',
+    'q1 Q0 d4 3 11.0 run', # tied with d2; the larger doc_id is ranked first
+    'q1 Q0 d3 4 -2.25 run',
+    'q1 Q0 d5 5 -8.0 run',
+    'q2 Q0 d2 1 0.9 run',
+    'q2 Q0 d6 2 0.3 run',
+    'q2 Q0 d1 3 0.25 run',
+    'q3 Q0 d1 1 1e3 run',
+    'q3 Q0 d4 2 -1e3 run',
+]
+
+
+INPUT_SPEC = {'qlen': 3, 'dlen': 4, 'qlen_mode': 'strict', 'dlen_mode': 'max'}
+
+
+class TestDatasets(unittest.TestCase):
+
+    def test_run_scores(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = os.path.join(tmpdir, 'run')
+            with open(run_path, 'wt') as f:
+                for line in RUN_LINES:
+                    f.write(f'{line}\n')
+            run = trec.read_run_dict(run_path)
+            scores = datasets.RunScores.build(trec.read_run_arrays(run_path))
+            for qid, docs in run.items():
+                # the per-query computations that RunScores replaces
+                kde_cdf = util.kde_cdf_from_run(docs)
+                mx, mn = max(docs.values()), min(docs.values())
+                sorted_docs = sorted(docs.items(), key=lambda x: (x[1], x[0]), reverse=True)
+                ranks = {did: rank+1 for rank, (did, score) in enumerate(sorted_docs)}
+                for did, score in docs.items():
+                    with self.subTest(qid=qid, did=did):
+                        self.assertEqual(scores.rank(qid, did), ranks[did])
+                        self.assertAlmostEqual(scores.normscore(qid, score), (score - mn) / (mx - mn))
+                        self.assertAlmostEqual(scores.kdescore(qid, score), kde_cdf(score).item(), delta=1e-3)
+                # also between and beyond the scores of the query
+                for score in np.linspace(mn - (mx - mn), mx + (mx - mn), 41):
+                    with self.subTest(qid=qid, score=score):
+                        self.assertAlmostEqual(scores.kdescore(qid, score), kde_cdf(score).item(), delta=1e-3)
+                self.assertEqual(scores.rank(qid, 'missing'), 1000)
+            self.assertEqual(scores.rank('q1', 'd4'), 2)
+
+    def test_run_scores_cache(self):
+        logger = mock.MagicMock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = os.path.join(tmpdir, 'run')
+            with open(run_path, 'wt') as f:
+                for line in RUN_LINES:
+                    f.write(f'{line}\n')
+            with mock.patch.object(datasets.RunScores, 'build', wraps=datasets.RunScores.build) as build:
+                built = datasets.RunScores.load_or_build(run_path, logger)
+                self.assertTrue(os.path.exists(f'{run_path}.scores.npz'))
+                self.assertFalse(os.path.exists(f'{run_path}.scores.npz.tmp'))
+                loaded = datasets.RunScores.load_or_build(run_path, logger)
+                self.assertEqual(build.call_count, 1) # from the cache
+                self.assertEqual((loaded.qids, loaded.dids), (built.qids, built.dids))
+                for key in ['offsets', 'ranked_doc_codes', 'mins', 'maxs', 'kde_bounds', 'kde_cdf']:
+                    np.testing.assert_array_equal(getattr(loaded, key), getattr(built, key))
+                for line in RUN_LINES:
+                    qid, _, did, _, score, _ = line.split()
+                    self.assertEqual(loaded.rank(qid, did), built.rank(qid, did))
+                    self.assertEqual(loaded.kdescore(qid, float(score)), built.kdescore(qid, float(score)))
+
+                # a changed run is re-read
+                with open(run_path, 'at') as f:
+                    f.write('q4 Q0 d1 1 1.0 run\n')
+                self.assertEqual(datasets.RunScores.load_or_build(run_path, logger).rank('q4', 'd1'), 1)
+                self.assertEqual(build.call_count, 2)
+
+    def test_batch_worker_pool(self):
+        dataset = _BatchDataset({'scale': 2.}, log.Logger('test'), _BatchVocab({}, log.Logger('test')))
+        fields = {'query_id', 'doc_id', 'query_tok', 'doc_tok', 'doc_len', 'runscore'}
+        batches = [{
+            'query_id': [f'q{i}', f'q{i}'],
+            'doc_id': [f'd{i}-{"x" * (i % 5)}', f'd{i}'],
+            'runscore': [float(i), -float(i)], # provided with the batch, so kept as-is
+        } for i in range(12)]
+        # workers read the repository's default configuration rather than the test runner's argv
+        with mock.patch.dict(os.environ, {'ONIR_IGNORE_ARGV': 'true'}), \
+             mock.patch('onir.config.args', return_value={'random_seed': '42'}):
+            pool = datasets.BatchWorkerPool(dataset, fields, INPUT_SPEC, workers=3, prefetch=4)
+            try:
+                for scale in [2., 3.]:
+                    # config changes (e.g., during a grid search) reach the workers
+                    dataset.config['scale'] = scale
+                    results = list(pool.imap(iter(batches)))
+                    self.assertEqual(len(results), len(batches))
+                    for batch, result in zip(batches, results):
+                        records = dataset.build_records(fields - set(batch), zip(batch['query_id'], batch['doc_id']))
+                        expected = spec.apply_spec_batch({f: (batch[f] if f in batch else [r[f] for r in records]) for f in fields}, INPUT_SPEC)
+                        self.assertEqual(set(result), fields)
+                        for field in fields:
+                            with self.subTest(scale=scale, query_id=batch['query_id'][0], field=field):
+                                self.assertEqual(_tolist(result[field]), _tolist(expected[field]))
+            finally:
+                pool.close()
+
+    def test_sampler_resume(self):
+        dataset = _SamplerDataset()
+        cand = dataset.qrels('df')[['qid', 'did']]
+        pos = dataset.qrels('df')[dataset.qrels('df')['score'] >= 1]
+        samplers = {
+            **{f'record_iter_sample(shuf={shuf}, inf={inf})': (lambda shuf, inf: lambda random, state:
+                   record_iter_sample(dataset, cand, shuf, random, inf, sampler_state=state))(shuf, inf)
+               for shuf in [True, False] for inf in [True, False]},
+            **{f'pair_iter(sampling={sampling}, inf={inf})': (lambda sampling, inf: lambda random, state:
+                   datasets.pair_iter(dataset, {'query_id', 'doc_id'}, pos_source='qrels', neg_source='union',
+                                      sampling=sampling, random=random, inf=inf, sampler_state=state))(sampling, inf)
+               for sampling in ['query', 'qrel'] for inf in [True, False]},
+        }
+        for name, sampler in samplers.items():
+            # inf=False runs out after a single pass (at most len(cand) records)
+            for count in [0, 1, 5, 12, 29, 45, 100]:
+                with self.subTest(sampler=name, count=count):
+                    state = datasets.SamplerState(np.random.RandomState(42))
+                    records = list(itertools.islice(sampler(state.random, state), 150))
+                    if count > len(records):
+                        continue
+                    state = datasets.SamplerState(np.random.RandomState(42))
+                    it = sampler(state.random, state)
+                    self.assertEqual(list(itertools.islice(it, count)), records[:count])
+                    saved = state.state_dict()
+                    self.assertEqual(saved['count'], count)
+                    # resumed with a different random state, which is restored from the saved one
+                    resumed = datasets.SamplerState(np.random.RandomState(1))
+                    resumed.load_state_dict(saved)
+                    self.assertEqual(list(itertools.islice(sampler(resumed.random, resumed), 150 - count)), records[count:])
+
+    def test_record_iter_resume(self):
+        # record_iter builds records in chunks (so runs ahead of its consumer); it is resumed from
+        # the snapshot taken when the consumer reached the checkpoint
+        dataset = _SamplerDataset()
+        for shuf, inf in [(True, True), (False, True), (True, False)]:
+            with self.subTest(shuf=shuf, inf=inf):
+                state = datasets.SamplerState(np.random.RandomState(42), checkpoint_every=7)
+                it = datasets.record_iter(dataset, {'query_id', 'doc_id'}, 'qrels', shuf=shuf, random=state.random, inf=inf, sampler_state=state)
+                records = list(itertools.islice(it, 100))
+                resumed = datasets.SamplerState(np.random.RandomState(1))
+                resumed.load_state_dict(state.checkpoints[14])
+                it = datasets.record_iter(dataset, {'query_id', 'doc_id'}, 'qrels', shuf=shuf, random=resumed.random, inf=inf, sampler_state=resumed)
+                self.assertEqual(list(itertools.islice(it, 86)), records[14:])
+
+    def test_pair_iter_sample_numpy(self):
+        dataset = _SamplerDataset()
+        rng = np.random.RandomState(0)
+        neg = pd.DataFrame([(f'q{q}', f'd{d}', int(rng.randint(0, 4))) for q in range(6) for d in rng.choice(40, 15, replace=False)],
+                           columns=['qid', 'did', 'score'])
+        # q6's positive has only one lower-scored negative (the others are tied with it)
+        neg = pd.concat([neg, pd.DataFrame([('q6', 'd0', 2), ('q6', 'd1', 1), ('q6', 'd2', 2), ('q6', 'd3', 2)], columns=['qid', 'did', 'score'])],
+                        ignore_index=True)
+        pos_minrel = 2
+        pos = neg[neg['score'] >= pos_minrel]
+        scores = {(qid, did): score for qid, did, score in neg.itertuples(index=False)}
+        num_negs = {(qid, did): ((neg['qid'] == qid) & (neg['score'] < score)).sum() for qid, did, score in pos.itertuples(index=False)}
+        for sampling in ['query', 'qrel']:
+            for num_neg in [1, 2, 3]:
+                for inf in [True, False]:
+                    with self.subTest(sampling=sampling, num_neg=num_neg, inf=inf):
+                        it = pair_iter_sample_numpy(dataset, pos, neg, sampling, num_neg, np.random.RandomState(42), inf)
+                        pairs = list(itertools.islice(it, 2000)) # terminates with inf=False
+                        if inf:
+                            self.assertEqual(len(pairs), 2000)
+                        for qid, dids in pairs:
+                            pos_did, neg_dids = dids[0], dids[1:]
+                            self.assertGreaterEqual(scores[qid, pos_did], pos_minrel)
+                            self.assertEqual(len(neg_dids), num_neg)
+                            self.assertEqual(len(set(neg_dids)), num_neg)
+                            for did in neg_dids:
+                                self.assertIn((qid, did), scores) # from the same query
+                                self.assertLess(scores[qid, did], scores[qid, pos_did])
+                        sampled = [(qid, dids[0]) for qid, dids in pairs]
+                        # positives without enough negatives are skipped
+                        self.assertEqual({key for key in sampled if num_negs[key] < num_neg}, set())
+                        if not inf:
+                            if sampling == 'qrel':
+                                # each positive with enough negatives, once
+                                self.assertEqual(sorted(sampled), sorted(key for key, count in num_negs.items() if count >= num_neg))
+                            else:
+                                # at most one positive per query
+                                self.assertEqual(len({qid for qid, _ in sampled}), len(sampled))
+                        elif num_neg == 1:
+                            self.assertIn(('q6', 'd0'), sampled)
+
+    def test_sample_without_replacement(self):
+        random = np.random.RandomState(0)
+        counts = np.array([3, 4, 5, 10, 100] * 200)
+        for k in [1, 2, 3]:
+            result = _sample_without_replacement(counts, k, random)
+            self.assertEqual(result.shape, (len(counts), k))
+            self.assertTrue(((result >= 0) & (result < counts.reshape(-1, 1))).all())
+            self.assertTrue((np.sort(result, axis=1)[:, 1:] != np.sort(result, axis=1)[:, :-1]).all()) # distinct
+        # all subsets are drawn, with (roughly) equal frequency
+        result = _sample_without_replacement(np.full(6000, 4), 2, random)
+        subsets, freqs = np.unique(np.sort(result, axis=1), axis=0, return_counts=True)
+        self.assertEqual(len(subsets), 6)
+        self.assertTrue((np.abs(freqs - 1000) < 150).all())
+        # and each position is drawn uniformly
+        for j in range(2):
+            self.assertTrue((np.abs(np.bincount(result[:, j], minlength=4) - 1500) < 200).all())
+
+    def test_query_doc_scores_without_run(self):
+        index = mock.Mock(spec=['get_query_doc_scores'])
+        index.get_query_doc_scores.return_value = (1.5, 2.)
+        dataset = _ScoresDataset(index)
+        with mock.patch.object(dataset, '_load_run_base') as load_run:
+            record = dataset.build_record({'runscore', 'query_score'}, query_id='q1', doc_id='d9')
+            self.assertEqual((record['runscore'], record['query_score']), (1.5, 2.))
+            load_run.assert_not_called() # scored individually, without building the run
+        index.get_query_doc_scores.assert_called_with(('hello', 'world'), 'd9', 'bm25')
+
+        # with batch_qdscores, the run is needed (the pair is scored individually if not in the run)
+        dataset.config['batch_qdscores'] = True
+        with mock.patch.object(dataset, '_load_run_base', return_value='run') as load_run:
+            record = dataset.build_record({'runscore'}, query_id='q1', doc_id='d9')
+            self.assertEqual(record['runscore'], 1.5)
+            load_run.assert_called()
+
+    def test_path_segment(self):
+        dataset = _ScoresDataset(None)
+        self.assertEqual(dataset.path_segment(), 'test_all_bm25.1000')
+        dataset.config['index_backend'] = 'numpy'
+        self.assertEqual(dataset.path_segment(), 'test_all_bm25.1000_numpy')
+
+
+class _ScoresDataset(datasets.IndexBackedDataset):
+    name = 'test'
+
+    def __init__(self, index):
+        vocab = mock.Mock(spec=['tokenize'])
+        vocab.tokenize.side_effect = str.split
+        super().__init__(datasets.IndexBackedDataset.default_config(), log.Logger('test'), vocab)
+        self._index = index
+
+    def _get_index(self, record):
+        return self._index
+
+    def _get_index_for_batchsearch(self):
+        return self._index
+
+    def _load_queries_base(self, subset):
+        return {'q1': 'hello world'}
+
+
+class _SamplerDataset:
+    logger = log.Logger('test')
+
+    def __init__(self):
+        rows = [(f'q{i % 7}', f'd{i}', i % 3) for i in range(30)]
+        self._qrels = pd.DataFrame(rows, columns=['qid', 'did', 'score'])
+
+    def qrels(self, fmt):
+        assert fmt == 'df'
+        return self._qrels
+
+    def run(self, fmt):
+        assert fmt == 'df'
+        return self._qrels.assign(score=self._qrels['score'].astype(float))
+
+    def build_records(self, fields, keys):
+        return [{'query_id': qid, 'doc_id': did} for qid, did in keys]
+
+
+class _BatchVocab:
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+
+
+class _BatchDataset:
+    # builds records from the ids alone; early batches are slowest, so workers finish out of order
+    def __init__(self, config, logger, vocab):
+        self.config = config
+        self.logger = logger
+        self.vocab = vocab
+
+    def build_records(self, fields, keys):
+        result = []
+        for qid, did in keys:
+            if os.getpid() != _PARENT_PID:
+                time.sleep(max(0., 0.05 - 0.005 * int(qid[1:])))
+            record = {
+                'query_tok': [int(qid[1:]), 1],
+                'doc_tok': [int(self.config['scale'])] * len(did),
+                'doc_len': len(did),
+            }
+            result.append({f: record[f] for f in fields})
+        return result
+
+
+_PARENT_PID = os.getpid()
+
+
+def _tolist(value):
+    return value.tolist() if hasattr(value, 'tolist') else list(value)
@@ -1,8 +1,14 @@
 import os
+import json
+import math
+import shutil
 import tempfile
 import unittest
-from onir import indices
-from onir.interfaces import plaintext
+import threading
+from unittest import mock
+from onir import indices, vocab
+from onir.interfaces import plaintext, trec
+from onir.interfaces.sqlite import Sqlite2KeyDict
 
 
 class TestMetrics(unittest.TestCase):
@@ -15,6 +21,8 @@ class TestMetrics(unittest.TestCase):
                 (indices.AnseriniIndex(os.path.join(tmpdir, 'anserini')), False),
                 (indices.AnseriniIndex(os.path.join(tmpdir, 'anserini.rawdocs'), store_raw_docs=True), True),
                 (indices.SqliteDocstore(os.path.join(tmpdir, 'sqlite')), True),
+                (indices.InvertedIndex(os.path.join(tmpdir, 'inverted')), False),
+                (indices.InvertedIndex(os.path.join(tmpdir, 'inverted.rawdocs'), store_raw_docs=True), True),
             ]
             for index, check_raw_docs in idxs:
                 with self.subTest(index=index):
@@ -26,6 +34,219 @@ class TestMetrics(unittest.TestCase):
                         for doc in docs:
                             self.assertEqual(index.get_raw(doc.did), doc.data['text'])
 
+    def test_get_raws(self):
+        df = plaintext.read_tsv('etc/dummy_datafile.tsv')
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        dids = [doc.did for doc in reversed(docs)]
+        expected = [doc.data['text'] for doc in reversed(docs)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            idxs = [
+                indices.SqliteDocstore(os.path.join(tmpdir, 'sqlite')),
+                indices.SqliteDocstore(os.path.join(tmpdir, 'sqlite.zstd'), compress=True),
+                indices.MultifieldSqliteDocstore(os.path.join(tmpdir, 'multifield_sqlite')),
+                indices.MultifieldSqliteDocstore(os.path.join(tmpdir, 'multifield_sqlite.zstd'), compress=True),
+            ]
+            for index in idxs:
+                with self.subTest(index=index):
+                    index.build(iter(docs))
+                    self.assertEqual(index.get_raws(dids), expected)
+                    self.assertEqual(index.get_raws(dids[:1] * 3), expected[:1] * 3)
+                    with self.assertRaises(KeyError):
+                        index.get_raws(dids[:1] + ['__missing__'])
+
+    def test_sqlite_legacy(self):
+        df = plaintext.read_tsv('etc/dummy_datafile.tsv')
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sqlite')
+            # file in the format written by previous versions
+            legacy = Sqlite2KeyDict(path, tablename='text', autocommit=False)
+            legacy.update([('__raw__', doc.did, doc.data['text']) for doc in docs])
+            legacy.commit()
+            legacy.close()
+            index = indices.SqliteDocstore(path)
+            self.assertTrue(index.built())
+            self.assertEqual(index.num_docs(), len(docs))
+            self.assertEqual(list(index.docids()), [doc.did for doc in docs])
+            self.assertEqual(index.get_raws([doc.did for doc in docs]), [doc.data['text'] for doc in docs])
+
+    def test_lexicon(self):
+        terms = [
+            {'term': 'bé', 'df': 2, 'cf': 5},
+            {'term': 'a', 'df': 1, 'cf': 1},
+            {'term': 'c', 'df': 3, 'cf': 4},
+            {'term': 'a', 'df': 2, 'cf': 3}, # from another segment
+        ]
+        stats = indices.CollectionStats(num_docs=4, doc_count=4, sum_total_term_freq=13, sum_doc_freq=8)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lexicon = indices.Lexicon(os.path.join(tmpdir, 'lexicon'))
+            self.assertFalse(lexicon.built())
+            calls = []
+            analyzer = lambda term: calls.append(term) or ([] if term == 'the' else term.lower().split('-'))
+            lexicon.build(iter(terms), stats, {'C': ('c',), 'the': ()})
+            self.assertTrue(lexicon.built())
+            self.assertEqual(lexicon.collection_stats(), stats)
+            self.assertEqual([t['term'] for t in lexicon.iter_terms()], ['a', 'bé', 'c'])
+            self.assertEqual((lexicon.df('a'), lexicon.cf('a')), (3, 4))
+            self.assertEqual((lexicon.df('bé'), lexicon.cf('bé')), (2, 5))
+            self.assertEqual((lexicon.df('b'), lexicon.df('d')), (0, 0))
+            # precomputed when built
+            self.assertEqual(lexicon.analyze('C', analyzer), ('c',))
+            self.assertEqual(lexicon.analyze('the', analyzer), ())
+            self.assertEqual(calls, [])
+            # kept for this process only
+            self.assertEqual(lexicon.analyze('a-C', analyzer), ('a', 'c'))
+            self.assertEqual(calls, ['a-C'])
+            lexicon.add_analyzed(['C', 'a-C', 'B\tb'], analyzer)
+            self.assertEqual(calls, ['a-C', 'B\tb'])
+            self.assertEqual(sorted(os.listdir(lexicon.path())), ['analyzed.json', 'cf.npy', 'df.npy', 'meta.json', 'offsets.npy', 'terms.bin'])
+            reopened = indices.Lexicon(lexicon.path())
+            self.assertEqual(reopened.analyze('C', analyzer), ('c',))
+            self.assertEqual(reopened.analyze('the', analyzer), ())
+            self.assertEqual(reopened.analyze('a-C', analyzer), ('a', 'c'))
+            self.assertEqual(reopened.analyze('B\tb', analyzer), ('b\tb',))
+            self.assertEqual(calls, ['a-C', 'B\tb'])
+
+    def test_docid_map(self):
+        dids = ['D1', 'clueweb09-en0000-00-00000', 'dé', '', 'D10', 'D2']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            docid_map = indices.DocidMap(os.path.join(tmpdir, 'docids'))
+            self.assertFalse(docid_map.built())
+            docid_map.build(iter(dids))
+            self.assertTrue(docid_map.built())
+            reopened = indices.DocidMap(docid_map.path())
+            self.assertEqual(reopened.num_docs(), len(dids))
+            self.assertEqual(list(reopened.iter_dids(chunk_size=4)), dids)
+            self.assertEqual(reopened.dids(1, 3), dids[1:3])
+            for idx, did in enumerate(dids):
+                self.assertEqual(reopened.did(idx), did)
+                self.assertEqual(reopened.idx(did), idx)
+            self.assertEqual(reopened.idx('D3'), -1)
+            self.assertEqual(reopened.idxs(['D2', 'D3', 'dé']).tolist(), [5, -1, 2])
+            reopened.remove()
+            self.assertFalse(docid_map.built())
+
+    def test_json_feeder(self):
+        records = [{'id': f'D{i}', 'contents': f'text {i} é'} for i in range(2500)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            feeder = indices.JsonFeeder(tmpdir, 3)
+            lines = [[] for _ in feeder.fifos]
+            def read(fifo, result):
+                with open(fifo, 'rt') as f:
+                    result.extend(f)
+            readers = [threading.Thread(target=read, args=args) for args in zip(feeder.fifos, lines)]
+            for reader in readers:
+                reader.start()
+            stats = feeder.feed(iter(records))
+            for reader in readers:
+                reader.join()
+            fed = sorted((json.loads(line) for result in lines for line in result), key=lambda r: int(r['id'][1:]))
+            self.assertEqual(fed, records)
+            self.assertEqual(stats['docs'], len(records))
+            self.assertEqual(stats['bytes'], sum(len(line) for result in lines for line in result))
+
+    def test_scoring(self):
+        stats = indices.CollectionStats(num_docs=10, doc_count=10, sum_total_term_freq=500, sum_doc_freq=300)
+        self.assertEqual(list(indices.scoring.encoded_lengths([0, 5, 23, 24, 100])), [0, 5, 23, 24, 96])
+        tfs = [[1, 0], [3, 2]]
+        lens = [40, 60]
+        bm25 = indices.scoring.score_terms(indices.scoring.parse_model('bm25_k1-1.2_b-0.5'), tfs, lens, [2, 5], [4, 20], stats)
+        ql = indices.scoring.score_terms(indices.scoring.parse_model('ql_mu-100'), tfs, lens, [2, 5], [4, 20], stats)
+        for d, (dl, doc_tfs) in enumerate(zip(indices.scoring.encoded_lengths(lens), tfs)):
+            for t, (tf, df, cf) in enumerate(zip(doc_tfs, [2, 5], [4, 20])):
+                idf = math.log(1 + (10 - df + 0.5) / (df + 0.5))
+                expected_bm25 = idf * tf / (tf + 1.2 * (1 - 0.5 + 0.5 * dl / 50)) if tf else 0.
+                expected_ql = math.log(1 + tf / (100 * (cf + 1) / 501)) + math.log(100 / (dl + 100)) if tf else 0.
+                self.assertAlmostEqual(float(bm25[d, t]), expected_bm25, places=5)
+                self.assertAlmostEqual(float(ql[d, t]), max(expected_ql, 0.), places=5)
+        self.assertIsNone(indices.scoring.parse_model('bm25_rm3'))
+        self.assertIsNone(indices.scoring.parse_model('sdm'))
+
+    def test_batch_query_doc_scores(self):
+        df = list(plaintext.read_tsv('etc/dummy_datafile.tsv'))
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        queries = {qid: tuple(qtext.split()) for t, qid, qtext in df if t == 'query'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = indices.AnseriniIndex(os.path.join(tmpdir, 'anserini'))
+            index.build(docs)
+            for model in ['bm25', 'bm25_k1-1.6_b-0.8', 'ql']:
+                run = index.batch_query(list(queries.items()), model, topk=10, quiet=True)
+                scores = index.batch_query_doc_scores(queries, run, model)
+                for qid, doc_scores in run.items():
+                    for did in doc_scores:
+                        with self.subTest(model=model, qid=qid, did=did):
+                            total, term_scores = scores.get(qid, did, queries[qid])
+                            expected_total, expected_term_scores = index.get_query_doc_scores(queries[qid], did, model)
+                            self.assertAlmostEqual(total, expected_total, places=4)
+                            for score, expected_score in zip(term_scores, expected_term_scores):
+                                self.assertAlmostEqual(score, expected_score, places=4)
+
+    def test_inverted_batch_query(self):
+        df = list(plaintext.read_tsv('etc/dummy_datafile.tsv'))
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        # queries made of document terms, so that there are enough matches
+        terms = [term for doc in docs for term in doc.data['text'].split()]
+        queries = [(str(i), ' '.join(terms[i*7:i*7+4])) for i in range(20)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = indices.InvertedIndex(os.path.join(tmpdir, 'inverted'))
+            index.build(docs)
+            for model in ['bm25', 'bm25_k1-1.6_b-0.8', 'ql', 'ql_mu-100']:
+                run = index.batch_query(queries, model, topk=5, quiet=True)
+                for qid, text in queries:
+                    with self.subTest(model=model, qid=qid):
+                        ranked = list(run[qid].items())
+                        self.assertTrue(0 < len(ranked) <= 5)
+                        self.assertEqual(ranked, sorted(ranked, key=lambda x: (-x[1], x[0])))
+                        for did, score in ranked:
+                            self.assertAlmostEqual(score, index.get_query_doc_scores(text.split(), did, model)[0], places=4)
+                self.assertEqual(index.query(queries[0][1], model, topk=5), run[queries[0][0]])
+                self.assertEqual(index.batch_query_table(queries, model, topk=5, quiet=True).to_dict(), run)
+                run_path = os.path.join(tmpdir, f'{model}.run')
+                index.batch_query(queries, model, topk=5, destf=run_path, quiet=True)
+                self.assertEqual(trec.read_run_table(run_path).to_dict(), run)
+            with self.assertRaises(ValueError):
+                index.batch_query(queries, 'bm25_rm3', topk=5)
+
+    def test_inverted_get_raw(self):
+        df = list(plaintext.read_tsv('etc/dummy_datafile.tsv'))
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = indices.InvertedIndex(os.path.join(tmpdir, 'inverted'), store_raw_docs=True)
+            index.build(docs)
+            with mock.patch.object(indices, 'SqliteDocstore', wraps=indices.SqliteDocstore) as docstore:
+                for doc in docs:
+                    self.assertEqual(index.get_raw(doc.did), doc.data['text'])
+                self.assertEqual(docstore.call_count, 1) # opened once
+
+    def test_porter_stem(self):
+        cases = {
+            'caresses': 'caress', 'ponies': 'poni', 'cats': 'cat', 'agreed': 'agre', 'hopping': 'hop',
+            'filing': 'file', 'happy': 'happi', 'relational': 'relat', 'conformabli': 'conform',
+            'hopefulness': 'hope', 'electrical': 'electr', 'adoption': 'adopt', 'controll': 'control',
+            'generalizations': 'gener', 'oscillators': 'oscil', 'is': 'is',
+        }
+        for word, stem in cases.items():
+            self.assertEqual(indices.analysis.porter_stem(word), stem)
+        self.assertEqual(indices.analysis.Analyzer(keep_stops=False)("The Dogs' owner's cats"), ['dog', 'owner', 'cat'])
+
+    def test_tokenized(self):
+        df = plaintext.read_tsv('etc/dummy_datafile.tsv')
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        vocab = _SimpleVocab()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            docstore = indices.SqliteDocstore(os.path.join(tmpdir, 'sqlite'))
+            docstore.build(iter(docs))
+            tokstore = indices.TokenizedDocstore(os.path.join(tmpdir, 'sqlite.tok'), docstore, vocab)
+            self.assertFalse(tokstore.built())
+            tokstore.build()
+            self.assertTrue(tokstore.built())
+            self.assertEqual(tokstore.num_docs(), len(docs))
+            self.assertEqual(set(tokstore.docids()), {doc.did for doc in docs})
+            for doc in docs:
+                expected = [vocab.tok2id(t) for t in vocab.tokenize(doc.data['text'])]
+                self.assertEqual(list(tokstore.get_tok(doc.did)), expected)
+                self.assertEqual(tokstore.get_len(doc.did), len(expected))
+
     def test_batch_query(self):
         df = list(plaintext.read_tsv('etc/dummy_datafile.tsv'))
         docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
@@ -46,8 +267,41 @@ class TestMetrics(unittest.TestCase):
                 index.build(docs)
                 for model in models:
                     with self.subTest(index=index, model=model):
-                        index.batch_query(queries, model, topk=10)
-                        index.batch_query(queries, model, topk=10, quiet=True)
+                        run = index.batch_query(queries, model, topk=10)
+                        self.assertEqual(index.batch_query(queries, model, topk=10, quiet=True), run)
+                        self.assertEqual(index.batch_query_table(queries, model, topk=10, quiet=True).to_dict(), run)
+
+    @unittest.skipIf(shutil.which('java') is None, 'needs a JVM')
+    def test_batch_query_searchers(self):
+        # runs from the in-process searchers match those from SearchCollection
+        df = list(plaintext.read_tsv('etc/dummy_datafile.tsv'))
+        docs = [indices.RawDoc(did, dtext) for t, did, dtext in df if t == 'doc']
+        queries = [(qid, qtext) for t, qid, qtext in df if t == 'query']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index = indices.AnseriniIndex(os.path.join(tmpdir, 'anserini'))
+            index.build(docs)
+            for model in ['bm25', 'bm25_k1-1.6_b-0.8', 'bm25_rm3', 'bm25_rm3_rm3.fbTerms-2_rm3.fbDocs-2', 'ql', 'ql_mu-0.4']:
+                for topk in [3, 10]: # small cutoffs, where score ties are broken
+                    with self.subTest(model=model, topk=topk):
+                        expected = index._batch_query_collection(queries, model, topk, quiet=True) # pylint: disable=W0212
+                        run = index.batch_query(queries, model, topk, quiet=True)
+                        self.assertEqual(run.keys(), expected.keys())
+                        for qid in expected:
+                            self.assertEqual(list(run[qid]), list(expected[qid]))
+                            for did, score in expected[qid].items():
+                                self.assertAlmostEqual(run[qid][did], score, places=4)
+
+
+class _SimpleVocab(vocab.Vocab):
+    def __init__(self):
+        super().__init__({}, None)
+        self._term2idx = {}
+
+    def tok2id(self, tok):
+        return self._term2idx.setdefault(tok, len(self._term2idx))
+
+    def lexicon_path_segment(self):
+        return 'simple'
 
 
 if __name__ == '__main__':
@@ -98,6 +98,30 @@ class TestMetrics(unittest.TestCase):
             },
         ])
 
+    def test_tables(self):
+        rng = random.Random(42)
+        DOCS = list('ABCEDFGHIJKLMNOPQRSTUVWXYZ')
+        qrels = {q: {doc: rng.choice([0, 1, 2]) for doc in rng.sample(DOCS, 10)} for q in '012'}
+        run = {q: {doc: float(rng.randint(-50, 50)) for doc in rng.sample(DOCS, 20)} for q in '0123'}
+        qrels_table = trec.QrelsTable.from_dict(qrels)
+        run_table = trec.RunTable.from_dict(run)
+        self.assertEqual(qrels_table.to_dict(), qrels)
+        self.assertEqual(run_table.to_dict(), run)
+        self.assertEqual(trec.RunTable.from_df(run_table.to_df()).to_dict(), run)
+        self.assertEqual(trec.Qrels(qrels_table).dict(), qrels)
+        self.assertEqual(run_table.query_dict('3'), run['3'])
+        self.assertFalse('4' in run_table)
+        for measure in ['p@5', 'judged@10', 'mrr@10']:
+            for metric_provider in onir.metrics.primary.metrics_priority_list:
+                if metric_provider.supports(measure):
+                    with self.subTest(metric_provider=metric_provider, measure=measure):
+                        results = []
+                        for q, r in [(qrels, run), (qrels_table, run_table)]:
+                            these_qrels = onir.metrics.FallbackMetrics.FormatManager(q, trec.read_qrels_dict, trec.write_qrels_dict_)
+                            these_run = onir.metrics.FallbackMetrics.FormatManager(r, trec.read_run_dict, trec.write_run_dict_)
+                            results.append(metric_provider.calc_metrics(these_qrels.in_format(metric_provider.QRELS_FORMAT), these_run.in_format(metric_provider.RUN_FORMAT), [measure]))
+                        self.assertEqual(results[0], results[1])
+
     def test_treceval_equals_pytreceval(self):
         rng = random.Random(42)
         DOCS = list('ABCEDFGHIJKLMNOPQRSTUVWXYZ')
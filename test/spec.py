@@ -0,0 +1,60 @@
+import random
+import unittest
+import numpy as np
+from onir import spec
+
+
+class TestSpec(unittest.TestCase):
+
+    def test_padded_array(self):
+        rng = random.Random(42)
+        for _ in range(1000):
+            len_mode = rng.choice(['strict', 'max', 'none'])
+            maxlen = rng.randint(1, 10)
+            minlen = rng.choice([None, rng.randint(0, 12)])
+            count = rng.randint(1, 5)
+            if len_mode == 'none':
+                seq_len = rng.randint(0, 8)
+                seqs = [[rng.randint(0, 9) for _ in range(seq_len)] for _ in range(count)]
+            else:
+                seqs = [[rng.randint(0, 9) for _ in range(rng.randint(0, 15))] for _ in range(count)]
+            if rng.random() < 0.3:
+                seqs = [np.array(seq, dtype=np.int32) for seq in seqs]
+            original = [list(seq) for seq in seqs]
+            with self.subTest(len_mode=len_mode, maxlen=maxlen, minlen=minlen, seqs=original):
+                expected = _padded_list(seqs, len_mode, maxlen, minlen)
+                result = spec.padded_array(seqs, len_mode, maxlen, minlen)
+                self.assertEqual(result.dtype, np.int64)
+                self.assertEqual(result.shape[0], count)
+                self.assertEqual(result.tolist(), expected)
+                self.assertEqual([list(seq) for seq in seqs], original)
+        result = spec.padded_array([[0.5, 1.5], [2.5]], 'max', 5, dtype=np.float32)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.tolist(), [[0.5, 1.5], [2.5, -1.]])
+        with self.assertRaises(ValueError):
+            spec.padded_array([[1], [1, 2]], 'none', 5)
+        with self.assertRaises(ValueError):
+            spec.padded_array([[1]], 'other', 5)
+
+    def test_clip_crop_pad_min_len(self):
+        seq = [1, 2, 3]
+        self.assertEqual(spec.clip_crop(seq, 2), [1, 2])
+        self.assertEqual(spec.clip_crop(seq, 5), [1, 2, 3, -1, -1])
+        self.assertEqual(spec.clip_crop(np.array(seq), 5), [1, 2, 3, -1, -1])
+        self.assertEqual(spec.pad_min_len(seq, 5), [1, 2, 3, -1, -1])
+        self.assertEqual(spec.pad_min_len(seq, 2), [1, 2, 3])
+        self.assertEqual(list(spec.pad_min_len(np.array(seq), 4)), [1, 2, 3, -1])
+        self.assertEqual(seq, [1, 2, 3])
+
+
+def _padded_list(seqs, len_mode, maxlen, minlen):
+    # nested-list padding, as previously done by apply_spec_batch
+    result = [list(seq) for seq in seqs]
+    if len_mode == 'strict':
+        result = [spec.clip_crop(r, maxlen) for r in result]
+    elif len_mode == 'max':
+        max_seq_len = min(maxlen, max(len(r) for r in result))
+        result = [spec.clip_crop(r, max_seq_len) for r in result]
+    if minlen is not None:
+        result = [spec.pad_min_len(r, minlen) for r in result]
+    return [[int(v) for v in r] for r in result]
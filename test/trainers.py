@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from onir import log
+from onir.trainers import shards, base
+
+
+INPUT_SPEC = {'qlen': 4, 'dlen': 8, 'qlen_mode': 'strict', 'dlen_mode': 'max'}
+
+
+class TestTrainers(unittest.TestCase):
+
+    def test_shards(self):
+        rng = np.random.RandomState(0)
+        records = [{
+            'query_tok': [rng.randint(0, 50, 3).tolist()] * 2,
+            'doc_tok': [rng.randint(0, 50, rng.randint(0, 12)).tolist() for _ in range(2)],
+            'runscore': [float(rng.rand()), float(rng.rand())],
+            'doc_len': [int(rng.randint(1, 20)), int(rng.randint(1, 20))],
+        } for _ in range(20)]
+        logger = log.Logger('test')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'shards')
+            shards.compile_shards(path, iter(records), 20, INPUT_SPEC, 2, {'records_per_epoch': 10}, logger)
+            self.assertFalse(os.path.exists(f'{path}.tmp'))
+            reader = shards.ShardReader(path, {'records_per_epoch': 10})
+            for start, batch_size in [(0, 4), (10, 4), (16, 2), (7, 5)]:
+                with self.subTest(start=start, batch_size=batch_size):
+                    reader.seek(start)
+                    batches = reader.iter_batches(batch_size)
+                    for batch_start in [start, start + batch_size]:
+                        if batch_start + batch_size > 20:
+                            break
+                        batch = next(batches)
+                        expected = records[batch_start:batch_start+batch_size]
+                        self.assertEqual([row.tolist() for row in batch['query_tok']], [s for r in expected for s in r['query_tok']])
+                        self.assertEqual([row.tolist() for row in batch['doc_tok']], [s[:8] for r in expected for s in r['doc_tok']])
+                        np.testing.assert_allclose(batch['runscore'], [v for r in expected for v in r['runscore']], rtol=1e-6)
+                        self.assertEqual(batch['runscore'].dtype, np.float32)
+                        self.assertEqual(batch['doc_len'].tolist(), [v for r in expected for v in r['doc_len']])
+            reader.seek(18)
+            batches = reader.iter_batches(2)
+            next(batches)
+            with self.assertRaises(ValueError):
+                next(batches) # exhausted
+            with self.assertRaises(ValueError):
+                shards.ShardReader(path, {'records_per_epoch': 11})
+
+            with self.assertRaises(ValueError):
+                shards.compile_shards(path, iter(records), 21, INPUT_SPEC, 2, {}, logger)
+            self.assertTrue(os.path.exists(os.path.join(path, 'meta.json'))) # earlier shards are kept
+        with self.assertRaises(FileNotFoundError):
+            shards.ShardReader(os.path.join(tmpdir, 'missing'), {})
+
+    def test_iter_train_closes_batch_pool(self):
+        trainer = mock.Mock()
+        trainer._iter_train.return_value = iter([{'epoch': -1}, {'epoch': 0}, {'epoch': 1}])
+        it = base.Trainer.iter_train(trainer)
+        self.assertEqual(next(it)['epoch'], -1)
+        self.assertEqual(next(it)['epoch'], 0)
+        trainer.batch_pool.close.assert_not_called()
+        it.close() # e.g., the pipeline stops early
+        trainer.batch_pool.close.assert_called_once_with()
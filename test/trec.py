@@ -0,0 +1,154 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from onir.interfaces import plaintext, trec
+
+
+RUN_LINES = [
+    'q1 Q0 d1 1 12.5 run',
+    'q1 Q0 d2 2 1.0000001 run',
+    'q1 Q0 d3 3 -3e-05 run',
+    'q2 Q0 d2 1 0.30000000000000004 run',
+    'q2 Q0 d4 2 7 run',
+    'q3 Q0 d1 1 1e+20 run',
+    'q3 Q0 d5 2 -0.5 run',
+]
+
+
+QRELS_LINES = [
+    'q1 0 d1 1',
+    'q1 0 d3 0',
+    'q2 0 d4 2',
+    'q3 0 d5 -1',
+]
+
+
+class TestTrec(unittest.TestCase):
+
+    def test_read_run(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = _write_lines(tmpdir, 'run', RUN_LINES)
+            expected = {}
+            for qid, _, did, _, score, _ in plaintext.read_sv(run_path, sep=' '):
+                expected.setdefault(qid, {})[did] = float(score)
+            # small chunks, so that records of a query span several chunks
+            for chunk_size in [2, trec.BULK_CHUNK_SIZE]:
+                with self.subTest(chunk_size=chunk_size), mock.patch.object(trec, 'BULK_CHUNK_SIZE', chunk_size):
+                    self.assertEqual(trec.read_run_dict(run_path), expected)
+                    self.assertEqual(list(trec.read_run(run_path)),
+                                     [(qid, did, int(rank), float(score)) for qid, _, did, rank, score, _ in plaintext.read_sv(run_path, sep=' ')])
+                    self.assertEqual(trec.read_run_table(run_path).to_dict(), {qid: {did: float(trec.RunTable.SCORE_DTYPE(score)) for did, score in docs.items()} for qid, docs in expected.items()})
+            self.assertEqual(trec.read_run_dict(run_path, top=1), {qid: dict([next(iter(docs.items()))]) for qid, docs in expected.items()})
+
+    def test_read_qrels(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            qrels_path = _write_lines(tmpdir, 'qrels', QRELS_LINES)
+            expected = {}
+            for qid, _, did, score in plaintext.read_sv(qrels_path, sep=' '):
+                expected.setdefault(qid, {})[did] = int(score)
+            with mock.patch.object(trec, 'BULK_CHUNK_SIZE', 3):
+                self.assertEqual(trec.read_qrels_dict(qrels_path), expected)
+
+    def test_run_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = _write_lines(tmpdir, 'run', RUN_LINES)
+            with mock.patch.object(trec, '_read_run_arrays', wraps=trec._read_run_arrays) as parse:
+                expected = trec.read_run_dict(run_path, cache=True)
+                self.assertTrue(os.path.exists(f'{run_path}.npz'))
+                self.assertEqual(parse.call_count, 1)
+                self.assertEqual(trec.read_run_dict(run_path, cache=True), expected)
+                self.assertEqual(parse.call_count, 1) # from the sidecar
+
+                # a different size invalidates the sidecar
+                _write_lines(tmpdir, 'run', RUN_LINES[:-1])
+                self.assertNotIn('d5', trec.read_run_dict(run_path, cache=True)['q3'])
+                self.assertEqual(parse.call_count, 2)
+                self.assertNotIn('d5', trec.read_run_dict(run_path, cache=True)['q3'])
+                self.assertEqual(parse.call_count, 2)
+
+                # so does a different modification time (with the same size)
+                _write_lines(tmpdir, 'run', [RUN_LINES[0].replace('12.5', '13.5')] + RUN_LINES[1:-1])
+                stat = os.stat(run_path)
+                os.utime(run_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+                self.assertEqual(trec.read_run_dict(run_path, cache=True)['q1']['d1'], 13.5)
+                self.assertEqual(parse.call_count, 3)
+
+                # and a sidecar written by a different version is ignored
+                with mock.patch.object(trec, 'RUN_SIDECAR_VERSION', trec.RUN_SIDECAR_VERSION + 1):
+                    self.assertEqual(trec.read_run_dict(run_path, cache=True)['q1']['d1'], 13.5)
+                    self.assertEqual(parse.call_count, 4)
+
+    def test_run_no_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = _write_lines(tmpdir, 'run', RUN_LINES)
+            trec.read_run_dict(run_path)
+            self.assertFalse(os.path.exists(f'{run_path}.npz'))
+
+    def test_truncate_run(self):
+        lines = [
+            'q1 Q0 d1 1 3.0 run',
+            'q1 Q0 d3 2 2.0 run',
+            'q1 Q0 d2 3 2.0 run', # tied with d3 at the cutoff; file order is kept
+            'q1 Q0 d4 4 1.0 run',
+            'q2 Q0 d9 1 5.0 run',
+            'q3 Q0 d5 1 1.0 run',
+            'q3 Q0 d7 2 1.0 run',
+            'q3 Q0 d6 3 1.0 run',
+            'q3 Q0 d1 4 0.5 run',
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = _write_lines(tmpdir, 'run', lines)
+            for top in [1, 2, 3, 10]:
+                with self.subTest(top=top):
+                    dest = os.path.join(tmpdir, f'run.{top}')
+                    trec.truncate_run(run_path, dest, top)
+                    with open(dest, 'rt') as f:
+                        self.assertEqual(f.read().splitlines(), [l for l in lines if int(l.split()[3]) <= top])
+                    self.assertEqual(trec.read_run_dict(dest), trec.read_run_dict(run_path, top=top))
+                    self.assertFalse(os.path.exists(f'{dest}.tmp'))
+            table = trec.read_run_table(os.path.join(tmpdir, 'run.2'))
+            self.assertEqual([table.dids[c] for c in table.query('q1')[0]], ['d1', 'd3'])
+            self.assertEqual([table.dids[c] for c in table.query('q3')[0]], ['d5', 'd7'])
+            # tab-separated columns and blank lines
+            mixed = [l.replace(' ', '\t', 1) if l.startswith('q3') else l for l in lines]
+            mixed = mixed[:5] + [''] + mixed[5:] + ['   ']
+            run_path = _write_lines(tmpdir, 'run.mixed', mixed)
+            for top in [1, 2, 3, 10]:
+                with self.subTest(top=top, sep='mixed'):
+                    dest = os.path.join(tmpdir, f'run.mixed.{top}')
+                    trec.truncate_run(run_path, dest, top)
+                    with open(dest, 'rt') as f:
+                        self.assertEqual(f.read().splitlines(), [l for l in mixed if l.strip() and int(l.split()[3]) <= top])
+
+    def test_write_run_queries(self):
+        results = [
+            ('q1', ['d2', 'd1', 'd3'], np.array([3.5, 2., 2.], dtype=np.float32)),
+            ('q2', [], np.zeros(0, dtype=np.float32)),
+            ('q3', ['d1'], np.array([-1.25], dtype=np.float32)),
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            run_path = os.path.join(tmpdir, 'run')
+            trec.write_run_queries(run_path, iter(results), runid='test')
+            with open(run_path, 'rt') as f:
+                self.assertEqual(f.read().splitlines(), [
+                    'q1 Q0 d2 1 3.5 test',
+                    'q1 Q0 d1 2 2.0 test',
+                    'q1 Q0 d3 3 2.0 test',
+                    'q3 Q0 d1 1 -1.25 test',
+                ])
+        table = trec.RunTable.from_queries(iter(results))
+        self.assertEqual(table.qids, ['q1', 'q2', 'q3'])
+        self.assertEqual([table.dids[c] for c in table.query('q1')[0]], ['d2', 'd1', 'd3'])
+        self.assertEqual(table.query_dict('q2'), {})
+        self.assertEqual(table.to_dict(), {'q1': {'d2': 3.5, 'd1': 2., 'd3': 2.}, 'q2': {}, 'q3': {'d1': -1.25}})
+
+
+def _write_lines(tmpdir, name, lines):
+    path = os.path.join(tmpdir, name)
+    with open(path, 'wt') as f:
+        for line in lines:
+            f.write(f'{line}\n')
+    return path
+
@@ -0,0 +1,141 @@
+import time
+import itertools
+import unittest
+from threading import Thread
+import numpy as np
+from onir.util.cache import LruCache, sizeof
+from onir.util.concurrency import FanOut, FanOutCancelled
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_lru_cache(self):
+        values = {key: np.full(1000, i, dtype=np.uint8) for i, key in enumerate('abcde')}
+        size = sizeof(values['a'])
+        self.assertTrue(1000 <= size < 2000)
+        cache = LruCache(max_bytes=3 * size)
+        calls = []
+        def get(key):
+            return cache.get(key, lambda: calls.append(key) or values[key])
+        for key in 'abc':
+            self.assertIs(get(key), values[key])
+        self.assertEqual(cache.nbytes, 3 * size)
+        self.assertIs(get('a'), values['a']) # a is now the most recently used
+        get('d') # evicts b, the least recently used
+        self.assertEqual([key for key in 'abcde' if key in cache], ['a', 'c', 'd'])
+        self.assertEqual(cache.nbytes, 3 * size)
+        get('b') # evicts c
+        self.assertEqual([key for key in 'abcde' if key in cache], ['a', 'b', 'd'])
+        self.assertEqual(calls, ['a', 'b', 'c', 'd', 'b'])
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+        # values larger than the whole cache are returned but not cached
+        big = np.zeros(4000, dtype=np.uint8)
+        self.assertIs(cache.get('big', lambda: big), big)
+        self.assertNotIn('big', cache)
+        self.assertEqual(len(cache), 3)
+
+        # many small values fit in the space of a large one
+        cache.clear()
+        self.assertEqual((len(cache), cache.nbytes), (0, 0))
+        for i in range(100):
+            cache.get(i, lambda: np.zeros(10, dtype=np.uint8))
+            self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertEqual(len(cache), cache.max_bytes // sizeof(np.zeros(10, dtype=np.uint8)))
+        self.assertNotIn(0, cache)
+        self.assertIn(99, cache)
+
+    def test_sizeof(self):
+        arr = np.zeros(1000, dtype=np.uint8)
+        self.assertLess(sizeof(arr), 2000) # data counted once
+        self.assertLess(sizeof(arr[:10]), sizeof(arr)) # views do not own their data
+        self.assertEqual(sizeof([arr, arr]), sizeof([]) + 2 * sizeof(arr) + 16)
+
+    def test_fan_out_producer_error(self):
+        def items():
+            yield 1
+            yield 2
+            raise ValueError('producer failed')
+        results = [[] for _ in range(3)]
+        def consumer(i):
+            def fn(it):
+                try:
+                    for item in it:
+                        results[i].append(item)
+                except ValueError as ex:
+                    results[i].append(str(ex))
+            return fn
+        _run_with_timeout(self, lambda: FanOut(items(), 3, max_items=1).run([consumer(i) for i in range(3)]))
+        self.assertEqual(results, [[1, 2, 'producer failed']] * 3)
+
+    def test_fan_out_consumer_error(self):
+        cancelled = []
+        def failing(it):
+            next(it)
+            raise RuntimeError('consumer failed')
+        def forever(it):
+            try:
+                for _ in it:
+                    pass
+            except FanOutCancelled:
+                cancelled.append(True)
+                raise
+        fanout = FanOut(itertools.count(), 3, max_items=2)
+        def run():
+            with self.assertRaisesRegex(RuntimeError, 'consumer failed'):
+                fanout.run([forever, failing, forever])
+        _run_with_timeout(self, run)
+        self.assertEqual(cancelled, [True, True])
+
+    def test_fan_out_early_stop(self):
+        results = []
+        def stop_early(it):
+            results.append(list(itertools.islice(it, 2)))
+        def consume_all(it):
+            results.append(sum(it))
+        _run_with_timeout(self, lambda: FanOut(range(10000), 2, max_items=2).run([stop_early, consume_all]))
+        self.assertCountEqual(results, [[0, 1], sum(range(10000))])
+        # the producer stops once all consumers have stopped (even for an infinite iterator)
+        fanout = FanOut(itertools.count(), 2, max_items=2)
+        _run_with_timeout(self, lambda: fanout.run([stop_early, stop_early]))
+        fanout._thread.join(timeout=5)
+        self.assertFalse(fanout._thread.is_alive())
+
+    def test_fan_out_bounded(self):
+        for max_items, max_bytes, expected in [(3, None, 3), (100, 10, 2)]:
+            with self.subTest(max_items=max_items, max_bytes=max_bytes):
+                produced = []
+                def items():
+                    for i in itertools.count():
+                        produced.append(i)
+                        yield i
+                fanout = FanOut(items(), 2, max_items=max_items, max_bytes=max_bytes, sizefn=lambda item: 5)
+                fast, slow = fanout.iters
+                self.assertEqual(next(fast), 0)
+                time.sleep(0.2) # gives the producer time to fill the slow consumer's buffer
+                # the producer is blocked on the slow consumer, holding at most one more item
+                self.assertEqual(fanout.stats()[1]['buffered'], expected)
+                self.assertLessEqual(len(produced), expected + 1)
+                self.assertEqual(list(itertools.islice(slow, expected)), list(range(expected)))
+                fanout.cancel()
+                with self.assertRaises(FanOutCancelled):
+                    next(fast)
+                fanout._thread.join(timeout=5)
+                self.assertFalse(fanout._thread.is_alive())
+                self.assertGreaterEqual(fanout.stats()[1]['backpressure'], 0.1)
+
+
+def _run_with_timeout(test, fn, timeout=10):
+    # runs fn in a thread so that a deadlock fails the test rather than hanging it
+    errors = []
+    def target():
+        try:
+            fn()
+        except BaseException as ex:
+            errors.append(ex)
+    thread = Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    test.assertFalse(thread.is_alive(), 'deadlocked')
+    if errors:
+        raise errors[0]